@@ -0,0 +1,404 @@
+#!/usr/bin/python
+# Throughput measurements for the write paths, run from the bot's directory:
+#
+#   python plugins/LogsToDB/benchmark.py copy --rows 20000
+#   python plugins/LogsToDB/benchmark.py traffic --events 100000 --mix chat=90,netsplit=5,bans=5
+#   python plugins/LogsToDB/benchmark.py writers --shards 1,2,4,8 --latency 2 --slots 4
+#
+# copy rolls everything back afterwards, but point config.json at a scratch
+# database anyway.  traffic drives the whole plugin (__call__, the do*
+# handlers, logEvent, LogviewerFile and LogviewerDB) with generated IRC traffic
+# against a stand-in database, or the one in config.json with --db postgres.
+# writers pushes the same messages through ShardedWriter with more and more
+# writers, the stand-in database takes --latency ms a statement and runs
+# --slots of them at once, like a server with that many cores.  --db sqlite
+# runs either against a scratch SQLite file, no server needed.
+import argparse
+import atexit
+import collections
+import contextlib
+import datetime
+import importlib
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+try:
+	from . import channelLogger_model as channellogger_model
+	from . import channelLogger_pool as channellogger_pool
+	from . import channelLogger_writer as channellogger_writer
+	from . import channelLogger_sqlite as channellogger_sqlite
+except ImportError:
+	import channelLogger_model as channellogger_model
+	import channelLogger_pool as channellogger_pool
+	import channelLogger_writer as channellogger_writer
+	import channelLogger_sqlite as channellogger_sqlite
+
+# Enough awkward characters to make sure COPY's escaping is exercised
+WORDS = ['hello', 'world', 'tab\there', 'back\\slash', 'newline\nhere', 'ünïcödé', '\\N', 'select', '*', '#channel']
+# and the ones that can go in an IRC line
+LINE_WORDS = [word for word in WORDS if '\n' not in word]
+
+def make_rows(db, count):
+	# Log one join so the user and channel IDs are committed (and cached), the
+	# measurements roll back everything else
+	db.write_batch([('message', time.time(), ('benchmark', 'benchmark!bench@example.org', None, 'join', '#benchmark'))])
+	with db.pool.connection() as conn:
+		cursor = conn.cursor()
+		user_id = db.get_user_id(cursor, 'benchmark', 'benchmark!bench@example.org')
+		channel_id = db.get_channel_id(cursor, '#benchmark')
+	now = datetime.datetime.now()
+	rows = []
+	for i in range(count):
+		content = ' '.join(random.choice(WORDS) for _ in range(random.randint(1, 20)))
+		rows.append((user_id, content, 'message', channel_id, now))
+	return rows
+
+def measure(db, write, rows):
+	with db.pool.connection() as conn:
+		cursor = conn.cursor()
+		start = time.perf_counter()
+		write(cursor, rows)
+		elapsed = time.perf_counter() - start
+		conn.rollback()
+	return len(rows) / elapsed
+
+def bench_copy(args):
+	db = channellogger_model.LogviewerDB()
+	rows = make_rows(db, args.rows)
+	for (name, write) in (('INSERT', db.insert_messages), ('COPY', db.copy_messages)):
+		results = [measure(db, write, rows) for _ in range(args.repeat)]
+		print('%-6s %10.0f rows/sec (best of %s, %s rows)' % (name, max(results), args.repeat, args.rows))
+	db.close()
+
+class StandInCursor:
+	# Accepts whatever LogviewerDB sends and hands back made up IDs, so the
+	# traffic benchmark measures the plugin rather than a server
+	def __init__(self, conn):
+		self.connection = conn
+		self.rowcount = 0
+
+	def execute(self, query, params=None):
+		self.connection.statements += 1
+		self.connection.round_trip()
+
+	def mogrify(self, template, args):
+		return repr(args).encode('utf-8')
+
+	def copy_expert(self, query, data):
+		self.connection.statements += 1
+		self.connection.copied += len(data.read())
+		self.connection.round_trip()
+
+	def fetchone(self):
+		# Enough IDs for any RETURNING, e.g. an identity and its nick and host
+		self.connection.lastId += 1
+		return (self.connection.lastId,) * 3
+
+	def fetchall(self):
+		return []
+
+	def close(self):
+		pass
+
+class StandInConnection:
+	encoding = 'UTF8'
+
+	def __init__(self, latency=0, slots=None):
+		self.statements = 0
+		self.commits = 0
+		self.copied = 0
+		self.lastId = 0
+		self.latency = latency
+		self.slots = slots
+
+	def round_trip(self):
+		if self.latency:
+			with self.slots:
+				time.sleep(self.latency)
+
+	def cursor(self):
+		return StandInCursor(self)
+
+	def commit(self):
+		self.commits += 1
+		self.round_trip()
+
+	def rollback(self):
+		pass
+
+class StandInPool:
+	# Takes the place of LogviewerPool, every caller shares one connection
+	def __init__(self, config=None, latency=0, slots=1, **kwargs):
+		self.conn = StandInConnection(latency, threading.BoundedSemaphore(slots))
+
+	@contextlib.contextmanager
+	def connection(self, kind='write'):
+		yield self.conn
+
+	def stats(self):
+		return {}
+
+	def close(self):
+		pass
+
+class Traffic:
+	# Generates IrcMsgs for a network of channels and users, keeping track of
+	# who is where so quits, rejoins and kicks are for users actually there
+	def __init__(self, ircmsgs, channels, users, seed):
+		self.ircmsgs = ircmsgs
+		self.random = random.Random(seed)
+		self.channels = ['#channel%d' % i for i in range(channels)]
+		# A few channels do most of the talking
+		self.weights = [1.0 / (i + 1) for i in range(channels)]
+		self.prefixes = ['user%d!~user%d@host%d.example.org' % (i, i, i % (users // 3 + 1)) for i in range(users)]
+		self.members = dict((channel, set()) for channel in self.channels)
+		self.split = []
+		self.banned = []
+
+	def nick(self, prefix):
+		return prefix.split('!', 1)[0]
+
+	def setup(self, nick):
+		"""The bot joining every channel and the users joining a few each."""
+		msgs = [self.ircmsgs.join(channel, prefix='%s!bot@example.org' % nick) for channel in self.channels]
+		for prefix in self.prefixes:
+			for channel in set(self.random.choices(self.channels, self.weights, k=self.random.randint(1, 4))):
+				self.members[channel].add(prefix)
+				msgs.append(self.ircmsgs.join(channel, prefix=prefix))
+		return msgs
+
+	def chat(self):
+		channel = self.random.choices(self.channels, self.weights)[0]
+		if not self.members[channel]:
+			return []
+		prefix = self.random.choice(tuple(self.members[channel]))
+		text = ' '.join(self.random.choice(LINE_WORDS) for _ in range(self.random.randint(1, 20)))
+		if self.random.random() < 0.05:
+			return [self.ircmsgs.action(channel, text, prefix=prefix)]
+		return [self.ircmsgs.privmsg(channel, text, prefix=prefix)]
+
+	def netsplit(self, size=200):
+		# Alternate between a server splitting off, taking a slice of the
+		# users with it, and everyone coming back
+		if self.split:
+			msgs = [self.ircmsgs.join(channel, prefix=prefix) for (prefix, channel) in self.split]
+			for (prefix, channel) in self.split:
+				self.members[channel].add(prefix)
+			self.split = []
+			return msgs
+		msgs = []
+		for prefix in self.random.sample(self.prefixes, min(size, len(self.prefixes))):
+			channels = [channel for channel in self.channels if prefix in self.members[channel]]
+			if channels:
+				msgs.append(self.ircmsgs.IrcMsg(prefix=prefix, command='QUIT', args=('*.net *.split',)))
+				for channel in channels:
+					self.members[channel].discard(prefix)
+					self.split.append((prefix, channel))
+		return msgs
+
+	def bans(self, size=20):
+		# An op banning and kicking a flood of joiners, or lifting the bans again
+		channel = self.random.choice(self.channels)
+		op = 'op!op@staff.example.org'
+		if self.banned:
+			msgs = [self.ircmsgs.IrcMsg(prefix=op, command='MODE', args=(bannedChannel, '-b', mask)) for (bannedChannel, mask) in self.banned]
+			self.banned = []
+			return msgs
+		msgs = []
+		for prefix in self.random.sample(tuple(self.members[channel]), min(size, len(self.members[channel]))):
+			mask = '*!*@' + prefix.split('@', 1)[1]
+			if self.random.random() < 0.3:
+				mask += '$##fix-your-connection'
+			self.banned.append((channel, mask))
+			self.members[channel].discard(prefix)
+			msgs.append(self.ircmsgs.IrcMsg(prefix=op, command='MODE', args=(channel, '+b', mask)))
+			msgs.append(self.ircmsgs.kick(channel, self.nick(prefix), 'Join flood', prefix=op))
+		return msgs
+
+def load_plugin(directory):
+	"""Sets Limnoria up in directory and imports the plugin from there."""
+	import supybot.conf as conf
+	for name in ('conf', 'data', 'log'):
+		getattr(conf.supybot.directories, name).setValue(os.path.join(directory, name))
+	# Registers supybot.log and starts logging into the directory above
+	import supybot.log
+	conf.supybot.log.stdout.setValue(False)
+	pluginDir = os.path.dirname(os.path.abspath(__file__))
+	sys.path.insert(0, os.path.dirname(pluginDir))
+	return importlib.import_module(os.path.basename(pluginDir) + '.plugin')
+
+def percentile(values, fraction):
+	return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def bench_traffic(args):
+	directory = tempfile.mkdtemp(prefix='LogsToDB-benchmark-')
+	# Registered before Limnoria's own exit handlers so it runs after them,
+	# they still log into the directory
+	atexit.register(shutil.rmtree, directory, True)
+	plugin = load_plugin(directory)
+	import supybot.conf as conf
+	import supybot.irclib as irclib
+	import supybot.ircmsgs as ircmsgs
+	if args.db != 'postgres':
+		# No config.json to read, the day logs go in the scratch directory
+		plugin.channellogger_model.load_config = lambda path=None: {'logs': {'folderPath': directory}}
+	if args.db == 'standin':
+		plugin.channellogger_pool.LogviewerPool = StandInPool
+	elif args.db == 'sqlite':
+		conf.supybot.plugins.LogsToDB.backend.setValue('sqlite')
+		conf.supybot.plugins.LogsToDB.backend.sqliteFile.setValue(os.path.join(directory, 'benchmark.sqlite3'))
+	conf.supybot.plugins.LogsToDB.backgroundWriter.setValue(args.writer)
+	conf.registerNetwork('benchmark')
+	irc = irclib.Irc('benchmark', callbacks=[])
+	cb = plugin.Class(irc)
+	cb.logViewerFile.logPath = directory
+	mix = dict((name, float(weight)) for (name, weight) in (part.split('=') for part in args.mix.split(',')))
+	traffic = Traffic(ircmsgs, args.channels, args.users, args.seed)
+
+	# Joins first so irc.state looks like a real network, these aren't timed
+	for msg in traffic.setup(irc.nick):
+		irc.state.addMsg(irc, msg)
+		cb(irc, msg)
+	msgs = []
+	counts = dict((name, 0) for name in mix)
+	while len(msgs) < args.events:
+		# The weights are shares of the events, netsplits and ban waves come in
+		# bursts so pick whichever is furthest behind its share
+		name = min(mix, key=lambda name: counts[name] / mix[name])
+		generated = getattr(traffic, name)()
+		counts[name] += len(generated)
+		msgs.extend(generated)
+
+	# Irc.feedMsg updates the state before any callback sees the message, so
+	# the plugin's handlers are timed after irc.state has been updated
+	latencies = dict()
+	allocations = []
+	with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+		start = time.perf_counter()
+		for (i, msg) in enumerate(msgs):
+			irc.state.addMsg(irc, msg)
+			traced = i >= len(msgs) - args.alloc_events
+			if traced:
+				if not tracemalloc.is_tracing():
+					tracemalloc.start()
+					elapsed = time.perf_counter() - start
+				tracemalloc.reset_peak()
+				before = tracemalloc.get_traced_memory()[0]
+			began = time.perf_counter_ns()
+			cb(irc, msg)
+			took = time.perf_counter_ns() - began
+			if traced:
+				(current, peak) = tracemalloc.get_traced_memory()
+				allocations.append((peak - before, current - before))
+			else:
+				latencies.setdefault(msg.command, []).append(took)
+		if not tracemalloc.is_tracing():
+			elapsed = time.perf_counter() - start
+		tracemalloc.stop()
+		# Time how long the background writer takes to catch up
+		drainStart = time.perf_counter()
+		cb.logViewerFile.flush()
+		cb.dbWriter.close()
+		drained = time.perf_counter() - drainStart
+	cb.dbWriter = cb.logViewerDB
+
+	timed = sum(len(values) for values in latencies.values())
+	print('%s events over %s channels and %s users: %s' % (len(msgs), args.channels, args.users, ', '.join('%s %s' % (counts[name], name) for name in mix)))
+	print('%-10s %10.0f msgs/sec over %s events' % ('handlers', timed / elapsed, timed))
+	everything = sorted(sum(latencies.values(), []))
+	for (name, values) in [('all', everything)] + sorted(latencies.items()):
+		values.sort()
+		print('%-10s p50 %8.1fus  p99 %8.1fus  max %8.1fus  (%s)' % (name, percentile(values, 0.5) / 1000.0, percentile(values, 0.99) / 1000.0, values[-1] / 1000.0, len(values)))
+	if args.writer:
+		print('%-10s caught up %.2f seconds after the last event, %s dropped' % ('writer', drained, cb.dbWriter.dropped if hasattr(cb.dbWriter, 'dropped') else 0))
+	if args.db == 'standin':
+		conn = cb.logViewerDB.pool.conn
+		print('%-10s %s statements in %s transactions, %s bytes through COPY' % ('database', conn.statements, conn.commits, conn.copied))
+	if allocations:
+		print('%-10s %.0f bytes allocated at peak, %.0f kept, per event over the last %s events' % ('memory', sum(a[0] for a in allocations) / float(len(allocations)), sum(a[1] for a in allocations) / float(len(allocations)), len(allocations)))
+	cb.die()
+
+def bench_writers(args):
+	random.seed(args.seed)
+	channels = ['#channel%s' % i for i in range(args.channels)]
+	nicks = ['user%s' % i for i in range(args.users)]
+	events = []
+	for i in range(args.events):
+		nick = random.choice(nicks)
+		text = ' '.join(random.choice(LINE_WORDS) for _ in range(random.randint(1, 12)))
+		events.append(('message', (nick, '%s!%s@example.org' % (nick, nick), text, 'message', random.choice(channels))))
+	print('%s messages over %s channels and %s users' % (len(events), args.channels, args.users))
+	first = None
+	for shards in [int(shards) for shards in args.shards.split(',')]:
+		if args.db == 'sqlite':
+			# Every writer on the same file, they take turns at its write lock
+			directory = tempfile.mkdtemp(prefix='LogsToDB-benchmark-')
+			atexit.register(shutil.rmtree, directory, True)
+			dbs = [channellogger_sqlite.SQLiteDB(os.path.join(directory, 'benchmark.sqlite3'), timeout=60) for shard in range(shards)]
+		else:
+			if args.db == 'standin':
+				pool = StandInPool(latency=args.latency / 1000.0, slots=args.slots)
+			else:
+				pool = channellogger_pool.LogviewerPool(channellogger_model.load_config(), writeConnections=shards)
+			dbs = [channellogger_model.LogviewerDB(pool) for shard in range(shards)]
+		writer = channellogger_writer.ShardedWriter([channellogger_writer.LogviewerWriter(db, queueSize=len(events) + 1, batchSize=args.batch_size, batchDelay=0.05) for db in dbs])
+		# Every writer has its own ID caches, fill them first so what's timed is
+		# a running bot rather than one that has just started
+		warm = [('message', time.time(), (nick, '%s!%s@example.org' % (nick, nick), '', 'join', channels[0])) for nick in nicks]
+		for shard in writer.writers:
+			if args.db == 'standin':
+				(latency, pool.conn.latency) = (pool.conn.latency, 0)
+				shard.db.write_batch(warm)
+				pool.conn.latency = latency
+			else:
+				shard.db.write_batch(warm)
+		# Ordering per channel caps the speedup at the busiest writer's share
+		shares = collections.Counter(writer.writer(eventArgs[-1]) for (kind, eventArgs) in events)
+		start = time.perf_counter()
+		for (kind, eventArgs) in events:
+			writer.write_event(kind, eventArgs)
+		writer.close(timeout=3600)
+		rate = len(events) / (time.perf_counter() - start)
+		first = first or rate
+		print('%3s writers %10.0f events/sec  %5.2fx  busiest writer had %.0f%%' % (shards, rate, rate / first, 100.0 * max(shares.values()) / len(events)))
+
+def main():
+	parser = argparse.ArgumentParser(description='LogsToDB benchmarks')
+	commands = parser.add_subparsers(dest='command')
+	commands.required = True
+	copy = commands.add_parser('copy', help='messages rows/sec through INSERT and COPY')
+	copy.add_argument('--rows', type=int, default=20000)
+	copy.add_argument('--repeat', type=int, default=3)
+	copy.set_defaults(run=bench_copy)
+	traffic = commands.add_parser('traffic', help='generated IRC traffic through the whole plugin')
+	traffic.add_argument('--events', type=int, default=50000)
+	traffic.add_argument('--channels', type=int, default=30)
+	traffic.add_argument('--users', type=int, default=3000)
+	traffic.add_argument('--mix', default='chat=90,netsplit=5,bans=5', help='relative weights of chat, netsplit and bans')
+	traffic.add_argument('--seed', type=int, default=1)
+	traffic.add_argument('--db', choices=('standin', 'postgres', 'sqlite'), default='standin', help='stand-in database, the one in config.json or a scratch SQLite file')
+	traffic.add_argument('--no-writer', dest='writer', action='store_false', help='write to the database in the handlers, without the background writer')
+	traffic.add_argument('--alloc-events', type=int, default=2000, help='events at the end traced with tracemalloc, not counted in the timings')
+	traffic.set_defaults(run=bench_traffic)
+	writers = commands.add_parser('writers', help='messages/sec through ShardedWriter by number of writers')
+	writers.add_argument('--events', type=int, default=50000)
+	writers.add_argument('--channels', type=int, default=100)
+	writers.add_argument('--users', type=int, default=3000)
+	writers.add_argument('--shards', default='1,2,4,8,16', help='writer counts to try')
+	writers.add_argument('--batch-size', type=int, default=500)
+	writers.add_argument('--seed', type=int, default=1)
+	writers.add_argument('--db', choices=('standin', 'postgres', 'sqlite'), default='standin', help='stand-in database, the one in config.json or a scratch SQLite file')
+	writers.add_argument('--latency', type=float, default=2, help='ms each stand-in statement takes')
+	writers.add_argument('--slots', type=int, default=4, help='stand-in statements that can run at once')
+	writers.set_defaults(run=bench_writers)
+	args = parser.parse_args()
+	args.run(args)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,307 @@
+#!/usr/bin/python
+# Move old messages out of the database into compressed archive files, run
+# from the bot's directory:
+#
+#   python plugins/LogsToDB/channelLogger_archive.py --months 12
+#
+# The plugin runs the same job daily when supybot.plugins.LogsToDB.archive is
+# on.  Each channel gets a file a month, <directory>/<channel id>/YYYY-MM,
+# made of blocks of rows compressed with zlib or lzma and only ever appended
+# to, and YYYY-MM.idx listing where each block is and the times and IDs it
+# covers.  LogviewerDB.iter_messages reads them together with what is still
+# in the database.  Rows are deleted once their blocks and index entries are
+# on disk, and a month's partition is dropped once it's empty.  If the job
+# dies in between, running it again skips rows already in a block and
+# readers drop the duplicates, so nothing is lost or shown twice.
+import argparse
+import array
+import bisect
+import datetime
+import heapq
+import lzma
+import os
+import struct
+import time
+import zlib
+
+try:
+	from . import channelLogger_pool as channellogger_pool
+	from . import channelLogger_schema as channellogger_schema
+except ImportError:
+	import channelLogger_pool as channellogger_pool
+	import channelLogger_schema as channellogger_schema
+
+# A row is its id, time (microseconds since 1970 in the bot's local time, like
+# the naive timestamps in the database) and user id (-1 for none), then nick,
+# action and content, each as a length (-1 for NULL) and UTF-8
+ROW = struct.Struct('<qqq')
+LENGTH = struct.Struct('<i')
+# A block's first and last time and ID, offset and length in the archive,
+# row count and compression method
+BLOCK = struct.Struct('<qqqqQIIB')
+METHODS = {'zlib': 1, 'lzma': 2}
+DECOMPRESS = {1: zlib.decompress, 2: lzma.decompress}
+COMPRESS = {1: lambda data: zlib.compress(data, 9), 2: lzma.compress}
+BLOCK_ROWS = 4096
+# IDs deleted a statement once they're archived
+DELETE_IDS = 10000
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def to_micros(timestamp):
+	delta = timestamp - EPOCH
+	return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def from_micros(micros):
+	return EPOCH + datetime.timedelta(microseconds=micros)
+
+def archive_path(directory, channel_id, month):
+	return os.path.join(directory, str(channel_id), month.strftime('%Y-%m'))
+
+def encode_text(value):
+	if value is None:
+		return LENGTH.pack(-1)
+	data = value.encode('utf-8')
+	return LENGTH.pack(len(data)) + data
+
+def decode_text(data, offset):
+	(length,) = LENGTH.unpack_from(data, offset)
+	offset += LENGTH.size
+	if length < 0:
+		return (None, offset)
+	return (data[offset:offset + length].decode('utf-8'), offset + length)
+
+def read_index(path):
+	"""The blocks of an archive as BLOCK tuples, [] if there is no archive."""
+	try:
+		with open(path + '.idx', 'rb') as index:
+			data = index.read()
+	except FileNotFoundError:
+		return []
+	return [BLOCK.unpack_from(data, offset) for offset in range(0, len(data) - len(data) % BLOCK.size, BLOCK.size)]
+
+def read_block(archive, block):
+	"""The rows of a block as (id, timestamp, user id, nick, action, content)."""
+	(first, last, firstId, lastId, offset, length, count, method) = block
+	archive.seek(offset)
+	data = DECOMPRESS[method](archive.read(length))
+	rows = []
+	position = 0
+	for i in range(count):
+		(id, micros, user) = ROW.unpack_from(data, position)
+		position += ROW.size
+		(nick, position) = decode_text(data, position)
+		(action, position) = decode_text(data, position)
+		(content, position) = decode_text(data, position)
+		if action == 'message' and content and content.startswith('\x01ACTION '):
+			# Archived before migration 7 turned these into emotes
+			(action, content) = ('emote', content[8:].rstrip('\x01'))
+		rows.append((id, from_micros(micros), None if user < 0 else user, nick, action, content))
+	return rows
+
+def read_archive(path, since=None, until=None):
+	"""Yields the rows archived in path from since until until, sorted by time
+	and ID.  Only the blocks covering that time are read, each when the rows
+	reach its first time, so memory use is a block or so however long the
+	range is (blocks from different runs of the job can overlap in time)."""
+	since = to_micros(since) if since is not None else None
+	until = to_micros(until) if until is not None else None
+	blocks = sorted(block for block in read_index(path) if (since is None or block[1] >= since) and (until is None or block[0] < until))
+	if not blocks:
+		return
+	heap = []
+	with open(path, 'rb') as archive:
+		i = 0
+		while i < len(blocks) or heap:
+			while i < len(blocks) and (not heap or blocks[i][0] <= heap[0][0]):
+				for row in read_block(archive, blocks[i]):
+					micros = to_micros(row[1])
+					if (since is None or micros >= since) and (until is None or micros < until):
+						heapq.heappush(heap, (micros, row[0], row))
+				i += 1
+			if heap:
+				yield heapq.heappop(heap)[2]
+
+class ArchiveWriter:
+	# Appends blocks to one channel's month, the index entries are only
+	# written (and synced) by finish() so a block is never listed before it is
+	# on disk.
+
+	def __init__(self, path, method='zlib'):
+		self.path = path
+		self.method = METHODS[method]
+		directory = os.path.dirname(path)
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+		self.archive = open(path, 'ab')
+		self.blocks = []
+		self.rows = []
+		self.written = 0
+
+	def add(self, row):
+		self.rows.append(row)
+		if len(self.rows) >= BLOCK_ROWS:
+			self.write_block()
+
+	def write_block(self):
+		if not self.rows:
+			return
+		data = bytearray()
+		for (id, timestamp, user, nick, action, content) in self.rows:
+			data += ROW.pack(id, to_micros(timestamp), -1 if user is None else user)
+			data += encode_text(nick)
+			data += encode_text(action)
+			data += encode_text(content)
+		compressed = COMPRESS[self.method](bytes(data))
+		offset = self.archive.seek(0, os.SEEK_END)
+		self.archive.write(compressed)
+		times = [to_micros(row[1]) for row in self.rows]
+		self.blocks.append(BLOCK.pack(min(times), max(times), self.rows[0][0], self.rows[-1][0], offset, len(compressed), len(self.rows), self.method))
+		self.written += len(self.rows)
+		self.rows = []
+
+	def finish(self):
+		self.write_block()
+		self.archive.flush()
+		os.fsync(self.archive.fileno())
+		self.archive.close()
+		if self.blocks:
+			with open(self.path + '.idx', 'ab') as index:
+				index.write(b''.join(self.blocks))
+				index.flush()
+				os.fsync(index.fileno())
+		return self.written
+
+class ArchivedIds:
+	# Which IDs the blocks already in an archive hold.  An ID inside a block's
+	# range isn't necessarily in it, the row may have been committed after the
+	# run that wrote the block took its snapshot (a parallel import, a late
+	# spool replay), so the blocks whose ranges an ID falls in are decoded,
+	# each once, to check.  Blocks from different runs can overlap.
+
+	def __init__(self, path):
+		self.path = path
+		self.blocks = sorted(read_index(path), key=lambda block: (block[2], block[3]))
+		self.firsts = [block[2] for block in self.blocks]
+		# The highest last ID of the blocks up to each one, so a lookup can
+		# stop going back once no earlier block could hold the ID
+		self.reach = []
+		for block in self.blocks:
+			self.reach.append(max(block[3], self.reach[-1]) if self.reach else block[3])
+		self.ids = {}
+		self.archive = None
+
+	def __contains__(self, id):
+		i = bisect.bisect_right(self.firsts, id) - 1
+		while i >= 0 and self.reach[i] >= id:
+			if self.blocks[i][3] >= id and id in self.block_ids(i):
+				return True
+			i -= 1
+		return False
+
+	def block_ids(self, i):
+		ids = self.ids.get(i)
+		if ids is None:
+			if self.archive is None:
+				self.archive = open(self.path, 'rb')
+			ids = self.ids[i] = set(row[0] for row in read_block(self.archive, self.blocks[i]))
+		return ids
+
+	def close(self):
+		if self.archive is not None:
+			self.archive.close()
+			self.archive = None
+
+def find_months(pool, horizon):
+	"""(channel_id, month) for every channel with messages before horizon."""
+	with pool.connection('read') as conn:
+		cursor = conn.cursor()
+		cursor.execute("SELECT channel_id, date_trunc('month', \"timestamp\")::date FROM messages WHERE \"timestamp\" < %s GROUP BY 1, 2 ORDER BY 2, 1", (horizon,))
+		return cursor.fetchall()
+
+def archive_month(pool, directory, channel_id, month, horizon, method='zlib'):
+	"""Moves a channel's messages for a month (up to horizon) to its archive.
+	Returns how many rows were archived."""
+	path = archive_path(directory, channel_id, month)
+	archived = ArchivedIds(path)
+	end = min(channellogger_schema.next_month(month), horizon)
+	writer = ArchiveWriter(path, method)
+	# The IDs this run wrote and those it found already in blocks, the only
+	# rows it may delete
+	done = array.array('q')
+	with pool.connection() as conn:
+		# The DELETE has to see just the rows the SELECT did, not ones another
+		# transaction commits in between with a lower ID than the last
+		conn.cursor().execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+		# A named cursor streams the rows instead of loading the whole month
+		cursor = conn.cursor('archive_%s_%s' % (channel_id, month.strftime('%Y%m')))
+		cursor.itersize = 10000
+		cursor.execute("SELECT m.id, m.\"timestamp\", m.\"user\", n.nick, m.action, m.content FROM messages m LEFT JOIN identities i ON i.id = m.\"user\" LEFT JOIN nicks n ON n.id = i.nick_id WHERE m.channel_id = %s AND m.\"timestamp\" >= %s AND m.\"timestamp\" < %s ORDER BY m.id", (channel_id, month, end))
+		try:
+			for row in cursor:
+				if row[0] not in archived:
+					writer.add(row)
+				done.append(row[0])
+		finally:
+			cursor.close()
+			archived.close()
+			written = writer.finish()
+		# Safe to delete now the archive is synced
+		cursor = conn.cursor()
+		for i in range(0, len(done), DELETE_IDS):
+			cursor.execute("DELETE FROM messages WHERE channel_id = %s AND \"timestamp\" >= %s AND \"timestamp\" < %s AND id = ANY(%s)", (channel_id, month, end, done[i:i + DELETE_IDS].tolist()))
+		conn.commit()
+	return written
+
+def drop_empty_partitions(pool, horizon):
+	"""Drops the monthly messages partitions wholly before horizon that the
+	archive has emptied, returns their names."""
+	dropped = []
+	with pool.connection() as conn:
+		cursor = conn.cursor()
+		cursor.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = 'messages'::regclass AND c.relname ~ '^messages_[0-9]{4}_[0-9]{2}$' ORDER BY 1")
+		for (name,) in cursor.fetchall():
+			month = datetime.date(int(name[9:13]), int(name[14:16]), 1)
+			if channellogger_schema.next_month(month) > horizon:
+				continue
+			cursor.execute("SELECT EXISTS (SELECT 1 FROM %s)" % name)
+			if cursor.fetchone()[0]:
+				continue
+			cursor.execute("ALTER TABLE messages DETACH PARTITION %s" % name)
+			cursor.execute("DROP TABLE %s" % name)
+			dropped.append(name)
+		conn.commit()
+	return dropped
+
+def archive_messages(pool, directory, months, method='zlib', log=None):
+	"""Archives every message from before the start of the month months ago.
+	Returns (rows archived, partitions dropped)."""
+	horizon = channellogger_schema.month_start(datetime.date.today())
+	for i in range(months):
+		horizon = channellogger_schema.month_start(horizon - datetime.timedelta(days=1))
+	archived = 0
+	for (channel_id, month) in find_months(pool, horizon):
+		rows = archive_month(pool, directory, channel_id, month, horizon, method)
+		if log is not None:
+			log('Archived %s messages from channel %s for %s' % (rows, channel_id, month.strftime('%Y-%m')))
+		archived += rows
+	return (archived, drop_empty_partitions(pool, horizon))
+
+def main():
+	try:
+		from . import channelLogger_model as channellogger_model
+	except ImportError:
+		import channelLogger_model as channellogger_model
+	parser = argparse.ArgumentParser(description='Move old LogsToDB messages into archive files')
+	parser.add_argument('--months', type=int, default=12, help='whole months of messages to keep in the database, besides this one')
+	parser.add_argument('--directory', default='data/LogsToDB-archive', help='where the archive files go')
+	parser.add_argument('--method', choices=sorted(METHODS), default='zlib')
+	options = parser.parse_args()
+
+	pool = channellogger_pool.LogviewerPool(channellogger_model.load_config(), writeConnections=1, readConnections=1)
+	began = time.time()
+	(archived, dropped) = archive_messages(pool, options.directory, options.months, options.method, log=print)
+	pool.close()
+	print('Archived %s messages in %.0f seconds, dropped partitions: %s' % (archived, time.time() - began, ', '.join(dropped) or 'none'))
+
+if __name__ == '__main__':
+	main()
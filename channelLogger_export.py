@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# Export a channel's history as JSON lines or CSV, run from the bot's
+# directory:
+#
+#   python plugins/LogsToDB/channelLogger_export.py '#channel' --since 2020-01-01 --gzip
+#   python plugins/LogsToDB/channelLogger_export.py '#channel' --nick someone --format csv --output -
+#
+# The plugin's export command does the same.  Rows come from
+# LogviewerDB.iter_messages, a server-side cursor over the database merged
+# with anything archived, and are written out one at a time, so memory use
+# stays the same however much history there is.
+import argparse
+import csv
+import datetime
+import gzip
+import json
+import os
+import re
+import sys
+import time
+
+try:
+	from . import channelLogger_model as channellogger_model
+	from . import channelLogger_sqlite as channellogger_sqlite
+except ImportError:
+	import channelLogger_model as channellogger_model
+	import channelLogger_sqlite as channellogger_sqlite
+
+FORMATS = ('jsonl', 'csv')
+FIELDS = ('id', 'timestamp', 'channel', 'nick', 'action', 'content')
+
+def export_filename(channel, format='jsonl', compress=False):
+	"""A file name for an export of channel started now."""
+	name = '%s-%s.%s' % (re.sub(r'[^\w#.-]', '_', channel), time.strftime('%Y%m%d-%H%M%S'), format)
+	return name + '.gz' if compress else name
+
+def open_output(path, compress=False):
+	if compress:
+		return gzip.open(path, 'wt', compresslevel=6, encoding='utf-8', newline='')
+	return open(path, 'w', encoding='utf-8', newline='')
+
+def write_messages(out, rows, channel, format='jsonl'):
+	"""Writes rows from LogviewerDB.iter_messages to out, returns how many."""
+	if format == 'csv':
+		writer = csv.writer(out)
+		writer.writerow(FIELDS)
+		write = writer.writerow
+	else:
+		write = lambda row: out.write(json.dumps(dict(zip(FIELDS, row)), ensure_ascii=False) + '\n')
+	count = 0
+	for (id, timestamp, user, nick, action, content) in rows:
+		write((id, timestamp.isoformat(' '), channel, nick, action, content))
+		count += 1
+	return count
+
+def export_messages(db, path, channel, format='jsonl', compress=False, nick=None, action=None, since=None, until=None, itersize=2000):
+	"""Exports channel's messages matching the filters to path and returns how
+	many there were.  They're written to path.part and renamed when done, so
+	an export that failed halfway is never taken for a whole one."""
+	rows = db.iter_messages(channel, since, until, nick=nick, action=action, itersize=itersize)
+	try:
+		with open_output(path + '.part', compress) as out:
+			count = write_messages(out, rows, channel, format)
+	except BaseException:
+		if os.path.exists(path + '.part'):
+			os.remove(path + '.part')
+		raise
+	finally:
+		rows.close()
+	os.replace(path + '.part', path)
+	return count
+
+def parse_date(value):
+	for format in ('%Y-%m-%d %H:%M', '%Y-%m-%d'):
+		try:
+			return datetime.datetime.strptime(value, format)
+		except ValueError:
+			pass
+	raise argparse.ArgumentTypeError('%r is not YYYY-MM-DD or "YYYY-MM-DD HH:MM"' % value)
+
+def main():
+	parser = argparse.ArgumentParser(description="Export a channel's LogsToDB history")
+	parser.add_argument('channel')
+	parser.add_argument('--nick', help='only messages by this nick')
+	parser.add_argument('--action', help='only this action, e.g. message, emote or join')
+	parser.add_argument('--since', type=parse_date, help='first time (YYYY-MM-DD or "YYYY-MM-DD HH:MM")')
+	parser.add_argument('--until', type=parse_date, help='time to stop before')
+	parser.add_argument('--format', choices=FORMATS, default='jsonl')
+	parser.add_argument('--gzip', action='store_true', help='compress the output')
+	parser.add_argument('--output', help='file to write, - for stdout, a name from the channel and time by default')
+	parser.add_argument('--directory', default='data/LogsToDB-archive', help='where archived messages are')
+	parser.add_argument('--sqlite', help='export from this SQLite database rather than Postgres')
+	parser.add_argument('--itersize', type=int, default=2000, help='rows fetched from the server at a time')
+	options = parser.parse_args()
+
+	if options.sqlite:
+		db = channellogger_sqlite.SQLiteDB(options.sqlite)
+	else:
+		db = channellogger_model.LogviewerDB(archiveDir=options.directory)
+	began = time.time()
+	if options.output == '-':
+		rows = db.iter_messages(options.channel, options.since, options.until, nick=options.nick, action=options.action, itersize=options.itersize)
+		out = gzip.open(sys.stdout.buffer, 'wt', encoding='utf-8', newline='') if options.gzip else sys.stdout
+		try:
+			count = write_messages(out, rows, options.channel, options.format)
+		finally:
+			rows.close()
+			out.flush()
+			if options.gzip:
+				out.close()
+		path = 'stdout'
+	else:
+		path = options.output or export_filename(options.channel, options.format, options.gzip)
+		count = export_messages(db, path, options.channel, options.format, options.gzip, options.nick, options.action, options.since, options.until, options.itersize)
+	db.close()
+	print('Exported %s messages to %s in %.0f seconds' % (count, path, time.time() - began), file=sys.stderr)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,170 @@
+#!/usr/bin/python
+import bisect
+import functools
+import os
+import re
+import threading
+import time
+
+import psycopg2.extensions
+
+# Upper bounds in seconds, from a fast handler to a stalled commit
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# The statement and table a query is counted under, e.g. "insert users"
+STATEMENT = re.compile(r'^\s*(INSERT INTO|UPDATE|DELETE FROM|COPY|SELECT|WITH|SAVEPOINT|RELEASE SAVEPOINT|ROLLBACK TO SAVEPOINT|SET LOCAL|SET)\s+"?(\w*)', re.I)
+
+class Histogram:
+
+	def __init__(self):
+		self.counts = [0] * (len(BUCKETS) + 1)
+		self.count = 0
+		self.sum = 0.0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+		self.count += 1
+		self.sum += value
+
+	def quantile(self, q):
+		"""The upper bound of the bucket holding the q quantile."""
+		if not self.count:
+			return 0
+		seen = 0
+		for (bound, count) in zip(BUCKETS, self.counts):
+			seen += count
+			if seen >= q * self.count:
+				return bound
+		return float('inf')
+
+class LogviewerMetrics:
+	# Timing histograms for the plugin, the model and the database, plus
+	# gauges and counters read from elsewhere when exported.  Nothing is timed
+	# unless it's been wrapped with instrument() or goes over a connection made
+	# with connection_factory(), so when metrics are turned off nothing here is
+	# ever called.
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		# (name, label) -> Histogram
+		self.histograms = {}
+		# name -> (type, help, function returning the current value), type is
+		# gauge or counter
+		self.gauges = {}
+		# query -> the label its timings go under
+		self.statements = {}
+
+	def observe(self, name, label, seconds):
+		with self.lock:
+			histogram = self.histograms.get((name, label))
+			if histogram is None:
+				histogram = self.histograms[(name, label)] = Histogram()
+			histogram.observe(seconds)
+
+	def gauge(self, name, function, help='', type='gauge'):
+		self.gauges[name] = (type, help, function)
+
+	def timed(self, name, label, function):
+		observe = self.observe
+		clock = time.perf_counter
+		@functools.wraps(function)
+		def timed(*args, **kwargs):
+			start = clock()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				observe(name, label, clock() - start)
+		return timed
+
+	def instrument(self, obj, name, methods):
+		"""Replaces each of obj's methods with a timed one, as an attribute of
+		obj itself so other instances and the class are left alone."""
+		for method in methods:
+			setattr(obj, method, self.timed(name, method, getattr(obj, method)))
+
+	def statement(self, query):
+		if isinstance(query, bytes):
+			query = query[:80].decode('utf-8', 'replace')
+		label = self.statements.get(query)
+		if label is None:
+			match = STATEMENT.match(query)
+			if match:
+				label = ('%s %s' % (match.group(1).split()[0], match.group(2))).strip().lower()
+			else:
+				label = 'other'
+			if len(self.statements) < 1000:
+				self.statements[query] = label
+		return label
+
+	def connection_factory(self):
+		"""A psycopg2 connection class timing every query and commit."""
+		metrics = self
+
+		class TimedCursor(psycopg2.extensions.cursor):
+			def execute(self, query, vars=None):
+				start = time.perf_counter()
+				try:
+					return super().execute(query, vars)
+				finally:
+					metrics.observe('db_query', metrics.statement(query), time.perf_counter() - start)
+
+			def copy_expert(self, sql, file, size=8192):
+				start = time.perf_counter()
+				try:
+					return super().copy_expert(sql, file, size)
+				finally:
+					metrics.observe('db_query', metrics.statement(sql), time.perf_counter() - start)
+
+		class TimedConnection(psycopg2.extensions.connection):
+			def __init__(self, *args, **kwargs):
+				super().__init__(*args, **kwargs)
+				self.cursor_factory = TimedCursor
+
+			def commit(self):
+				start = time.perf_counter()
+				try:
+					return super().commit()
+				finally:
+					metrics.observe('db_query', 'commit', time.perf_counter() - start)
+
+		return TimedConnection
+
+	def snapshot(self):
+		with self.lock:
+			histograms = dict((key, (h.count, h.sum, h.quantile(0.5), h.quantile(0.99), list(h.counts))) for (key, h) in self.histograms.items())
+		gauges = {}
+		for (name, (type, help, function)) in self.gauges.items():
+			try:
+				gauges[name] = function()
+			except Exception:
+				pass
+		return (histograms, gauges)
+
+	def prometheus(self):
+		"""Everything in the Prometheus text exposition format."""
+		(histograms, gauges) = self.snapshot()
+		lines = []
+		for name in sorted(set(name for (name, label) in histograms)):
+			lines.append('# TYPE logstodb_%s_seconds histogram' % name)
+			for ((histogramName, label), (count, total, p50, p99, counts)) in sorted(histograms.items()):
+				if histogramName != name:
+					continue
+				cumulative = 0
+				for (bound, bucketCount) in zip(BUCKETS + ('+Inf',), counts):
+					cumulative += bucketCount
+					lines.append('logstodb_%s_seconds_bucket{name="%s",le="%s"} %s' % (name, label, bound, cumulative))
+				lines.append('logstodb_%s_seconds_sum{name="%s"} %r' % (name, label, total))
+				lines.append('logstodb_%s_seconds_count{name="%s"} %s' % (name, label, count))
+		for (name, value) in sorted(gauges.items()):
+			(type, help, function) = self.gauges[name]
+			if help:
+				lines.append('# HELP logstodb_%s %s' % (name, help))
+			lines.append('# TYPE logstodb_%s %s' % (name, type))
+			lines.append('logstodb_%s %s' % (name, value))
+		return '\n'.join(lines) + '\n'
+
+	def write_textfile(self, path):
+		# Written aside and renamed so a scrape never sees half a file
+		with open(path + '.tmp', 'w') as textfile:
+			textfile.write(self.prometheus())
+		os.replace(path + '.tmp', path)
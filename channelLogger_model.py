@@ -4,234 +4,1237 @@ import json
 import os
 import string
 import time
+import datetime
 import psycopg2
+import psycopg2.extras
 import logging
 import logging.handlers
 import re
+import abc
+import collections
+import gzip
+import lzma
+import mmap
+import struct
+import bisect
+import threading
+import array
+import heapq
+import contextlib
+from io import StringIO
 
-class LogviewerDB:
+try:
+	from . import channelLogger_pool as channellogger_pool
+	from . import channelLogger_archive as channellogger_archive
+except ImportError:
+	import channelLogger_pool as channellogger_pool
+	import channelLogger_archive as channellogger_archive
+
+CONFIG_PATH = 'plugins/LogsToDB/config.json'
+
+def load_config(path=CONFIG_PATH):
+	try:
+		with open(path) as data:
+			return json.load(data)
+	except IOError as e:
+		print(os.getcwd())
+		logging.error("Error! No config file supplied, please create a config.json file in the root")
+		sys.exit("Error! No config file supplied, please create a config.json file in the root")
+
+# COPY's text format treats these specially
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+def copy_value(value):
+	if value is None:
+		return '\\N'
+	return str(value).translate(COPY_ESCAPES)
+
+# Logs come in whatever encoding the client used, try the likely ones in turn
+def decode(data):
+	try:
+		return data.decode('utf-8')
+	except UnicodeDecodeError:
+		try:
+			return data.decode('iso-8859-1')
+		except UnicodeDecodeError:
+			return data.decode('cp1252')
+
+# The first time after now that time.strftime(format) gives something else,
+# or None if it never will (the format has no time in it).  A name can only
+# change on a second, minute, hour or day boundary, so those are tried in
+# turn, days for up to a year ahead.
+def next_rollover(format, now):
+	current = time.strftime(format, time.localtime(now))
+	t = time.localtime(now)
+	candidates = [
+		int(now) + 1,
+		time.mktime((t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min + 1, 0, 0, 0, -1)),
+		time.mktime((t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour + 1, 0, 0, 0, 0, -1)),
+	]
+	candidates.extend(time.mktime((t.tm_year, t.tm_mon, t.tm_mday + day, 0, 0, 0, 0, 0, -1)) for day in range(1, 367))
+	for candidate in candidates:
+		if time.strftime(format, time.localtime(candidate)) != current:
+			return candidate
+	return None
+
+# method -> (suffix, compress, decompress)
+COMPRESSORS = {'gzip': ('.gz', gzip.compress, gzip.decompress), 'xz': ('.xz', lzma.compress, lzma.decompress)}
+
+# A log's index is a record for each minute something was logged in: the
+# minute (seconds since the epoch // 60), the offset its first line starts at
+# and how many lines come before it.  Compressed logs also have a block index,
+# the offset in the compressed file of each BLOCK_SIZE of the original.
+INDEX_SUFFIX = '.idx'
+INDEX_RECORD = struct.Struct('<qQQ')
+BLOCKS_SUFFIX = '.blocks'
+BLOCK_RECORD = struct.Struct('<Q')
+BLOCK_SIZE = 1024 * 1024
+
+# Compress a finished log next to itself and remove the original, the
+# compressed copy is written aside first so a crash never loses the log.
+# Each block is its own gzip member or xz stream, so the file still reads as
+# one to zcat and friends but log_range only has to decompress the blocks it
+# needs.
+def compress_file(path, method):
+	(suffix, compress, decompress) = COMPRESSORS[method]
+	offset = 0
+	with open(path, 'rb') as original, open(path + suffix + '.tmp', 'wb') as compressed, open(path + suffix + BLOCKS_SUFFIX + '.tmp', 'wb') as blocks:
+		while True:
+			block = original.read(BLOCK_SIZE)
+			if not block:
+				break
+			blocks.write(BLOCK_RECORD.pack(offset))
+			offset += compressed.write(compress(block))
+	os.replace(path + suffix + BLOCKS_SUFFIX + '.tmp', path + suffix + BLOCKS_SUFFIX)
+	os.replace(path + suffix + '.tmp', path + suffix)
+	os.remove(path)
+	return path + suffix
+
+def count_lines(logFile, start=0):
+	logFile.seek(start)
+	lines = 0
+	for block in iter(lambda: logFile.read(BLOCK_SIZE), b''):
+		lines += block.count(b'\n')
+	return lines
+
+class IndexedLog:
+	# A log file opened for appending that keeps its index up to date, use it
+	# like the file itself.  Finding where a minute starts takes a tell(), which
+	# flushes, so that only happens for the first line of each minute.
+
+	def __init__(self, path):
+		self.name = path
+		self.logFile = open(path, 'a')
+		self.index = open(path + INDEX_SUFFIX, 'a+b')
+		self.minute = None
+		self.lines = 0
+		# Carry on from the last record, or count the lines of a log from
+		# before it had an index
+		size = self.index.seek(0, os.SEEK_END)
+		start = 0
+		with open(path, 'rb') as logFile:
+			end = logFile.seek(0, os.SEEK_END)
+			if size >= INDEX_RECORD.size:
+				self.index.seek(size - size % INDEX_RECORD.size - INDEX_RECORD.size)
+				(minute, offset, lines) = INDEX_RECORD.unpack(self.index.read(INDEX_RECORD.size))
+				if offset <= end:
+					(self.minute, start, self.lines) = (minute, offset, lines)
+			if self.minute is None:
+				self.index.truncate(0)
+			elif size % INDEX_RECORD.size:
+				# Drop a record torn by a crash, the next one would be written
+				# after it and every lookup from then on misaligned
+				self.index.truncate(size - size % INDEX_RECORD.size)
+			self.lines += count_lines(logFile, start)
+
+	@property
+	def closed(self):
+		return self.logFile.closed
+
+	def write(self, s):
+		minute = int(time.time()) // 60
+		if self.minute is None or minute > self.minute:
+			self.minute = minute
+			self.index.write(INDEX_RECORD.pack(minute, self.logFile.tell(), self.lines))
+		self.lines += s.count('\n')
+		return self.logFile.write(s)
+
+	def flush(self):
+		self.logFile.flush()
+		self.index.flush()
+
+	def close(self):
+		self.logFile.close()
+		self.index.close()
+
+class IndexMinutes:
+	# The minutes of an index's records as a sequence, for bisect
+	def __init__(self, data):
+		self.data = data
+
+	def __len__(self):
+		return len(self.data) // INDEX_RECORD.size
+
+	def __getitem__(self, i):
+		return INDEX_RECORD.unpack_from(self.data, i * INDEX_RECORD.size)[0]
+
+def find_offsets(indexPath, since, until):
+	"""The offsets in the log where since starts and until does, None for the
+	end of the log, and the number of lines before since."""
+	with open(indexPath, 'rb') as index:
+		if not os.fstat(index.fileno()).st_size:
+			return (None, None, 0)
+		with mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ) as data:
+			minutes = IndexMinutes(data)
+			first = bisect.bisect_left(minutes, int(since) // 60)
+			last = bisect.bisect_left(minutes, -(-int(until) // 60))
+			if first == len(minutes):
+				return (None, None, 0)
+			(minute, start, lines) = INDEX_RECORD.unpack_from(data, first * INDEX_RECORD.size)
+			end = None
+			if last < len(minutes):
+				end = INDEX_RECORD.unpack_from(data, last * INDEX_RECORD.size)[1]
+			return (start, end, lines)
+
+def log_range(path, since, until):
+	"""Returns the lines logged to path from since until until (seconds since
+	the epoch or datetimes, to the minute) and the line number of the first,
+	as (line, bytes).  Only the index and the slice asked for are read, path
+	can be a log written through IndexedLog or a compressed one that was."""
+	if isinstance(since, datetime.datetime):
+		since = time.mktime(since.timetuple())
+	if isinstance(until, datetime.datetime):
+		until = time.mktime(until.timetuple())
+	for (suffix, compress, decompress) in COMPRESSORS.values():
+		if path.endswith(suffix):
+			break
+	else:
+		suffix = decompress = None
+	if suffix:
+		(start, end, lines) = find_offsets(path[:-len(suffix)] + INDEX_SUFFIX, since, until)
+	else:
+		(start, end, lines) = find_offsets(path + INDEX_SUFFIX, since, until)
+	if start is None or (end is not None and end <= start):
+		return (lines, b'')
+	if not suffix:
+		with open(path, 'rb') as logFile:
+			if not os.fstat(logFile.fileno()).st_size:
+				return (lines, b'')
+			with mmap.mmap(logFile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+				return (lines, data[start:end])
+	with open(path + BLOCKS_SUFFIX, 'rb') as blocksFile, open(path, 'rb') as logFile:
+		if not os.fstat(logFile.fileno()).st_size:
+			return (lines, b'')
+		with mmap.mmap(blocksFile.fileno(), 0, access=mmap.ACCESS_READ) as blocks, mmap.mmap(logFile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+			count = len(blocks) // BLOCK_RECORD.size
+			first = start // BLOCK_SIZE
+			last = count - 1 if end is None else min((end - 1) // BLOCK_SIZE, count - 1)
+			chunks = []
+			for block in range(first, last + 1):
+				offset = BLOCK_RECORD.unpack_from(blocks, block * BLOCK_RECORD.size)[0]
+				following = None
+				if block + 1 < count:
+					following = BLOCK_RECORD.unpack_from(blocks, (block + 1) * BLOCK_RECORD.size)[0]
+				chunks.append(decompress(data[offset:following]))
+	text = b''.join(chunks)
+	base = first * BLOCK_SIZE
+	return (lines, text[start - base:None if end is None else end - base])
+
+# A ban forwarding to another channel ends in $#channel
+FORWARD = re.compile(r'\$(#.*)')
+
+def split_forward(target):
+	"""Returns a banmask and the channel it forwards to, or None."""
+	match = FORWARD.search(target)
+	if match is None:
+		return (target, None)
+	return (target[:match.start()], match.group(1))
+
+# Nicks and masks compare with RFC 1459 casemapping, {}|^ are the lower case
+# of []\~
+IRC_LOWER = str.maketrans(string.ascii_uppercase + '[]\\~', string.ascii_lowercase + '{}|^')
+
+def complete_mask(mask):
+	"""A banmask completed the way servers do it, nick to nick!*@* and
+	user@host to *!user@host, in lower case."""
+	if '!' not in mask and '@' not in mask:
+		mask += '!*@*'
+	elif '!' not in mask:
+		mask = '*!' + mask
+	elif '@' not in mask:
+		mask += '@*'
+	return mask.translate(IRC_LOWER)
+
+def split_hostmask(hostmask):
+	(nick, _, rest) = hostmask.partition('!')
+	(user, _, host) = rest.partition('@')
+	return (nick, user, host)
+
+def mask_pattern(mask):
+	"""The regex for a banmask, None for extbans ($a:account and so on) which
+	can't be matched against a hostmask."""
+	if mask.startswith('$') or not mask:
+		return None
+	return re.escape(complete_mask(mask)).replace('\\*', '.*').replace('\\?', '.')
+
+def mask_piece(mask):
+	"""A piece of a banmask without wildcards, which a hostmask has to have
+	to match it, as (part, end, text).  part is 0, 1 or 2 for nick, user or
+	host and end says whether text is the start or the end of it.  The host
+	is tried first, it's what most bans are on.  None if there isn't one."""
+	parts = split_hostmask(complete_mask(mask))
+	for part in (2, 0, 1):
+		text = parts[part]
+		wildcards = [i for (i, c) in enumerate(text) if c in '*?']
+		if not wildcards:
+			return (part, 'start', text) if text else None
+		if wildcards[0] > 0:
+			return (part, 'start', text[:wildcards[0]])
+		if wildcards[-1] < len(text) - 1:
+			return (part, 'end', text[wildcards[-1] + 1:])
+	return None
+
+Ban = collections.namedtuple('Ban', 'channel mask setBy timestamp reason')
+
+class CountRing:
+	# The last size samples of a channel's user count, kept in arrays so
+	# sampling every few seconds never allocates.  drain() sums up the samples
+	# added since it was last called.
+	__slots__ = ('counts', 'times', 'added', 'pending')
+
+	def __init__(self, size):
+		self.counts = array.array('l', [0]) * size
+		self.times = array.array('d', [0.0]) * size
+		self.added = 0
+		self.pending = 0
+
+	def __len__(self):
+		return min(self.added, len(self.counts))
+
+	def add(self, timestamp, count):
+		i = self.added % len(self.counts)
+		self.counts[i] = count
+		self.times[i] = timestamp
+		self.added += 1
+		# Older samples nobody drained are overwritten
+		self.pending = min(self.pending + 1, len(self.counts))
+
+	def drain(self):
+		"""Returns (first time, last time, min, max, total, samples) for the
+		samples since the last drain, or None if there aren't any."""
+		n = self.pending
+		if not n:
+			return None
+		self.pending = 0
+		size = len(self.counts)
+		start = (self.added - n) % size
+		if start + n <= size:
+			counts = self.counts[start:start + n]
+		else:
+			counts = self.counts[start:] + self.counts[:start + n - size]
+		return (self.times[start], self.times[(self.added - 1) % size], min(counts), max(counts), sum(counts), n)
+
+class ChannelBans:
+	# One channel's bans, indexed by a piece of each mask (see mask_piece) so
+	# a hostmask is only checked against the bans whose piece it has, found
+	# with a dict lookup for each place the piece could start or end.
 
 	def __init__(self):
-		# Will only work on UNIX
-		if (hasattr(time, 'tzset')):
-			os.environ['TZ'] = 'Europe/London'
-			time.tzset()
-		fh = logging.handlers.TimedRotatingFileHandler('combined.log', when='midnight', interval=1, backupCount=5);
-		logging.basicConfig(level=logging.DEBUG, handlers=[fh], format="%(levelname)s: %(asctime)s -  %(message)s")
-		self.__connect()
+		# mask -> (Ban, compiled regex or None)
+		self.bans = {}
+		# (part, end) -> {text: {mask: (Ban, regex)}}
+		self.pieces = {}
+		# Bans with no piece, like *!*@*, always checked
+		self.rest = {}
+
+	def add(self, ban, regex):
+		self.remove(ban.mask)
+		self.bans[ban.mask] = (ban, regex)
+		if regex is None:
+			return
+		piece = mask_piece(ban.mask)
+		if piece is None:
+			self.rest[ban.mask] = (ban, regex)
+		else:
+			(part, end, text) = piece
+			self.pieces.setdefault((part, end), {}).setdefault(text, {})[ban.mask] = (ban, regex)
+
+	def remove(self, mask):
+		if self.bans.pop(mask, None) is None:
+			return False
+		self.rest.pop(mask, None)
+		piece = mask_piece(mask)
+		if piece is not None:
+			(part, end, text) = piece
+			texts = self.pieces.get((part, end), {})
+			masks = texts.get(text, {})
+			masks.pop(mask, None)
+			if not masks:
+				texts.pop(text, None)
+		return True
+
+	def match(self, hostmask):
+		parts = split_hostmask(hostmask)
+		candidates = list(self.rest.values())
+		for ((part, end), texts) in self.pieces.items():
+			if not texts:
+				continue
+			text = parts[part]
+			if end == 'start':
+				keys = (text[:i] for i in range(1, len(text) + 1))
+			else:
+				keys = (text[i:] for i in range(len(text)))
+			for key in keys:
+				masks = texts.get(key)
+				if masks:
+					candidates.extend(masks.values())
+		return [ban for (ban, regex) in candidates if regex.fullmatch(hostmask)]
+
+class BanIndex:
+	# The active bans of every channel, each compiled once when it's added so
+	# checking a hostmask never goes near the database.
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		# channel -> ChannelBans
+		self.channels = {}
+
+	def add(self, channel, mask, setBy=None, timestamp=None, reason=None):
+		mask = split_forward(mask)[0]
+		pattern = mask_pattern(mask)
+		ban = Ban(channel, mask, setBy, timestamp or datetime.datetime.now(), reason)
+		key = channel.translate(IRC_LOWER)
+		with self.lock:
+			if key not in self.channels:
+				self.channels[key] = ChannelBans()
+			self.channels[key].add(ban, pattern and re.compile(pattern, re.S))
+
+	def remove(self, channel, mask):
+		mask = split_forward(mask)[0]
+		key = channel.translate(IRC_LOWER)
+		with self.lock:
+			bans = self.channels.get(key)
+			if bans is not None and bans.remove(mask) and not bans.bans:
+				del self.channels[key]
+
+	def clear(self):
+		with self.lock:
+			self.channels.clear()
+
+	def __len__(self):
+		return sum(len(bans.bans) for bans in self.channels.values())
+
+	def active(self, channel):
+		with self.lock:
+			bans = self.channels.get(channel.translate(IRC_LOWER))
+			return [ban for (ban, regex) in bans.bans.values()] if bans else []
+
+	def match(self, hostmask, channel=None):
+		"""The active bans matching hostmask (nick!user@host) in channel, or in
+		every channel if it's None."""
+		hostmask = hostmask.translate(IRC_LOWER)
+		with self.lock:
+			if channel is None:
+				channels = list(self.channels.values())
+			else:
+				channels = [self.channels.get(channel.translate(IRC_LOWER))]
+			return [ban for bans in channels if bans is not None for ban in bans.match(hostmask)]
+
+class LRUCache:
+	# Bounded mapping that forgets the least recently used keys first, shared
+	# by every thread writing to the database
+
+	def __init__(self, size):
+		self.size = size
+		self.data = collections.OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, key):
+		with self.lock:
+			try:
+				self.data.move_to_end(key)
+			except KeyError:
+				return None
+			return self.data[key]
 
-	def __connect(self):
-		logging.debug("Attempting to connect with database...")
-		# DB connection string
+	def set(self, key, value):
+		with self.lock:
+			self.data[key] = value
+			self.data.move_to_end(key)
+			if len(self.data) > self.size:
+				self.data.popitem(last=False)
+
+	def discard(self, key):
+		with self.lock:
+			self.data.pop(key, None)
+
+	def clear(self):
+		with self.lock:
+			self.data.clear()
+
+	def __len__(self):
+		return len(self.data)
+
+class LogEvent:
+	# Something that happened in a channel, built once by the plugin's do*
+	# handlers and handed to every sink that takes its kind.  The time is
+	# taken once and the channel normalised once, and whatever a sink makes of
+	# the event is cached on it by rendered(), so no line or timestamp is
+	# formatted twice.  channel is the name as the server sent it, which is
+	# how the database keeps it, normalized the one the plugin's logs are kept
+	# under.  content is the message, reason, mode string or netsplit's
+	# servers, target the nick kicked, new nick, mask banned, nick a relayed
+	# message is from or the (nick, host, time) of each user in a netsplit or
+	# join flood.
+	__slots__ = ('kind', 'time', 'channel', 'normalized', 'nick', 'host', 'content', 'target', 'hidden', 'local', 'cache')
+
+	def __init__(self, kind, now, channel, normalized, nick, host=None, content='', target=None, hidden=False):
+		self.kind = kind
+		self.time = now
+		self.channel = channel
+		self.normalized = normalized
+		self.nick = nick
+		self.host = host
+		self.content = content
+		self.target = target
+		# Left out of the plugin's channel logs, see noLogPrefix
+		self.hidden = hidden
+		self.local = None
+		self.cache = None
+
+	def rendered(self, key, render):
+		"""render(self), worked out the first time key is asked for."""
+		if self.cache is None:
+			self.cache = {}
 		try:
-			with open('plugins/LogsToDB/config.json') as data:
-				config = json.load(data)
-
-			conn_string = "host='%s' dbname='%s' user='%s' password='%s'" % (config['db']['host'], config['db']['dbname'], config['db']['user'], config['db']['password'])
-		except IOError as e:
-			print(os.getcwd())
-			logging.error("Error! No config file supplied, please create a config.json file in the root")
-			sys.exit("Error! No config file supplied, please create a config.json file in the root")
-		
-		# Print connection string
-		print("Connecting to database\n -> %s" % (conn_string))
-		
-		# get a connection
-		conn = psycopg2.connect(conn_string)
-		
-		# conn.curser will return a cursor object, you can use this to perform queries
-		self.cursor = conn.cursor()
-		self.conn = conn
-		logging.debug("connected!")
+			return self.cache[key]
+		except KeyError:
+			value = self.cache[key] = render(self)
+			return value
+
+	def strftime(self, format):
+		if self.local is None:
+			self.local = time.localtime(self.time)
+		return self.rendered(('strftime', format), lambda event: time.strftime(format, event.local))
+
+class LogviewerEvents(abc.ABC):
+	# Turns the calls the plugin makes into (kind, args) events, subclasses
+	# decide what write_event does with them.  timestamp is when it happened,
+	# now if it isn't given.
 
 	def add_count(self, count, channel, topic):
-		count = str(count)
-		topic = str(topic)
-		channel_id = self.get_channel_id(channel)
-		try:
-			self.cursor.execute("INSERT INTO user_count (count, channel_id, topic) VALUES (%s, %s, %s)", (count, channel_id, topic))
-			self.conn.commit()
-		except psycopg2.InterfaceError as e:
-			logging.error('Error within add_count: ' + e.message)
-			logging.debug('Attempting to reconnect with database...')
-			self.__connect()
+		self.write_event('count', (count, channel, topic))
+
+	def add_counts(self, samples):
+		# [(channel, first, last, min, max, total, samples)] for every channel
+		self.write_event('counts', (samples,))
+
+	def add_topic(self, topic, channel):
+		self.write_event('topic', (topic, channel))
 
 	def add_message(self, user, host, msg, channel):
-		self.__add_message(user, host, msg, 'message', channel)
+		self.write_event('message', (user, host, msg, 'message', channel))
 
 	def add_join(self, user, host, channel):
-		self.__add_message(user, host, '', 'join', channel)
+		self.write_event('join', (user, host, channel))
 
 	def add_part(self, user, host, channel):
-		self.__add_message(user, host, '', 'part', channel)
+		self.write_event('message', (user, host, '', 'part', channel))
 
 	def add_quit(self, user, host, channel):
-		self.__add_message(user, host, '', 'quit', channel)
+		self.write_event('message', (user, host, '', 'quit', channel))
 
 	def add_emote(self, user, host, msg, channel):
-		self.__add_message(user, host, msg, 'emote', channel)
+		self.write_event('message', (user, host, msg, 'emote', channel))
+
+	def write_ban(self, nick, host, mode, target, channel):
+		self.write_event('ban', (nick, host, mode, target, channel))
+
+	def write_unban(self, nick, host, mode, target, channel):
+		self.write_event('unban', (nick, host, mode, target, channel))
+
+	# The database's share of a LogEvent, for the kinds in DB_KINDS
+	def add_event(self, event):
+		if event.kind in ('ban', 'unban'):
+			self.write_event(event.kind, (event.nick, event.host, event.content, event.target, event.channel), event.time)
+		elif event.kind == 'netsplit':
+			self.write_event('group', ('quit', event.target, event.channel), event.time)
+		elif event.kind == 'join':
+			self.write_event('join', (event.nick, event.host, event.channel), event.time)
+		elif event.kind == 'netjoin':
+			self.write_event('joins', (event.target, event.channel), event.time)
+		else:
+			content = event.content if event.kind in ('message', 'emote') else ''
+			self.write_event('message', (event.nick, event.host, content, event.kind, event.channel), event.time)
+
+	@abc.abstractmethod
+	def write_event(self, kind, args, timestamp=None):
+		pass
 
+class Batch:
+	# What a thread's write_batch builds up before it's committed: the cache
+	# entries to forget if it isn't, and the message rows and
+	# (channel_id, hour, user id, action) -> message counts written at its end
+	__slots__ = ('uncommitted', 'messageRows', 'activity')
 
-	def __add_message(self, user, host, msg, action, channel):
+	def __init__(self):
+		self.uncommitted = []
+		self.messageRows = []
+		self.activity = collections.Counter()
+
+class LogviewerStorage(LogviewerEvents):
+	# What the plugin, the writers and the tools need from a database, along
+	# with everything that doesn't depend on which database it is.  Backends
+	# provide:
+	#
+	#   transaction()                     a cursor, committed on the way out
+	#   get_user_id, resolve_users        identity resolution
+	#   get_channel_id
+	#   write_messages, write_activity    message append, once per batch
+	#   _write_ban, _write_unban          ban updates
+	#   _write_counts, _write_count,      count samples and topics
+	#   _write_topic
+	#   get_marker, set_marker,           spool replay progress
+	#   clear_marker
+	#   search, iter_messages,            reading it all back
+	#   activity_stats, load_bans
+	#
+	# and say which of their exceptions mean the database is away (the batch
+	# is spooled) and which are its errors in general.  LogviewerDB is the
+	# Postgres backend, channelLogger_sqlite.SQLiteDB an embedded one.
+	unavailableErrors = ()
+	errors = ()
+
+	def __init__(self, cacheSize=50000, spool=None, replayBatch=1000):
+		# Will only work on UNIX
+		if (hasattr(time, 'tzset')):
+			os.environ['TZ'] = 'Europe/London'
+			time.tzset()
+		fh = logging.handlers.TimedRotatingFileHandler('combined.log', when='midnight', interval=1, backupCount=5);
+		logging.basicConfig(level=logging.DEBUG, handlers=[fh], format="%(levelname)s: %(asctime)s -  %(message)s")
+		# nick -> nicks.id, host -> hosts.id, (nick id, host id) ->
+		# identities.id and channel_name -> channels.id, IDs never change once
+		# committed so these only need care around rollbacks.  Each string is
+		# kept once however many hosts a nick has been seen with, the users
+		# themselves are just pairs of ints.
+		self.nickCache = LRUCache(cacheSize)
+		self.hostCache = LRUCache(cacheSize)
+		self.userCache = LRUCache(cacheSize)
+		self.channelCache = LRUCache(cacheSize)
+		# The writer and the plugin's own threads may write at once, each has
+		# its own Batch, see batch
+		self.local = threading.local()
+		# While the database is away events go to the spool, they are replayed
+		# replayBatch at a time once it's back
+		self.spool = spool
+		self.replayBatch = replayBatch
+		# Kept in step with the channels' modes by the plugin, see load_bans
+		self.bans = BanIndex()
+
+	def close(self):
+		if self.spool is not None:
+			self.spool.close()
 
+	@property
+	def batch(self):
 		try:
-			# Was this message from a user we already have in our database?
-			# If so return the userID.
-			userID = self.check_user_host_exists(user, host) or False
-
-			# If userID is False, store the new combo then get back the userID
-			if not userID:
-				self.cursor.execute("INSERT INTO users (\"user\", \"host\") VALUES (%s, %s)", (user, host))
-				self.conn.commit()
-				# We should now have an ID for our new user/host combo
-				userID = self.check_user_host_exists(user, host);
-
-			# check channel exists, if not get_channel_id will generate an ID
-			channel_id = self.get_channel_id(channel)
-
-			if (action == 'message' or action == 'emote'):	
-				self.cursor.execute("INSERT INTO messages (\"user\", \"content\", \"action\", \"channel_id\") VALUES (%s, %s, %s, %s)", (userID, msg, action, channel_id))
-			else:
-				self.cursor.execute("INSERT INTO messages (\"user\", \"action\", \"channel_id\") VALUES (%s, %s, %s)", (userID, action, channel_id))
-			self.conn.commit()
-		except psycopg2.InterfaceError as e:
-			logging.error('Error within add_message: ' + e.message)
-			logging.debug('Attempting to reconnect with database...')
-			self.__connect()			
+			return self.local.batch
+		except AttributeError:
+			batch = self.local.batch = Batch()
+			return batch
 
-	def write_ban(self, nick, host, mode, target, channel):
+	@abc.abstractmethod
+	def transaction(self):
+		pass
+
+	def flush(self):
+		# Every write is committed as it happens, there is nothing buffered here
+		return
+
+	def write_event(self, kind, args, timestamp=None):
+		if timestamp is None:
+			timestamp = time.time()
+		if self.write_batch([(kind, timestamp, args)]):
+			self.replay_spool()
+
+	# Events are (kind, timestamp, args) tuples, the whole batch is written in
+	# a single transaction so a busy channel costs one commit per batch rather
+	# than one per line.  marker is set when replaying the spool, it's saved
+	# in the same transaction so a batch can never be replayed twice.
+	# Returns whether the batch made it into the database.
+	def write_batch(self, events, marker=None):
 		try:
-			# check channel exists, if not get_channel_id will generate an ID
-			channel_id = self.get_channel_id(channel)
-			# Sometimes users can be kicked to another channel because of join/quit floos, make sure we strip of the ban forwarding
-			
-			if (len(re.split(r'(\$#.*)', target)) > 1):
-				banmask = re.split(r'(\$#.*)', target)[0]
-				forwarded_channel = re.sub('^\$', '', re.split(r'(\$#.*)', target)[1])
-				self.cursor.execute("INSERT INTO bans (banmask, banned_by, channel, reason) values (%s, %s, %s, %s)", (banmask, nick, channel_id, "Join/Quit flood, user forwarded to " + forwarded_channel))
-			else:
-				banmask = re.split(r'(\$#.*)', target)[0]
-				self.cursor.execute("INSERT INTO bans (banmask, banned_by, channel) values (%s, %s, %s)", (banmask, nick, channel_id))
-			self.conn.commit()
-		except psycopg2.InterfaceError as e:
-			logging.error('Error within write_ban: ' + e.message)
-			logging.debug('Attempting to reconnect with database...')
-			self.__connect()
+			with self.transaction() as cursor:
+				self.resolve_users(cursor, events)
+				self.write_events(cursor, events)
+				if marker is not None:
+					self.set_marker(cursor, marker)
+			self.batch.uncommitted = []
+			return True
+		except self.unavailableErrors as e:
+			# The database went away, keep the events for later
+			logging.error('Error within write_batch: ' + str(e))
+			self.forget_uncommitted()
+			if marker is None:
+				self.spool_events(events)
+			return False
+		except self.errors as e:
+			# Something in the batch itself is wrong, spooling it would only fail
+			# again.  Retry the events one by one so only the bad one is lost.
+			logging.error('Error within write_batch: ' + str(e))
+			self.forget_uncommitted()
+			return self.write_each(events, marker)
 
-	def write_unban(self, nick, host, mode, target, channel):
+	def write_events(self, cursor, events):
+		batch = self.batch
+		batch.messageRows = []
+		batch.activity.clear()
+		for (kind, timestamp, args) in events:
+			getattr(self, '_write_' + kind)(cursor, timestamp, *args)
+		self.write_messages(cursor, batch.messageRows)
+		self.write_activity(cursor, batch.activity)
+
+	# A batch that failed as a whole, written again in one transaction with a
+	# savepoint for each event so only the bad ones are lost.  The marker goes
+	# in the same transaction, and if the database goes away nothing of it is
+	# kept, so the events are still written exactly once.
+	def write_each(self, events, marker=None):
+		try:
+			with self.transaction() as cursor:
+				uncommitted = self.batch.uncommitted
+				for event in events:
+					n = len(uncommitted)
+					cursor.execute("SAVEPOINT write_event")
+					try:
+						self.write_events(cursor, [event])
+					except self.unavailableErrors:
+						raise
+					except self.errors as e:
+						cursor.execute("ROLLBACK TO SAVEPOINT write_event")
+						for (cache, key) in uncommitted[n:]:
+							cache.discard(key)
+						del uncommitted[n:]
+						logging.error('Dropping event %r: %s' % (event, e))
+					else:
+						cursor.execute("RELEASE SAVEPOINT write_event")
+				if marker is not None:
+					self.set_marker(cursor, marker)
+			self.batch.uncommitted = []
+			return True
+		except self.unavailableErrors as e:
+			logging.error('Error within write_each: ' + str(e))
+			self.forget_uncommitted()
+			if marker is None:
+				self.spool_events(events)
+			return False
+		except self.errors as e:
+			logging.error('Error within write_each: ' + str(e))
+			self.forget_uncommitted()
+			return False
+
+	def spool_events(self, events):
+		if self.spool is None:
+			logging.error('No spool configured, dropping %s events' % len(events))
+			return
+		try:
+			self.spool.append(events)
+		except (IOError, OSError) as e:
+			logging.error('Error within spool_events, dropping %s events: %s' % (len(events), e))
+
+	def replay_spool(self):
+		"""Writes one batch from the spool.  Returns True if it did anything, so
+		callers know there may be more waiting."""
+		if self.spool is None or not self.spool.pending():
+			return False
+		name = self.spool.oldest()
+		if name is None:
+			return False
 		try:
-			# check channel exists, if not get_channel_id will generate an ID
-			channel_id = self.get_channel_id(channel)
-			self.cursor.execute("UPDATE bans SET still_banned = FALSE WHERE channel = %s AND banmask = %s", (channel_id, target))
-			self.conn.commit()
-		except psycopg2.InterfaceError as e:
-			logging.error('Error within write_unban: ' + e.message)
-			logging.debug('Attempting to reconnect with database...')
-			self.__connect()
+			(events, offset) = self.spool.read(name, self.get_marker(name), self.replayBatch)
+			if not events:
+				with self.transaction() as cursor:
+					self.clear_marker(cursor, name)
+				self.spool.remove(name)
+				logging.info('Finished replaying spool segment %s' % name)
+				return True
+		except self.errors as e:
+			logging.error('Error within replay_spool: ' + str(e))
+			return False
+		return self.write_batch(events, (name, offset))
+
+	def forget_uncommitted(self):
+		batch = self.batch
+		for (cache, key) in batch.uncommitted:
+			cache.discard(key)
+		batch.uncommitted = []
+
+	def remember(self, cache, key, value):
+		cache.set(key, value)
+		self.batch.uncommitted.append((cache, key))
+
+	# The ID for this user/host combo if every part of it is cached, else None
+	def cached_user_id(self, user, host):
+		nick_id = self.nickCache.get(user)
+		host_id = self.hostCache.get(host)
+		if nick_id is None or host_id is None:
+			return None
+		return self.userCache.get((nick_id, host_id))
+
+	# Backends that can add a batch's new users in fewer statements than
+	# get_user_id one at a time do it here, before anything else is written
+	def resolve_users(self, cursor, events):
+		return
+
+	# (user, host) for every message row or join a batch of events writes
+	def event_users(self, events):
+		for (kind, timestamp, args) in events:
+			if kind == 'message' or kind == 'join':
+				yield (args[0], args[1])
+			elif kind == 'group':
+				for (user, host, when) in args[1]:
+					yield (user, host)
+			elif kind == 'joins':
+				for (user, host, when) in args[0]:
+					yield (user, host)
+
+	# A netsplit's quits in a channel, a row each with its own time, added to
+	# the batch's other rows so they all go in with one insert
+	def _write_group(self, cursor, timestamp, action, users, channel):
+		for (user, host, when) in users:
+			self._write_message(cursor, when, user, host, '', action, channel)
+
+	# Joins are only counted in channel_activity_hourly, there are too many
+	# to keep a messages row for each
+	def _write_join(self, cursor, timestamp, user, host, channel):
+		userID = self.get_user_id(cursor, user, host)
+		channel_id = self.get_channel_id(cursor, channel)
+		hour = datetime.datetime.fromtimestamp(timestamp).replace(minute=0, second=0, microsecond=0)
+		self.batch.activity[(channel_id, hour, userID, 'join')] += 1
+
+	# A join flood or the joins after a netsplit, each with its own time
+	def _write_joins(self, cursor, timestamp, users, channel):
+		for (user, host, when) in users:
+			self._write_join(cursor, when, user, host, channel)
+
+	def _write_message(self, cursor, timestamp, user, host, msg, action, channel):
+		userID = self.get_user_id(cursor, user, host)
+
+		# check channel exists, if not get_channel_id will generate an ID
+		channel_id = self.get_channel_id(cursor, channel)
+		if not (action == 'message' or action == 'emote'):
+			msg = None
+		elif msg and '\x00' in msg:
+			# Postgres can't store NUL in text at all, it's dropped whichever
+			# way the row is written
+			msg = msg.replace('\x00', '')
+		timestamp = datetime.datetime.fromtimestamp(timestamp)
+		# Rows are written together at the end of the batch, see write_messages
+		batch = self.batch
+		batch.messageRows.append((userID, msg, action, channel_id, timestamp))
+		batch.activity[(channel_id, timestamp.replace(minute=0, second=0, microsecond=0), userID, action)] += 1
+
+	# The user_count rows and (channel_id, hour) -> (samples, total, peak) for
+	# channel_users_hourly from add_counts' samples.  count is the average.
+	def count_rows(self, cursor, samples):
+		rows = []
+		hourly = {}
+		for (channel, first, last, low, high, total, n) in samples:
+			channel_id = self.get_channel_id(cursor, channel)
+			last = datetime.datetime.fromtimestamp(last)
+			rows.append((int(round(total / float(n))), channel_id, last, low, high, n))
+			key = (channel_id, last.replace(minute=0, second=0, microsecond=0))
+			(hourSamples, hourTotal, peak) = hourly.get(key, (0, 0, 0))
+			hourly[key] = (hourSamples + n, hourTotal + total, max(peak, high))
+		return (rows, hourly)
+
+class LogviewerDB(LogviewerStorage):
+	unavailableErrors = (channellogger_pool.PoolUnavailable, psycopg2.OperationalError, psycopg2.InterfaceError)
+	errors = (channellogger_pool.PoolUnavailable, psycopg2.Error)
+
+	def __init__(self, pool=None, cacheSize=50000, copyThreshold=50, spool=None, replayBatch=1000, archiveDir=None):
+		super().__init__(cacheSize, spool, replayBatch)
+		if pool is None:
+			pool = channellogger_pool.LogviewerPool(load_config())
+		self.pool = pool
+		# Batches with at least this many message rows are loaded with COPY,
+		# 0 means always use INSERT
+		self.copyThreshold = copyThreshold
+		# Where channelLogger_archive puts messages moved out of the database
+		self.archiveDir = archiveDir
+
+	def close(self):
+		super().close()
+		self.pool.close()
+
+	@contextlib.contextmanager
+	def transaction(self):
+		with self.pool.connection() as conn:
+			yield conn.cursor()
+			conn.commit()
+
+	def get_marker(self, segment):
+		"""Returns the offset saved by write_batch for segment, 0 if there is none."""
+		with self.pool.connection() as conn:
+			cursor = conn.cursor()
+			cursor.execute("SELECT \"offset\" FROM spool_replay WHERE segment = %s", (segment,))
+			row = cursor.fetchone()
+			return row[0] if row else 0
+
+	def set_marker(self, cursor, marker):
+		cursor.execute("INSERT INTO spool_replay (segment, \"offset\") VALUES (%s, %s) ON CONFLICT (segment) DO UPDATE SET \"offset\" = EXCLUDED.\"offset\"", marker)
+
+	def clear_marker(self, cursor, segment):
+		cursor.execute("DELETE FROM spool_replay WHERE segment = %s", (segment,))
+
+	def _write_count(self, cursor, timestamp, count, channel, topic):
+		count = str(count)
+		topic = str(topic)
+		channel_id = self.get_channel_id(cursor, channel)
+		timestamp = datetime.datetime.fromtimestamp(timestamp)
+		cursor.execute("INSERT INTO user_count (count, channel_id, topic, \"timestamp\") VALUES (%s, %s, %s, %s)", (count, channel_id, topic, timestamp))
+		cursor.execute("INSERT INTO channel_users_hourly (channel_id, hour, samples, total, peak) VALUES (%s, %s, 1, %s, %s) ON CONFLICT (channel_id, hour) DO UPDATE SET samples = channel_users_hourly.samples + 1, total = channel_users_hourly.total + EXCLUDED.total, peak = greatest(channel_users_hourly.peak, EXCLUDED.peak)", (channel_id, timestamp.replace(minute=0, second=0, microsecond=0), count, count))
+
+	# Every channel's user counts since the last call, in one INSERT for
+	# user_count and one upsert for channel_users_hourly.  The topic is written
+	# by _write_topic when it changes.
+	def _write_counts(self, cursor, timestamp, samples):
+		(rows, hourly) = self.count_rows(cursor, samples)
+		psycopg2.extras.execute_values(cursor, "INSERT INTO user_count (count, channel_id, \"timestamp\", min_count, max_count, samples) VALUES %s", rows, page_size=1000)
+		# Sorted for the same reason as write_activity
+		psycopg2.extras.execute_values(cursor, "INSERT INTO channel_users_hourly (channel_id, hour, samples, total, peak) VALUES %s ON CONFLICT (channel_id, hour) DO UPDATE SET samples = channel_users_hourly.samples + EXCLUDED.samples, total = channel_users_hourly.total + EXCLUDED.total, peak = greatest(channel_users_hourly.peak, EXCLUDED.peak)", sorted(key + value for (key, value) in hourly.items()), page_size=1000)
+
+	def _write_topic(self, cursor, timestamp, topic, channel):
+		channel_id = self.get_channel_id(cursor, channel)
+		cursor.execute("INSERT INTO channel_topics (channel_id, topic, \"timestamp\") VALUES (%s, %s, %s)", (channel_id, topic, datetime.datetime.fromtimestamp(timestamp)))
+
+	def _write_ban(self, cursor, timestamp, nick, host, mode, target, channel):
+		# check channel exists, if not get_channel_id will generate an ID
+		channel_id = self.get_channel_id(cursor, channel)
+		# Sometimes users can be kicked to another channel because of join/quit floos, make sure we strip of the ban forwarding
+		(banmask, forwarded_channel) = split_forward(target)
+		if forwarded_channel:
+			cursor.execute("INSERT INTO bans (banmask, banned_by, channel, reason) values (%s, %s, %s, %s)", (banmask, nick, channel_id, "Join/Quit flood, user forwarded to " + forwarded_channel))
+		else:
+			cursor.execute("INSERT INTO bans (banmask, banned_by, channel) values (%s, %s, %s)", (banmask, nick, channel_id))
+
+	def _write_unban(self, cursor, timestamp, nick, host, mode, target, channel):
+		# check channel exists, if not get_channel_id will generate an ID
+		channel_id = self.get_channel_id(cursor, channel)
+		# Uses the bans_active index
+		cursor.execute("UPDATE bans SET still_banned = FALSE WHERE channel = %s AND banmask = %s AND still_banned", (channel_id, split_forward(target)[0]))
+
+	def write_messages(self, cursor, rows):
+		if not rows:
+			return
+		if self.copyThreshold and len(rows) >= self.copyThreshold:
+			# Keep the rest of the batch if COPY fails, INSERT will get the real error
+			cursor.execute("SAVEPOINT copy_messages")
+			try:
+				self.copy_messages(cursor, rows)
+				cursor.execute("RELEASE SAVEPOINT copy_messages")
+				return
+			except psycopg2.Error as e:
+				logging.error('Error within copy_messages, falling back to INSERT: ' + str(e))
+				cursor.execute("ROLLBACK TO SAVEPOINT copy_messages")
+		self.insert_messages(cursor, rows)
+
+	# One upsert for the whole batch.  Rows go in sorted so writers touching
+	# the same rollup rows always lock them in the same order and can't
+	# deadlock each other.
+	def write_activity(self, cursor, activity):
+		if not activity:
+			return
+		rows = sorted(key + (count,) for (key, count) in activity.items())
+		psycopg2.extras.execute_values(cursor, "INSERT INTO channel_activity_hourly (channel_id, hour, \"user\", action, count) VALUES %s ON CONFLICT (channel_id, hour, \"user\", action) DO UPDATE SET count = channel_activity_hourly.count + EXCLUDED.count", rows, page_size=1000)
+
+	def insert_messages(self, cursor, rows):
+		for row in rows:
+			cursor.execute("INSERT INTO messages (\"user\", \"content\", \"action\", \"channel_id\", \"timestamp\") VALUES (%s, %s, %s, %s, %s)", row)
+
+	# Stream rows through COPY's text format from an in-memory buffer, one
+	# round trip for the whole batch
+	def copy_messages(self, cursor, rows):
+		data = StringIO()
+		for row in rows:
+			data.write('\t'.join([copy_value(value) for value in row]))
+			data.write('\n')
+		data.seek(0)
+		cursor.copy_expert("COPY messages (\"user\", \"content\", \"action\", \"channel_id\", \"timestamp\") FROM STDIN", data)
 
 	# UTILITY FUNCTIONS
 
 	# Check if user exists then return the user ID, if not return false
 	def check_user_host_exists(self, user, host):
 		try:
-			self.cursor.execute("SELECT * FROM users WHERE \"user\"= %s AND \"host\"= %s", (user, host))
-			if self.cursor.rowcount:
-				return self.cursor.fetchone()[0]
-			else:
-				return False
-		except psycopg2.InterfaceError as e:
-			logging.error('Error within check_user_host_exists: ' + e.message)
-			logging.debug('Attempting to reconnect with database...')
-			self.__connect()
+			with self.pool.connection('read') as conn:
+				cursor = conn.cursor()
+				cursor.execute("SELECT i.id FROM identities i JOIN nicks n ON n.id = i.nick_id JOIN hosts h ON h.id = i.host_id WHERE md5(n.nick)::uuid = md5(%s)::uuid AND md5(h.host)::uuid = md5(%s)::uuid AND n.nick = %s AND h.host = %s", (user, host, user, host))
+				if cursor.rowcount:
+					return cursor.fetchone()[0]
+				else:
+					return False
+		except (channellogger_pool.PoolUnavailable, psycopg2.Error) as e:
+			logging.error('Error within check_user_host_exists: ' + str(e))
+
 
+	# Return the ID for this user/host combo, creating it if we haven't seen it
+	# before.  Misses cost a single statement interning the nick and host and
+	# upserting the pair, the no-op updates on conflict are there so RETURNING
+	# gives us the existing rows' IDs as well.  Usually resolve_users has
+	# already done this for the whole batch.
+	def get_user_id(self, cursor, user, host):
+		userID = self.cached_user_id(user, host)
+		if userID is None:
+			cursor.execute("WITH n AS (INSERT INTO nicks (nick) VALUES (%s) ON CONFLICT ((md5(nick)::uuid)) DO UPDATE SET nick = nicks.nick RETURNING id), h AS (INSERT INTO hosts (host) VALUES (%s) ON CONFLICT ((md5(host)::uuid)) DO UPDATE SET host = hosts.host RETURNING id) INSERT INTO identities (nick_id, host_id) SELECT n.id, h.id FROM n, h ON CONFLICT (nick_id, host_id) DO UPDATE SET nick_id = EXCLUDED.nick_id RETURNING id, nick_id, host_id", (user, host))
+			(userID, nick_id, host_id) = cursor.fetchone()
+			self.remember(self.nickCache, user, nick_id)
+			self.remember(self.hostCache, host, host_id)
+			self.remember(self.userCache, (nick_id, host_id), userID)
+		return userID
 
-	def get_channel_id(self, channel):
+	# New users are added before anything else in the batch, a statement for
+	# all the new nicks, one for the hosts and one for the pairs, each in
+	# sorted order.  The upserts lock their rows until commit, and with several
+	# writers (see ShardedWriter) a quit is logged by each of them, so two
+	# batches adding the same users in different orders could deadlock, in
+	# the same order one just waits for the other.
+	def resolve_users(self, cursor, events):
+		users = set()
+		for (user, host) in self.event_users(events):
+			if self.cached_user_id(user, host) is None:
+				users.add((user, host))
+		if not users:
+			return
+		for (cache, table, column, values) in ((self.nickCache, 'nicks', 'nick', set(user for (user, host) in users)), (self.hostCache, 'hosts', 'host', set(host for (user, host) in users))):
+			missing = sorted(value for value in values if cache.get(value) is None)
+			if missing:
+				rows = psycopg2.extras.execute_values(cursor, "INSERT INTO %(table)s (%(column)s) VALUES %%s ON CONFLICT ((md5(%(column)s)::uuid)) DO UPDATE SET %(column)s = %(table)s.%(column)s RETURNING id, %(column)s" % {'table': table, 'column': column}, [(value,) for value in missing], page_size=1000, fetch=True)
+				for (id, value) in rows:
+					self.remember(cache, value, id)
+		pairs = set()
+		for (user, host) in users:
+			pair = (self.nickCache.get(user), self.hostCache.get(host))
+			if None not in pair and self.userCache.get(pair) is None:
+				pairs.add(pair)
+		if pairs:
+			rows = psycopg2.extras.execute_values(cursor, "INSERT INTO identities (nick_id, host_id) VALUES %s ON CONFLICT (nick_id, host_id) DO UPDATE SET nick_id = EXCLUDED.nick_id RETURNING id, nick_id, host_id", sorted(pairs), page_size=1000, fetch=True)
+			for (id, nick_id, host_id) in rows:
+				self.remember(self.userCache, (nick_id, host_id), id)
+
+	def get_channel_id(self, cursor, channel):
+		channel_id = self.channelCache.get(channel)
+		if channel_id is None:
+			cursor.execute("INSERT INTO channels (channel_name) VALUES (%s) ON CONFLICT (channel_name) DO UPDATE SET channel_name = EXCLUDED.channel_name RETURNING id", (channel,))
+			channel_id = cursor.fetchone()[0]
+			self.remember(self.channelCache, channel, channel_id)
+		return channel_id
+
+	# Full-text search over messages, newest first.  Filters are optional,
+	# before is the (timestamp, id) of the last row of the previous page so
+	# paging never has to skip over rows like OFFSET would.  The expression
+	# has to stay in step with the messages_content_search index.
+	def search(self, terms, channel=None, nick=None, since=None, until=None, before=None, limit=10, timeout=5000):
+		query = ["SELECT m.id, m.\"timestamp\", c.channel_name, n.nick, m.content FROM messages m JOIN channels c ON c.id = m.channel_id JOIN identities i ON i.id = m.\"user\" JOIN nicks n ON n.id = i.nick_id WHERE to_tsvector('simple', coalesce(m.content, '')) @@ websearch_to_tsquery('simple', %s)"]
+		params = [terms]
+		if channel is not None:
+			query.append("m.channel_id = (SELECT id FROM channels WHERE channel_name = %s)")
+			params.append(channel)
+		if nick is not None:
+			query.append("m.\"user\" IN (SELECT i.id FROM identities i JOIN nicks n ON n.id = i.nick_id WHERE md5(n.nick)::uuid = md5(%s)::uuid AND n.nick = %s)")
+			params.extend((nick, nick))
+		if since is not None:
+			query.append("m.\"timestamp\" >= %s")
+			params.append(since)
+		if until is not None:
+			query.append("m.\"timestamp\" < %s")
+			params.append(until)
+		if before is not None:
+			query.append("(m.\"timestamp\", m.id) < (%s, %s)")
+			params.extend(before)
+		params.append(limit)
+		with self.pool.connection('read') as conn:
+			cursor = conn.cursor()
+			# Never let one search tie up a connection for long
+			cursor.execute("SET LOCAL statement_timeout = %s", (timeout,))
+			cursor.execute(' AND '.join(query) + " ORDER BY m.\"timestamp\" DESC, m.id DESC LIMIT %s", params)
+			return cursor.fetchall()
+
+	# A channel's messages from since until until (None for no limit), oldest
+	# first, as (id, timestamp, user id, nick, action, content) whether they
+	# are still in the database or have been archived, optionally only those
+	# by nick or of one action.  Rows are streamed through a named cursor
+	# itersize at a time and the archive's blocks read as they're reached, so
+	# any range costs the same memory.  The read connection is held until the
+	# generator is finished or closed.
+	def iter_messages(self, channel, since=None, until=None, nick=None, action=None, itersize=2000):
+		with self.pool.connection('read') as conn:
+			cursor = conn.cursor()
+			cursor.execute("SELECT id FROM channels WHERE channel_name = %s", (channel,))
+			row = cursor.fetchone()
+			if row is None:
+				return
+			channel_id = row[0]
+			archived = []
+			directory = self.archiveDir and os.path.join(self.archiveDir, str(channel_id))
+			if directory and os.path.isdir(directory):
+				for name in sorted(os.listdir(directory)):
+					if name.endswith('.idx'):
+						continue
+					month = datetime.datetime.strptime(name, '%Y-%m')
+					end = (month + datetime.timedelta(days=32)).replace(day=1)
+					if (since is None or end > since) and (until is None or month < until):
+						rows = channellogger_archive.read_archive(os.path.join(directory, name), since, until)
+						if nick is not None or action is not None:
+							rows = (row for row in rows if (nick is None or row[3] == nick) and (action is None or row[4] == action))
+						archived.append(rows)
+			query = ["SELECT m.id, m.\"timestamp\", m.\"user\", n.nick, m.action, m.content FROM messages m LEFT JOIN identities i ON i.id = m.\"user\" LEFT JOIN nicks n ON n.id = i.nick_id WHERE m.channel_id = %s"]
+			params = [channel_id]
+			if since is not None:
+				query.append("m.\"timestamp\" >= %s")
+				params.append(since)
+			if until is not None:
+				query.append("m.\"timestamp\" < %s")
+				params.append(until)
+			if nick is not None:
+				query.append("i.nick_id = (SELECT id FROM nicks WHERE md5(nick)::uuid = md5(%s)::uuid AND nick = %s)")
+				params.extend((nick, nick))
+			if action is not None:
+				query.append("m.action = %s")
+				params.append(action)
+			hot = conn.cursor('iter_messages')
+			hot.itersize = itersize
+			hot.execute(' AND '.join(query) + " ORDER BY m.\"timestamp\", m.id", params)
+			try:
+				# A row can be in both if an archive run was cut short before
+				# deleting it, they sort next to each other
+				previous = None
+				for row in heapq.merge(*archived + [hot], key=lambda row: (row[1], row[0])):
+					if row[0] != previous:
+						previous = row[0]
+						yield row
+			finally:
+				hot.close()
+
+	# Totals for channel since the given time from the hourly rollups, never
+	# the raw tables.  Returns None if the channel has never been logged.
+	def activity_stats(self, channel, since, talkers=5):
+		with self.pool.connection('read') as conn:
+			cursor = conn.cursor()
+			cursor.execute("SELECT id FROM channels WHERE channel_name = %s", (channel,))
+			row = cursor.fetchone()
+			if row is None:
+				return None
+			params = (row[0], since)
+			stats = {}
+			cursor.execute("SELECT action, sum(count) FROM channel_activity_hourly WHERE channel_id = %s AND hour >= %s GROUP BY action", params)
+			stats['actions'] = dict(cursor.fetchall())
+			cursor.execute("SELECT hour, sum(count) FROM channel_activity_hourly WHERE channel_id = %s AND hour >= %s AND action IN ('message', 'emote') GROUP BY hour ORDER BY 2 DESC, hour DESC LIMIT 1", params)
+			stats['busiest'] = cursor.fetchone()
+			# Nicks rather than identities, which are per nick and host
+			cursor.execute("SELECT n.nick, sum(a.count) FROM channel_activity_hourly a JOIN identities i ON i.id = a.\"user\" JOIN nicks n ON n.id = i.nick_id WHERE a.channel_id = %s AND a.hour >= %s AND a.action IN ('message', 'emote') GROUP BY n.id ORDER BY 2 DESC LIMIT %s", params + (talkers,))
+			stats['talkers'] = cursor.fetchall()
+			cursor.execute("SELECT round(sum(total) / nullif(sum(samples), 0)), max(peak) FROM channel_users_hourly WHERE channel_id = %s AND hour >= %s", params)
+			stats['users'] = cursor.fetchone()
+			return stats
+
+	def load_bans(self):
+		"""Fills self.bans with the bans the database has as still active.
+		Returns whether it could."""
 		try:
-			self.cursor.execute("SELECT id FROM channels WHERE channel_name = %s", (channel,))
-			if self.cursor.rowcount:
-				return self.cursor.fetchone()[0]
-			else:
-				self.cursor.execute("INSERT INTO channels (channel_name) VALUES (%s)", (channel,))
-				self.conn.commit()
-				return self.get_channel_id(channel)
-		except psycopg2.InterfaceError as e:
-			logging.error('Error within get_channel_id: ' + e.message)
-			logging.debug('Attempting to reconnect with database...')
-			self.__connect()
+			with self.pool.connection('read') as conn:
+				cursor = conn.cursor()
+				cursor.execute("SELECT c.channel_name, b.banmask, b.banned_by, b.\"timestamp\", b.reason FROM bans b JOIN channels c ON c.id = b.channel WHERE b.still_banned ORDER BY b.id")
+				rows = cursor.fetchall()
+		except (channellogger_pool.PoolUnavailable, psycopg2.Error) as e:
+			logging.error('Error within load_bans: ' + str(e))
+			return False
+		for (channel, mask, setBy, timestamp, reason) in rows:
+			self.bans.add(channel, mask, setBy, timestamp, reason)
+		return True
 
 	# Probably don't need this actually
 	def get_banned_row_id(self, banmask):
 		try:
-			self.cursor.execute("SELECT id FROM bans WHERE banmask = %s", (banmask,))
-			if self.cursor.rowcount:
-				return self.cursor.fetchone()[0]
+			with self.pool.connection('read') as conn:
+				cursor = conn.cursor()
+				cursor.execute("SELECT id FROM bans WHERE banmask = %s", (banmask,))
+				if cursor.rowcount:
+					return cursor.fetchone()[0]
+
+				return False
+		except (channellogger_pool.PoolUnavailable, psycopg2.Error) as e:
+			logging.error('Error within get_banned_row_id: ' + str(e))
 
-			return False
-		except psycopg2.InterfaceError as e:
-			logging.error('Error within get_banned_row_id: ' + e.message)
-			logging.debug('Attempting to reconnect with database...')
-			self.__connect()
 
+# How each kind of LogEvent reads in the LogviewerFile, after the time.  The
+# kinds left out don't go there.
+FILE_LINES = {
+	'message': lambda event: " <%s> %s\n" % (event.nick, event.content),
+	# Emotes have always been written as the raw CTCP
+	'emote': lambda event: " <%s> \x01ACTION %s\x01\n" % (event.nick, event.content),
+	'join': lambda event: " --> <%s> (%s) joins %s \n" % (event.nick, event.host, event.channel),
+	'part': lambda event: " <-- <%s> (%s) parts %s \n" % (event.nick, event.host, event.channel),
+	'quit': lambda event: " <-- <%s> (%s) quits %s \n" % (event.nick, event.host, event.channel),
+	'kick': lambda event: " %s has kicked %s from %s \n" % (event.nick, event.target, event.channel),
+	'netsplit': lambda event: " <-- Netsplit %s, %s users quit %s: %s \n" % (event.content, len(event.target), event.channel, ' '.join('<%s> (%s)' % (nick, host) for (nick, host, when) in event.target)),
+	'netjoin': lambda event: " --> %s users join %s: %s \n" % (len(event.target), event.channel, ' '.join('<%s> (%s)' % (nick, host) for (nick, host, when) in event.target)),
+	'ban': lambda event: " %s sets mode: %s %s\n" % (event.nick, event.content, event.target),
+	'unban': lambda event: " %s sets mode: %s %s\n" % (event.nick, event.content, event.target),
+}
 
 class LogviewerFile:
 
-	def __init__(self):
+	def __init__(self, flushInterval=5):
 		# Get Logfile Path
-		try:
-			with open('plugins/LogsToDB/config.json') as data:
-				config = json.load(data)
-
-			self.logPath = config['logs']['folderPath']
-		except IOError as e:
-			sys.exit("Error! No config file supplied, please create a config.json file in the root")
+		self.logPath = load_config()['logs']['folderPath']
 
 		# self.all_bytes = string.maketrans('', '')
 
-	def write_message(self, user, msg):
-		time_stamp = time.strftime("%H:%M:%S")
-		dateStamp = time.strftime("%Y-%m-%d")
-		with open(self.logPath + "/%s.log" % dateStamp, 'a') as logFile:
-			msg = "%s <%s> %s\n" % (time_stamp, user, msg)
-			logFile.write(msg)
-
-	def write_join(self, user, host, channel):
-		time_stamp = time.strftime("%H:%M:%S")
-		dateStamp = time.strftime("%Y-%m-%d")
-		with open(self.logPath + "/%s.log" % dateStamp, 'a') as logFile:
-			msg = "%s --> <%s> (%s) joins %s \n" % (time_stamp, user, host, channel)
-			logFile.write(msg)
-
-	def write_part(self, user, host, channel):
-		time_stamp = time.strftime("%H:%M:%S")
-		dateStamp = time.strftime("%Y-%m-%d")
-		with open(self.logPath + "/%s.log" % dateStamp, 'a') as logFile:
-			msg = "%s <-- <%s> (%s) parts %s \n" % (time_stamp, user, host, channel)
-			logFile.write(msg)
-
-	def write_quit(self, user, host, channel):
-		time_stamp = time.strftime("%H:%M:%S")
-		dateStamp = time.strftime("%Y-%m-%d")
-		with open(self.logPath + "/%s.log" % dateStamp, 'a') as logFile:
-			msg = "%s <-- <%s> (%s) quits %s \n" % (time_stamp, user, host, channel)
-			logFile.write(msg)
-
-	def write_kick(self, target, nick, channel):
-		time_stamp = time.strftime("%H:%M:%S")
-		dateStamp = time.strftime("%Y-%m-%d")
-		with open(self.logPath + "/%s.log" % dateStamp, 'a') as logFile:
-			msg = "%s %s has kicked %s from %s \n" % (time_stamp, nick, target, channel)
-			logFile.write(msg)
+		# The day's file stays open until midnight, lines are buffered and
+		# flushed every flushInterval seconds (0 flushes every line)
+		self.flushInterval = flushInterval
+		self.logFile = None
+		self.rollover = 0
+		self.lastFlush = 0
+		self.second = None
+		self.time_stamp = ''
 
-	def write_ban(self, nick, host, mode, target, channel):
-		time_stamp = time.strftime("%H:%M:%S")
-		dateStamp = time.strftime("%Y-%m-%d")
-		with open(self.logPath + "/%s.log" % dateStamp, 'a') as logFile:
-			msg = '%s %s sets mode: %s %s\n' % (time_stamp, nick, mode, target)
-			logFile.write(msg)
+	def flush(self):
+		if self.logFile:
+			self.logFile.flush()
+		self.lastFlush = time.time()
 
-	def write_unban(self, nick, host, mode, target, channel):
-		time_stamp = time.strftime("%H:%M:%S")
-		dateStamp = time.strftime("%Y-%m-%d")
-		with open(self.logPath + "/%s.log" % dateStamp, 'a') as logFile:
-			msg = '%s %s sets mode: %s %s\n' % (time_stamp, nick, mode, target)
-			logFile.write(msg)
+	def close(self):
+		if self.logFile:
+			self.logFile.close()
+			self.logFile = None
+		self.rollover = 0
+
+	def __open(self, now):
+		self.close()
+		today = time.localtime(now)
+		dateStamp = time.strftime("%Y-%m-%d", today)
+		self.logFile = IndexedLog(self.logPath + "/%s.log" % dateStamp)
+		# mktime normalises day + 1 into the next month/year for us
+		self.rollover = time.mktime((today.tm_year, today.tm_mon, today.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+
+	def __timestamp(self, now):
+		# Only format the time once a second, and only check for a new day then.
+		# The time never goes back, an event older than the last line is written
+		# as if it came with it so it doesn't land in a day that's been closed.
+		second = int(now)
+		if self.second is None or second > self.second:
+			self.second = second
+			self.time_stamp = time.strftime("%H:%M:%S", time.localtime(now))
+			if now >= self.rollover:
+				self.__open(now)
+		return self.time_stamp
+
+	def __write(self, msg):
+		self.logFile.write(msg)
+		if self.second - self.lastFlush >= self.flushInterval:
+			self.flush()
+
+	def write_event(self, event):
+		stamp = self.__timestamp(event.time)
+		self.__write(stamp + event.rendered('file', FILE_LINES[event.kind]))
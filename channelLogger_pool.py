@@ -0,0 +1,142 @@
+#!/usr/bin/python
+import contextlib
+import logging
+import random
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+class PoolUnavailable(Exception):
+	pass
+
+class LogviewerPool:
+	# Separate write and read connection pools on top of psycopg2's
+	# ThreadedConnectionPool.  Connections are checked before being handed
+	# out, and while the database is away connecting is only retried after an
+	# exponential, jittered backoff so an outage doesn't turn into a connect
+	# storm.  Callers that can't get a connection get PoolUnavailable.
+
+	def __init__(self, config, writeConnections=2, readConnections=2, checkInterval=30, timeout=5, maxBackoff=60, connectionFactory=None):
+		db = config['db']
+		self.conn_string = "host='%s' dbname='%s' user='%s' password='%s'" % (db['host'], db['dbname'], db['user'], db['password'])
+		self.sizes = {'write': writeConnections, 'read': readConnections}
+		self.checkInterval = checkInterval
+		self.timeout = timeout
+		self.maxBackoff = maxBackoff
+		# psycopg2 connection class, LogviewerMetrics passes one that times queries
+		self.connectionFactory = connectionFactory
+		self.lock = threading.Lock()
+		self.pools = {}
+		self.slots = {}
+		self.lastUsed = {}
+		self.failures = 0
+		self.nextAttempt = 0
+		self.metrics = {}
+		for kind in self.sizes:
+			self.slots[kind] = threading.BoundedSemaphore(self.sizes[kind])
+			self.metrics[kind] = {'size': self.sizes[kind], 'in_use': 0, 'peak': 0, 'waits': 0, 'timeouts': 0, 'discarded': 0}
+		self.metrics['connect_failures'] = 0
+
+	@contextlib.contextmanager
+	def connection(self, kind='write'):
+		"""Lends out a connection of the given kind ('write' or 'read').  A
+		transaction left open by the caller is rolled back when it's returned,
+		and connections that raised a connection error are thrown away."""
+		metrics = self.metrics[kind]
+		if not self.slots[kind].acquire(blocking=False):
+			metrics['waits'] += 1
+			if not self.slots[kind].acquire(timeout=self.timeout):
+				metrics['timeouts'] += 1
+				raise PoolUnavailable('No %s connection free after %s seconds' % (kind, self.timeout))
+		try:
+			conn = self.__get(kind)
+			metrics['in_use'] += 1
+			metrics['peak'] = max(metrics['peak'], metrics['in_use'])
+			try:
+				yield conn
+			except (psycopg2.OperationalError, psycopg2.InterfaceError):
+				self.__discard(kind, conn)
+				conn = None
+				raise
+			finally:
+				metrics['in_use'] -= 1
+				if conn is not None:
+					self.__put(kind, conn)
+		finally:
+			self.slots[kind].release()
+
+	def __get(self, kind):
+		with self.lock:
+			if time.time() < self.nextAttempt:
+				raise PoolUnavailable('Database unavailable, next attempt in %.0f seconds' % (self.nextAttempt - time.time()))
+			if kind not in self.pools:
+				try:
+					self.pools[kind] = psycopg2.pool.ThreadedConnectionPool(0, self.sizes[kind], self.conn_string, connection_factory=self.connectionFactory)
+				except psycopg2.Error as e:
+					self.__failed(e)
+			pool = self.pools[kind]
+		while True:
+			try:
+				conn = pool.getconn()
+			except psycopg2.Error as e:
+				with self.lock:
+					self.__failed(e)
+			if self.__alive(conn):
+				self.failures = 0
+				return conn
+			self.__discard(kind, conn)
+
+	def __failed(self, e):
+		# Double the wait after every failed attempt, up to maxBackoff, and
+		# spread it out so several threads don't all retry at once
+		self.failures += 1
+		self.metrics['connect_failures'] += 1
+		delay = min(self.maxBackoff, 2 ** self.failures) * random.uniform(0.5, 1)
+		self.nextAttempt = time.time() + delay
+		logging.error('Error connecting to database, retrying in %.1f seconds: %s' % (delay, e))
+		raise PoolUnavailable(str(e))
+
+	def __alive(self, conn):
+		if conn.closed:
+			return False
+		# Only bother the server if the connection has been sitting around
+		if time.time() - self.lastUsed.get(id(conn), 0) < self.checkInterval:
+			return True
+		try:
+			cursor = conn.cursor()
+			cursor.execute("SELECT 1")
+			cursor.close()
+			conn.rollback()
+			return True
+		except psycopg2.Error:
+			return False
+
+	def __put(self, kind, conn):
+		try:
+			if conn.status != psycopg2.extensions.STATUS_READY:
+				conn.rollback()
+		except psycopg2.Error:
+			self.__discard(kind, conn)
+			return
+		self.lastUsed[id(conn)] = time.time()
+		self.pools[kind].putconn(conn)
+
+	def __discard(self, kind, conn):
+		self.metrics[kind]['discarded'] += 1
+		self.lastUsed.pop(id(conn), None)
+		try:
+			self.pools[kind].putconn(conn, close=True)
+		except psycopg2.Error:
+			pass
+
+	def stats(self):
+		return dict((kind, dict(value) if isinstance(value, dict) else value) for (kind, value) in self.metrics.items())
+
+	def close(self):
+		with self.lock:
+			for pool in self.pools.values():
+				pool.closeall()
+			self.pools.clear()
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# Recompute the hourly activity rollups from the raw messages and user_count
+# rows, run from the bot's directory:
+#
+#   python plugins/LogsToDB/channelLogger_rollup.py --from 2012-01-01
+#
+# LogviewerDB keeps channel_activity_hourly and channel_users_hourly up to
+# date as it writes, this is for filling in history from before they existed
+# or after raw rows were changed by hand.  The work is split into a shard per
+# channel and day, each replaced in its own transaction, so shards run in
+# parallel and running it again gives the same result.  Today is left alone
+# unless --until says otherwise, the bot is still adding to its rollups.
+# The bot only counts joins in the rollup, so join counts are kept and only
+# raised to what the raw rows say (imported logs have a row per join).
+import argparse
+import concurrent.futures
+import datetime
+import time
+
+try:
+	from . import channelLogger_model as channellogger_model
+	from . import channelLogger_pool as channellogger_pool
+except ImportError:
+	import channelLogger_model as channellogger_model
+	import channelLogger_pool as channellogger_pool
+
+SHARD = [
+	"DELETE FROM channel_activity_hourly WHERE channel_id = %(channel)s AND hour >= %(start)s AND hour < %(end)s AND action <> 'join'",
+	"INSERT INTO channel_activity_hourly (channel_id, hour, \"user\", action, count) SELECT channel_id, date_trunc('hour', \"timestamp\"), \"user\", action, count(*) FROM messages WHERE channel_id = %(channel)s AND \"timestamp\" >= %(start)s AND \"timestamp\" < %(end)s AND \"user\" IS NOT NULL GROUP BY 1, 2, 3, 4 ON CONFLICT (channel_id, hour, \"user\", action) DO UPDATE SET count = greatest(channel_activity_hourly.count, EXCLUDED.count)",
+	"DELETE FROM channel_users_hourly WHERE channel_id = %(channel)s AND hour >= %(start)s AND hour < %(end)s",
+	"INSERT INTO channel_users_hourly (channel_id, hour, samples, total, peak) SELECT channel_id, date_trunc('hour', \"timestamp\"), sum(coalesce(samples, 1)), sum(count * coalesce(samples, 1)), max(coalesce(max_count, count)) FROM user_count WHERE channel_id = %(channel)s AND \"timestamp\" >= %(start)s AND \"timestamp\" < %(end)s GROUP BY 1, 2",
+]
+
+def find_shards(pool, start, until, channel=None):
+	"""Returns a (channel_id, day) for every day from start, or the channel's
+	first logged day if that's later, until the day before until."""
+	shards = []
+	with pool.connection('read') as conn:
+		cursor = conn.cursor()
+		if channel:
+			cursor.execute("SELECT id FROM channels WHERE channel_name = %s", (channel,))
+		else:
+			cursor.execute("SELECT id FROM channels ORDER BY id")
+		for (channel_id,) in cursor.fetchall():
+			# Both use the (channel_id, "timestamp") indexes
+			cursor.execute("SELECT least((SELECT min(\"timestamp\") FROM messages WHERE channel_id = %s), (SELECT min(\"timestamp\") FROM user_count WHERE channel_id = %s))", (channel_id, channel_id))
+			first = cursor.fetchone()[0]
+			if first is None:
+				continue
+			day = max(start, first.date()) if start else first.date()
+			while day < until:
+				shards.append((channel_id, day))
+				day += datetime.timedelta(days=1)
+	return shards
+
+def rebuild_shard(pool, channel_id, day):
+	params = {'channel': channel_id, 'start': day, 'end': day + datetime.timedelta(days=1)}
+	with pool.connection() as conn:
+		cursor = conn.cursor()
+		for statement in SHARD:
+			cursor.execute(statement, params)
+		conn.commit()
+
+def main():
+	parser = argparse.ArgumentParser(description='Rebuild the LogsToDB activity rollups from the raw tables')
+	parser.add_argument('--from', dest='start', help='first day (YYYY-MM-DD), each channel\'s first logged day by default')
+	parser.add_argument('--until', help='day to stop before (YYYY-MM-DD), today by default')
+	parser.add_argument('--channel', help='only rebuild this channel')
+	parser.add_argument('--jobs', type=int, default=4, help='shards rebuilt at once')
+	options = parser.parse_args()
+
+	start = until = None
+	if options.start:
+		start = datetime.datetime.strptime(options.start, '%Y-%m-%d').date()
+	if options.until:
+		until = datetime.datetime.strptime(options.until, '%Y-%m-%d').date()
+	pool = channellogger_pool.LogviewerPool(channellogger_model.load_config(), writeConnections=options.jobs, readConnections=1)
+	shards = find_shards(pool, start, until or datetime.date.today(), options.channel)
+	print('Rebuilding %s channel days' % len(shards))
+
+	began = time.time()
+	failed = 0
+	with concurrent.futures.ThreadPoolExecutor(options.jobs) as executor:
+		futures = dict((executor.submit(rebuild_shard, pool, channel_id, day), (channel_id, day)) for (channel_id, day) in shards)
+		for future in concurrent.futures.as_completed(futures):
+			try:
+				future.result()
+			except Exception as e:
+				(channel_id, day) = futures[future]
+				print('Channel %s on %s: failed, %s' % (channel_id, day, e))
+				failed += 1
+	pool.close()
+	print('Rebuilt %s channel days in %.0f seconds, %s failed' % (len(shards) - failed, time.time() - began, failed))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,313 @@
+#!/usr/bin/python
+# The database schema LogsToDB writes to, as numbered migrations.  From the
+# bot's directory:
+#
+#   python plugins/LogsToDB/channelLogger_schema.py migrate
+#   python plugins/LogsToDB/channelLogger_schema.py partitions --from 2012-01
+#   python plugins/LogsToDB/channelLogger_schema.py sql > logs_stats.sql
+#
+# messages and user_count are range partitioned by month on "timestamp", so
+# time-range queries only touch the months they ask for.  Each partitioned
+# table also has a DEFAULT partition so an insert never fails for want of a
+# month; creating a month's partition later moves its rows out of DEFAULT.
+import argparse
+import datetime
+import re
+import sys
+
+try:
+	from . import channelLogger_model as channellogger_model
+	from . import channelLogger_pool as channellogger_pool
+except ImportError:
+	import channelLogger_model as channellogger_model
+	import channelLogger_pool as channellogger_pool
+
+PARTITIONED = ('messages', 'user_count')
+
+TABLES = [
+	"""CREATE TABLE IF NOT EXISTS channels (
+		id serial PRIMARY KEY,
+		channel_name text NOT NULL
+	)""",
+	"CREATE UNIQUE INDEX IF NOT EXISTS channels_channel_name ON channels (channel_name)",
+	"""CREATE TABLE IF NOT EXISTS users (
+		id serial PRIMARY KEY,
+		"user" text NOT NULL,
+		host text NOT NULL
+	)""",
+	"CREATE UNIQUE INDEX IF NOT EXISTS users_user_host ON users (\"user\", host)",
+	"""CREATE TABLE IF NOT EXISTS messages (
+		id bigserial,
+		"user" integer REFERENCES users (id),
+		content text,
+		action varchar(16) NOT NULL,
+		channel_id integer REFERENCES channels (id),
+		"timestamp" timestamp NOT NULL DEFAULT now(),
+		PRIMARY KEY (id, "timestamp")
+	) PARTITION BY RANGE ("timestamp")""",
+	"CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT",
+	"CREATE INDEX IF NOT EXISTS messages_channel_timestamp ON messages (channel_id, \"timestamp\")",
+	"""CREATE TABLE IF NOT EXISTS user_count (
+		id bigserial,
+		count integer NOT NULL,
+		channel_id integer REFERENCES channels (id),
+		topic text,
+		"timestamp" timestamp NOT NULL DEFAULT now(),
+		PRIMARY KEY (id, "timestamp")
+	) PARTITION BY RANGE ("timestamp")""",
+	"CREATE TABLE IF NOT EXISTS user_count_default PARTITION OF user_count DEFAULT",
+	"CREATE INDEX IF NOT EXISTS user_count_channel_timestamp ON user_count (channel_id, \"timestamp\")",
+	"""CREATE TABLE IF NOT EXISTS bans (
+		id serial PRIMARY KEY,
+		banmask text NOT NULL,
+		banned_by text,
+		channel integer REFERENCES channels (id),
+		reason text,
+		still_banned boolean NOT NULL DEFAULT TRUE,
+		"timestamp" timestamp NOT NULL DEFAULT now()
+	)""",
+	"CREATE INDEX IF NOT EXISTS bans_channel_banmask ON bans (channel, banmask)",
+	"""CREATE TABLE IF NOT EXISTS spool_replay (
+		segment text PRIMARY KEY,
+		"offset" bigint NOT NULL
+	)""",
+]
+
+def columns(cursor, table):
+	cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = %s ORDER BY ordinal_position", (table,))
+	return [row[0] for row in cursor.fetchall()]
+
+def baseline(cursor):
+	# Databases set up from the old logs_stats.sql already have plain messages
+	# and user_count tables.  Those are renamed out of the way, the
+	# partitioned ones created, and their rows copied across.
+	legacy = []
+	for table in PARTITIONED:
+		cursor.execute("SELECT c.relkind FROM pg_class c WHERE c.oid = to_regclass(%s)", (table,))
+		row = cursor.fetchone()
+		if row and row[0] == 'r':
+			cursor.execute("ALTER TABLE %s RENAME TO %s_unpartitioned" % (table, table))
+			legacy.append(table)
+	for statement in TABLES:
+		cursor.execute(statement)
+	for table in legacy:
+		old = table + '_unpartitioned'
+		cursor.execute("SELECT min(\"timestamp\") FROM %s" % old)
+		first = cursor.fetchone()[0]
+		if first is not None:
+			ensure_partitions(cursor, 0, first.date())
+		shared = ', '.join('"%s"' % column for column in columns(cursor, old) if column in columns(cursor, table))
+		cursor.execute("INSERT INTO %s (%s) SELECT %s FROM %s" % (table, shared, shared, old))
+		cursor.execute("SELECT setval(pg_get_serial_sequence(%s, 'id'), coalesce(max(id), 1)) FROM " + table, (table,))
+		print('Copied %s into the partitioned %s, drop it once you are happy with the result' % (old, table))
+
+# (version, description, statements or a function taking a cursor)
+MIGRATIONS = [
+	(1, 'Tables, partitioned by month where they grow with time', baseline),
+	(2, 'Full-text search over messages.content', [
+		# Has to be the exact expression LogviewerDB.search uses
+		"CREATE INDEX IF NOT EXISTS messages_content_search ON messages USING gin (to_tsvector('simple', coalesce(content, '')))",
+	]),
+	# Kept up to date by LogviewerDB.write_batch, fill in the history with
+	# channelLogger_rollup.py
+	(3, 'Hourly per-channel activity rollups', [
+		"""CREATE TABLE IF NOT EXISTS channel_activity_hourly (
+			channel_id integer NOT NULL REFERENCES channels (id),
+			hour timestamp NOT NULL,
+			"user" integer NOT NULL REFERENCES users (id),
+			action varchar(16) NOT NULL,
+			count integer NOT NULL,
+			PRIMARY KEY (channel_id, hour, "user", action)
+		)""",
+		"""CREATE TABLE IF NOT EXISTS channel_users_hourly (
+			channel_id integer NOT NULL REFERENCES channels (id),
+			hour timestamp NOT NULL,
+			samples integer NOT NULL,
+			total bigint NOT NULL,
+			peak integer NOT NULL,
+			PRIMARY KEY (channel_id, hour)
+		)""",
+	]),
+	# Loading the active bans at startup and marking one lifted
+	(4, 'Index of active bans', [
+		"CREATE INDEX IF NOT EXISTS bans_active ON bans (channel, banmask) WHERE still_banned",
+	]),
+	# user_count rows now sum up many samples, count being their average, and
+	# topics are only written when they change
+	(5, 'User count aggregates and topic history', [
+		"ALTER TABLE user_count ADD COLUMN IF NOT EXISTS min_count integer, ADD COLUMN IF NOT EXISTS max_count integer, ADD COLUMN IF NOT EXISTS samples integer",
+		"""CREATE TABLE IF NOT EXISTS channel_topics (
+			id serial PRIMARY KEY,
+			channel_id integer NOT NULL REFERENCES channels (id),
+			topic text,
+			"timestamp" timestamp NOT NULL DEFAULT now()
+		)""",
+		"CREATE INDEX IF NOT EXISTS channel_topics_channel_timestamp ON channel_topics (channel_id, \"timestamp\")",
+	]),
+	# users was a row per nick and host, both as text and both in its unique
+	# index.  Nicks and hosts now get a row each in their own table, unique on
+	# a 16 byte hash rather than the text, and identities (the old users, IDs
+	# kept so nothing pointing at them changes) is just the pair of their IDs.
+	# Look one up with md5(nick)::uuid = md5(%s)::uuid so the index is used.
+	# users is now a view with the old columns for anything else reading
+	# them.  The dropped text columns' space comes back once identities is
+	# rewritten, e.g. by VACUUM FULL.
+	(6, 'Interned nicks and hosts', [
+		"""CREATE TABLE IF NOT EXISTS nicks (
+			id serial PRIMARY KEY,
+			nick text NOT NULL
+		)""",
+		"CREATE UNIQUE INDEX IF NOT EXISTS nicks_nick ON nicks ((md5(nick)::uuid))",
+		"""CREATE TABLE IF NOT EXISTS hosts (
+			id serial PRIMARY KEY,
+			host text NOT NULL
+		)""",
+		"CREATE UNIQUE INDEX IF NOT EXISTS hosts_host ON hosts ((md5(host)::uuid))",
+		"INSERT INTO nicks (nick) SELECT DISTINCT \"user\" FROM users ON CONFLICT DO NOTHING",
+		"INSERT INTO hosts (host) SELECT DISTINCT host FROM users ON CONFLICT DO NOTHING",
+		"ALTER TABLE users RENAME TO identities",
+		"ALTER TABLE identities ADD COLUMN nick_id integer REFERENCES nicks (id), ADD COLUMN host_id integer REFERENCES hosts (id)",
+		"UPDATE identities i SET nick_id = n.id, host_id = h.id FROM nicks n, hosts h WHERE md5(n.nick)::uuid = md5(i.\"user\")::uuid AND md5(h.host)::uuid = md5(i.host)::uuid",
+		"ALTER TABLE identities ALTER COLUMN nick_id SET NOT NULL, ALTER COLUMN host_id SET NOT NULL, DROP COLUMN \"user\", DROP COLUMN host",
+		"CREATE UNIQUE INDEX IF NOT EXISTS identities_nick_host ON identities (nick_id, host_id)",
+		# Left joins so queries only using one of the two skip the other
+		"""CREATE OR REPLACE VIEW users AS
+			SELECT i.id, n.nick AS "user", h.host
+			FROM identities i LEFT JOIN nicks n ON n.id = i.nick_id LEFT JOIN hosts h ON h.id = i.host_id""",
+	]),
+	# Emotes used to be stored as messages with their CTCP wrapper, now they're
+	# action 'emote' with just the text.  The old rows are rewritten the same
+	# way and their hourly counts moved from 'message' to 'emote', where there
+	# are rollups for them.
+	(7, 'Emotes as their own action', [
+		"""WITH moved AS (
+			UPDATE messages SET action = 'emote', content = rtrim(substr(content, 9), E'\\x01')
+			WHERE action = 'message' AND left(content, 8) = E'\\x01ACTION '
+			RETURNING channel_id, date_trunc('hour', "timestamp") AS hour, "user"
+		), counts AS (
+			SELECT channel_id, hour, "user", count(*) AS count FROM moved WHERE "user" IS NOT NULL GROUP BY 1, 2, 3
+		), taken AS (
+			UPDATE channel_activity_hourly a SET count = a.count - c.count FROM counts c
+			WHERE a.channel_id = c.channel_id AND a.hour = c.hour AND a."user" = c."user" AND a.action = 'message'
+			RETURNING a.channel_id, a.hour, a."user", c.count
+		)
+		INSERT INTO channel_activity_hourly (channel_id, hour, "user", action, count)
+		SELECT channel_id, hour, "user", 'emote', count FROM taken
+		ON CONFLICT (channel_id, hour, "user", action) DO UPDATE SET count = channel_activity_hourly.count + EXCLUDED.count""",
+		"DELETE FROM channel_activity_hourly WHERE action = 'message' AND count <= 0",
+	]),
+]
+
+def month_start(day):
+	return datetime.date(day.year, day.month, 1)
+
+def next_month(month):
+	if month.month == 12:
+		return datetime.date(month.year + 1, 1, 1)
+	return datetime.date(month.year, month.month + 1, 1)
+
+def partition_name(table, month):
+	return '%s_%04d_%02d' % (table, month.year, month.month)
+
+def create_partition(cursor, table, month):
+	"""Creates table's partition for the month starting at month, moving any
+	rows for it out of the DEFAULT partition.  Does nothing if it exists."""
+	name = partition_name(table, month)
+	cursor.execute("SELECT to_regclass(%s)", (name,))
+	if cursor.fetchone()[0] is not None:
+		return False
+	end = next_month(month)
+	# Nothing may insert the month's rows into DEFAULT between moving them and
+	# the ATTACH, which would fail on finding them there.  ATTACH needs this
+	# lock on DEFAULT anyway, and what it then takes on the parent doesn't
+	# conflict with inserts, so taking it first can't deadlock them.
+	cursor.execute("LOCK TABLE %s_default IN ACCESS EXCLUSIVE MODE" % table)
+	cursor.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS)" % (name, table))
+	cursor.execute("WITH moved AS (DELETE FROM %s_default WHERE \"timestamp\" >= %%s AND \"timestamp\" < %%s RETURNING *) INSERT INTO %s SELECT * FROM moved" % (table, name), (month, end))
+	cursor.execute("ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (%%s) TO (%%s)" % (table, name), (month, end))
+	return True
+
+def ensure_partitions(cursor, monthsAhead=3, start=None):
+	"""Makes sure every partitioned table has partitions from start (this month
+	by default) until monthsAhead months from now."""
+	today = datetime.date.today()
+	month = month_start(start or today)
+	last = month_start(today)
+	for i in range(monthsAhead):
+		last = next_month(last)
+	created = []
+	while month <= last:
+		for table in PARTITIONED:
+			if create_partition(cursor, table, month):
+				created.append(partition_name(table, month))
+		month = next_month(month)
+	return created
+
+def current_version(cursor):
+	cursor.execute("CREATE TABLE IF NOT EXISTS schema_version (version integer PRIMARY KEY, description text, applied timestamp NOT NULL DEFAULT now())")
+	cursor.execute("SELECT max(version) FROM schema_version")
+	return cursor.fetchone()[0] or 0
+
+def migrate(conn):
+	"""Applies the migrations the database doesn't have yet, each in its own
+	transaction, and returns the versions applied."""
+	cursor = conn.cursor()
+	version = current_version(cursor)
+	conn.commit()
+	applied = []
+	for (number, description, steps) in MIGRATIONS:
+		if number <= version:
+			continue
+		if callable(steps):
+			steps(cursor)
+		else:
+			for statement in steps:
+				cursor.execute(statement)
+		cursor.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)", (number, description))
+		conn.commit()
+		applied.append(number)
+	return applied
+
+def sql():
+	"""The whole schema as one SQL script, for setting a database up by hand."""
+	lines = []
+	for (number, description, steps) in MIGRATIONS:
+		lines.append('-- %s: %s' % (number, description))
+		if steps is baseline:
+			steps = TABLES
+		elif callable(steps):
+			lines.append('-- (applied by channelLogger_schema.py migrate)')
+			continue
+		for statement in steps:
+			lines.append(re.sub(r'\n\t+\)', '\n)', re.sub(r'\n\t+', '\n\t', statement)) + ';')
+	return '\n'.join(lines) + '\n'
+
+def main():
+	parser = argparse.ArgumentParser(description='LogsToDB database schema')
+	commands = parser.add_subparsers(dest='command')
+	commands.required = True
+	commands.add_parser('migrate', help='bring the database up to date')
+	partitions = commands.add_parser('partitions', help='create monthly partitions')
+	partitions.add_argument('--from', dest='start', help='first month (YYYY-MM), this month by default')
+	partitions.add_argument('--ahead', type=int, default=3, help='months past this one to create')
+	commands.add_parser('sql', help='print the schema as SQL')
+	args = parser.parse_args()
+
+	if args.command == 'sql':
+		sys.stdout.write(sql())
+		return
+	pool = channellogger_pool.LogviewerPool(channellogger_model.load_config())
+	with pool.connection() as conn:
+		if args.command == 'migrate':
+			applied = migrate(conn)
+			print('Applied migrations: %s' % (', '.join(map(str, applied)) or 'none'))
+		start = None
+		if getattr(args, 'start', None):
+			start = datetime.datetime.strptime(args.start, '%Y-%m').date()
+		created = ensure_partitions(conn.cursor(), getattr(args, 'ahead', 3), start)
+		conn.commit()
+		print('Created partitions: %s' % (', '.join(created) or 'none'))
+	pool.close()
+
+if __name__ == '__main__':
+	main()
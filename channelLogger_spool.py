@@ -0,0 +1,96 @@
+#!/usr/bin/python
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+# Every record is its length and crc32 followed by the JSON encoded event, a
+# torn write at the end of a segment shows up as a short or corrupt record
+HEADER = struct.Struct('>II')
+
+class LogviewerSpool:
+	# Append-only segment files holding events the database couldn't take.
+	# New events always go to the newest segment, replay only ever reads
+	# segments that have been closed, so the two never share a file.
+
+	def __init__(self, directory, fsync='interval', fsyncInterval=1, segmentSize=64 * 1024 * 1024):
+		self.directory = directory
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+		self.fsync = fsync
+		self.fsyncInterval = fsyncInterval
+		self.segmentSize = segmentSize
+		self.lock = threading.Lock()
+		self.segment = None
+		self.lastSync = 0
+		self.segments = sorted(name for name in os.listdir(directory) if name.endswith('.spool'))
+
+	def pending(self):
+		return bool(self.segments) or self.segment is not None
+
+	def append(self, events):
+		with self.lock:
+			if self.segment is None:
+				name = '%020d.spool' % time.time_ns()
+				self.segment = open(os.path.join(self.directory, name), 'ab')
+				self.segments.append(name)
+			for event in events:
+				data = json.dumps(event).encode('utf-8')
+				self.segment.write(HEADER.pack(len(data), zlib.crc32(data)))
+				self.segment.write(data)
+			self.segment.flush()
+			now = time.time()
+			if self.fsync == 'always' or (self.fsync == 'interval' and now - self.lastSync >= self.fsyncInterval):
+				os.fsync(self.segment.fileno())
+				self.lastSync = now
+			if self.segment.tell() >= self.segmentSize:
+				self.__close_segment()
+
+	def __close_segment(self):
+		if self.segment is not None:
+			if self.fsync != 'never':
+				os.fsync(self.segment.fileno())
+			self.segment.close()
+			self.segment = None
+
+	def close(self):
+		with self.lock:
+			self.__close_segment()
+
+	def oldest(self):
+		# Hand out the oldest closed segment, closing the one being appended to
+		# if it's all that's left
+		with self.lock:
+			if not self.segments:
+				return None
+			if len(self.segments) == 1:
+				self.__close_segment()
+			return self.segments[0]
+
+	def read(self, name, offset, limit):
+		"""Returns up to limit events from segment name starting at byte offset,
+		along with the offset just after the last one."""
+		events = []
+		with open(os.path.join(self.directory, name), 'rb') as segment:
+			segment.seek(offset)
+			while len(events) < limit:
+				header = segment.read(HEADER.size)
+				if len(header) < HEADER.size:
+					break
+				(length, crc) = HEADER.unpack(header)
+				data = segment.read(length)
+				if len(data) < length or zlib.crc32(data) != crc:
+					logging.error('Spool segment %s is damaged at offset %s, ignoring the rest of it' % (name, offset))
+					break
+				(kind, timestamp, args) = json.loads(data.decode('utf-8'))
+				events.append((kind, timestamp, tuple(args)))
+				offset = segment.tell()
+		return (events, offset)
+
+	def remove(self, name):
+		with self.lock:
+			os.remove(os.path.join(self.directory, name))
+			self.segments.remove(name)
@@ -0,0 +1,302 @@
+#!/usr/bin/python
+# An embedded storage backend for LogsToDB, for a bot that doesn't want a
+# Postgres server to look after.  Set supybot.plugins.LogsToDB.backend to
+# sqlite, or from a script:
+#
+#   db = SQLiteDB('data/LogsToDB.sqlite3')
+#
+# The tables mirror the Postgres ones (without the partitions, the archive
+# and full-text search) and are created when the file is opened.  It runs in
+# WAL mode, so the commands' reads never wait on the writer, with
+# synchronous=NORMAL, so a commit is a write to the WAL rather than an fsync;
+# the last few batches can be lost to a power cut but never to the bot
+# crashing.  Every statement is prepared once and kept in sqlite3's statement
+# cache, and a batch is one transaction like with Postgres.
+import contextlib
+import datetime
+import logging
+import sqlite3
+import threading
+import time
+
+try:
+	from . import channelLogger_model as channellogger_model
+except ImportError:
+	import channelLogger_model as channellogger_model
+
+TABLES = [
+	"CREATE TABLE IF NOT EXISTS channels (id INTEGER PRIMARY KEY, channel_name TEXT NOT NULL UNIQUE)",
+	"CREATE TABLE IF NOT EXISTS nicks (id INTEGER PRIMARY KEY, nick TEXT NOT NULL UNIQUE)",
+	"CREATE TABLE IF NOT EXISTS hosts (id INTEGER PRIMARY KEY, host TEXT NOT NULL UNIQUE)",
+	"CREATE TABLE IF NOT EXISTS identities (id INTEGER PRIMARY KEY, nick_id INTEGER NOT NULL REFERENCES nicks (id), host_id INTEGER NOT NULL REFERENCES hosts (id), UNIQUE (nick_id, host_id))",
+	"""CREATE VIEW IF NOT EXISTS users AS
+		SELECT i.id, n.nick AS "user", h.host
+		FROM identities i LEFT JOIN nicks n ON n.id = i.nick_id LEFT JOIN hosts h ON h.id = i.host_id""",
+	"""CREATE TABLE IF NOT EXISTS messages (
+		id INTEGER PRIMARY KEY,
+		"user" INTEGER REFERENCES identities (id),
+		content TEXT,
+		action TEXT NOT NULL,
+		channel_id INTEGER REFERENCES channels (id),
+		"timestamp" TEXT NOT NULL
+	)""",
+	"CREATE INDEX IF NOT EXISTS messages_channel_timestamp ON messages (channel_id, \"timestamp\")",
+	"""CREATE TABLE IF NOT EXISTS user_count (
+		id INTEGER PRIMARY KEY,
+		count INTEGER NOT NULL,
+		channel_id INTEGER REFERENCES channels (id),
+		topic TEXT,
+		"timestamp" TEXT NOT NULL,
+		min_count INTEGER,
+		max_count INTEGER,
+		samples INTEGER
+	)""",
+	"CREATE INDEX IF NOT EXISTS user_count_channel_timestamp ON user_count (channel_id, \"timestamp\")",
+	"""CREATE TABLE IF NOT EXISTS channel_topics (
+		id INTEGER PRIMARY KEY,
+		channel_id INTEGER NOT NULL REFERENCES channels (id),
+		topic TEXT,
+		"timestamp" TEXT NOT NULL
+	)""",
+	"""CREATE TABLE IF NOT EXISTS channel_activity_hourly (
+		channel_id INTEGER NOT NULL REFERENCES channels (id),
+		hour TEXT NOT NULL,
+		"user" INTEGER NOT NULL REFERENCES identities (id),
+		action TEXT NOT NULL,
+		count INTEGER NOT NULL,
+		PRIMARY KEY (channel_id, hour, "user", action)
+	) WITHOUT ROWID""",
+	"""CREATE TABLE IF NOT EXISTS channel_users_hourly (
+		channel_id INTEGER NOT NULL REFERENCES channels (id),
+		hour TEXT NOT NULL,
+		samples INTEGER NOT NULL,
+		total INTEGER NOT NULL,
+		peak INTEGER NOT NULL,
+		PRIMARY KEY (channel_id, hour)
+	) WITHOUT ROWID""",
+	"""CREATE TABLE IF NOT EXISTS bans (
+		id INTEGER PRIMARY KEY,
+		banmask TEXT NOT NULL,
+		banned_by TEXT,
+		channel INTEGER REFERENCES channels (id),
+		reason TEXT,
+		still_banned INTEGER NOT NULL DEFAULT 1,
+		"timestamp" TEXT NOT NULL
+	)""",
+	"CREATE INDEX IF NOT EXISTS bans_active ON bans (channel, banmask) WHERE still_banned",
+	"CREATE TABLE IF NOT EXISTS spool_replay (segment TEXT PRIMARY KEY, \"offset\" INTEGER NOT NULL)",
+]
+
+# Times are kept as text, always with microseconds so they sort as they compare
+def to_text(timestamp):
+	return timestamp.isoformat(' ', 'microseconds')
+
+def from_text(text):
+	return None if text is None else datetime.datetime.fromisoformat(text)
+
+class SQLiteDB(channellogger_model.LogviewerStorage):
+	# Busy and I/O errors are OperationalError, they're worth spooling for
+	unavailableErrors = (sqlite3.OperationalError,)
+	errors = (sqlite3.Error,)
+
+	def __init__(self, path, cacheSize=50000, spool=None, replayBatch=1000, timeout=5.0):
+		super().__init__(cacheSize, spool, replayBatch)
+		self.path = path
+		self.timeout = timeout
+		# One connection for writing, used by one thread at a time
+		self.lock = threading.Lock()
+		self.conn = self.connect()
+		self.conn.execute("PRAGMA journal_mode = WAL")
+		with self.transaction() as cursor:
+			for statement in TABLES:
+				cursor.execute(statement)
+
+	def connect(self):
+		conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False, cached_statements=256)
+		conn.execute("PRAGMA synchronous = NORMAL")
+		return conn
+
+	def close(self):
+		super().close()
+		with self.lock:
+			self.conn.close()
+
+	@contextlib.contextmanager
+	def transaction(self):
+		with self.lock:
+			cursor = self.conn.cursor()
+			# IMMEDIATE takes the write lock now rather than failing halfway
+			cursor.execute("BEGIN IMMEDIATE")
+			try:
+				yield cursor
+				cursor.execute("COMMIT")
+			except BaseException:
+				if self.conn.in_transaction:
+					self.conn.execute("ROLLBACK")
+				raise
+
+	@contextlib.contextmanager
+	def reader(self):
+		# WAL lets readers run alongside the writer, each on a connection of its
+		# own.  An in-memory database only exists on the one connection.
+		if self.path == ':memory:':
+			with self.lock:
+				yield self.conn
+			return
+		conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+		try:
+			yield conn
+		finally:
+			conn.close()
+
+	def get_marker(self, segment):
+		"""Returns the offset saved by write_batch for segment, 0 if there is none."""
+		with self.reader() as conn:
+			row = conn.execute("SELECT \"offset\" FROM spool_replay WHERE segment = ?", (segment,)).fetchone()
+			return row[0] if row else 0
+
+	def set_marker(self, cursor, marker):
+		cursor.execute("INSERT INTO spool_replay (segment, \"offset\") VALUES (?, ?) ON CONFLICT (segment) DO UPDATE SET \"offset\" = excluded.\"offset\"", marker)
+
+	def clear_marker(self, cursor, segment):
+		cursor.execute("DELETE FROM spool_replay WHERE segment = ?", (segment,))
+
+	# The ID of value in table, adding it if it's new.  Nothing is written for
+	# values already there, unlike an upsert, and unlike INSERT OR IGNORE a
+	# NULL is still an error.
+	def intern(self, cursor, cache, table, column, value):
+		id = cache.get(value)
+		if id is None:
+			cursor.execute("INSERT INTO %s (%s) VALUES (?) ON CONFLICT (%s) DO NOTHING" % (table, column, column), (value,))
+			id = cursor.execute("SELECT id FROM %s WHERE %s = ?" % (table, column), (value,)).fetchone()[0]
+			self.remember(cache, value, id)
+		return id
+
+	# There's no round trip to save, so users are added one at a time as they
+	# come up rather than by resolve_users
+	def get_user_id(self, cursor, user, host):
+		nick_id = self.intern(cursor, self.nickCache, 'nicks', 'nick', user)
+		host_id = self.intern(cursor, self.hostCache, 'hosts', 'host', host)
+		userID = self.userCache.get((nick_id, host_id))
+		if userID is None:
+			cursor.execute("INSERT INTO identities (nick_id, host_id) VALUES (?, ?) ON CONFLICT (nick_id, host_id) DO NOTHING", (nick_id, host_id))
+			userID = cursor.execute("SELECT id FROM identities WHERE nick_id = ? AND host_id = ?", (nick_id, host_id)).fetchone()[0]
+			self.remember(self.userCache, (nick_id, host_id), userID)
+		return userID
+
+	def get_channel_id(self, cursor, channel):
+		return self.intern(cursor, self.channelCache, 'channels', 'channel_name', channel)
+
+	def write_messages(self, cursor, rows):
+		cursor.executemany("INSERT INTO messages (\"user\", content, action, channel_id, \"timestamp\") VALUES (?, ?, ?, ?, ?)", [(user, content, action, channel_id, to_text(timestamp)) for (user, content, action, channel_id, timestamp) in rows])
+
+	def write_activity(self, cursor, activity):
+		cursor.executemany("INSERT INTO channel_activity_hourly (channel_id, hour, \"user\", action, count) VALUES (?, ?, ?, ?, ?) ON CONFLICT (channel_id, hour, \"user\", action) DO UPDATE SET count = count + excluded.count", [(channel_id, to_text(hour), user, action, count) for ((channel_id, hour, user, action), count) in sorted(activity.items())])
+
+	def _write_counts(self, cursor, timestamp, samples):
+		(rows, hourly) = self.count_rows(cursor, samples)
+		cursor.executemany("INSERT INTO user_count (count, channel_id, \"timestamp\", min_count, max_count, samples) VALUES (?, ?, ?, ?, ?, ?)", [(count, channel_id, to_text(last), low, high, n) for (count, channel_id, last, low, high, n) in rows])
+		cursor.executemany("INSERT INTO channel_users_hourly (channel_id, hour, samples, total, peak) VALUES (?, ?, ?, ?, ?) ON CONFLICT (channel_id, hour) DO UPDATE SET samples = samples + excluded.samples, total = total + excluded.total, peak = max(peak, excluded.peak)", [(channel_id, to_text(hour), n, total, peak) for ((channel_id, hour), (n, total, peak)) in sorted(hourly.items())])
+
+	# A single sample, from events spooled before add_counts
+	def _write_count(self, cursor, timestamp, count, channel, topic):
+		self._write_counts(cursor, timestamp, [(channel, timestamp, timestamp, int(count), int(count), int(count), 1)])
+		self._write_topic(cursor, timestamp, topic, channel)
+
+	def _write_topic(self, cursor, timestamp, topic, channel):
+		channel_id = self.get_channel_id(cursor, channel)
+		cursor.execute("INSERT INTO channel_topics (channel_id, topic, \"timestamp\") VALUES (?, ?, ?)", (channel_id, topic, to_text(datetime.datetime.fromtimestamp(timestamp))))
+
+	def _write_ban(self, cursor, timestamp, nick, host, mode, target, channel):
+		channel_id = self.get_channel_id(cursor, channel)
+		(banmask, forwarded_channel) = channellogger_model.split_forward(target)
+		reason = "Join/Quit flood, user forwarded to " + forwarded_channel if forwarded_channel else None
+		cursor.execute("INSERT INTO bans (banmask, banned_by, channel, reason, \"timestamp\") VALUES (?, ?, ?, ?, ?)", (banmask, nick, channel_id, reason, to_text(datetime.datetime.fromtimestamp(timestamp))))
+
+	def _write_unban(self, cursor, timestamp, nick, host, mode, target, channel):
+		channel_id = self.get_channel_id(cursor, channel)
+		cursor.execute("UPDATE bans SET still_banned = 0 WHERE channel = ? AND banmask = ? AND still_banned", (channel_id, channellogger_model.split_forward(target)[0]))
+
+	# LogviewerDB.search without the full-text index, every word of terms has
+	# to be somewhere in the message.  timeout (in milliseconds) is enforced
+	# with a progress handler instead of statement_timeout.
+	def search(self, terms, channel=None, nick=None, since=None, until=None, before=None, limit=10, timeout=5000):
+		query = ["SELECT m.id, m.\"timestamp\", c.channel_name, n.nick, m.content FROM messages m JOIN channels c ON c.id = m.channel_id JOIN identities i ON i.id = m.\"user\" JOIN nicks n ON n.id = i.nick_id WHERE m.content IS NOT NULL"]
+		params = []
+		for word in terms.split():
+			query.append("instr(lower(m.content), ?)")
+			params.append(word.lower())
+		if channel is not None:
+			query.append("c.channel_name = ?")
+			params.append(channel)
+		if nick is not None:
+			query.append("n.nick = ?")
+			params.append(nick)
+		if since is not None:
+			query.append("m.\"timestamp\" >= ?")
+			params.append(to_text(since))
+		if until is not None:
+			query.append("m.\"timestamp\" < ?")
+			params.append(to_text(until))
+		if before is not None:
+			query.append("(m.\"timestamp\", m.id) < (?, ?)")
+			params.extend((to_text(before[0]), before[1]))
+		params.append(limit)
+		deadline = time.monotonic() + timeout / 1000.0
+		with self.reader() as conn:
+			conn.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+			try:
+				rows = conn.execute(' AND '.join(query) + " ORDER BY m.\"timestamp\" DESC, m.id DESC LIMIT ?", params).fetchall()
+			finally:
+				conn.set_progress_handler(None, 0)
+		return [(id, from_text(timestamp), channel, nick, content) for (id, timestamp, channel, nick, content) in rows]
+
+	# Like LogviewerDB.iter_messages, there's no archive here.  sqlite3 steps
+	# through the rows as they're asked for, itersize is only for the same
+	# call to work on both.
+	def iter_messages(self, channel, since=None, until=None, nick=None, action=None, itersize=2000):
+		query = ["SELECT m.id, m.\"timestamp\", m.\"user\", n.nick, m.action, m.content FROM messages m LEFT JOIN identities i ON i.id = m.\"user\" LEFT JOIN nicks n ON n.id = i.nick_id WHERE m.channel_id = (SELECT id FROM channels WHERE channel_name = ?)"]
+		params = [channel]
+		if since is not None:
+			query.append("m.\"timestamp\" >= ?")
+			params.append(to_text(since))
+		if until is not None:
+			query.append("m.\"timestamp\" < ?")
+			params.append(to_text(until))
+		if nick is not None:
+			query.append("n.nick = ?")
+			params.append(nick)
+		if action is not None:
+			query.append("m.action = ?")
+			params.append(action)
+		with self.reader() as conn:
+			for (id, timestamp, user, nick, action, content) in conn.execute(' AND '.join(query) + " ORDER BY m.\"timestamp\", m.id", params):
+				yield (id, from_text(timestamp), user, nick, action, content)
+
+	def activity_stats(self, channel, since, talkers=5):
+		with self.reader() as conn:
+			row = conn.execute("SELECT id FROM channels WHERE channel_name = ?", (channel,)).fetchone()
+			if row is None:
+				return None
+			params = (row[0], to_text(since))
+			stats = {}
+			stats['actions'] = dict(conn.execute("SELECT action, sum(count) FROM channel_activity_hourly WHERE channel_id = ? AND hour >= ? GROUP BY action", params).fetchall())
+			busiest = conn.execute("SELECT hour, sum(count) FROM channel_activity_hourly WHERE channel_id = ? AND hour >= ? AND action IN ('message', 'emote') GROUP BY hour ORDER BY 2 DESC, hour DESC LIMIT 1", params).fetchone()
+			stats['busiest'] = busiest and (from_text(busiest[0]), busiest[1])
+			stats['talkers'] = conn.execute("SELECT n.nick, sum(a.count) FROM channel_activity_hourly a JOIN identities i ON i.id = a.\"user\" JOIN nicks n ON n.id = i.nick_id WHERE a.channel_id = ? AND a.hour >= ? AND a.action IN ('message', 'emote') GROUP BY n.id ORDER BY 2 DESC LIMIT ?", params + (talkers,)).fetchall()
+			(average, peak) = conn.execute("SELECT CAST(round(CAST(sum(total) AS REAL) / nullif(sum(samples), 0)) AS INTEGER), max(peak) FROM channel_users_hourly WHERE channel_id = ? AND hour >= ?", params).fetchone()
+			stats['users'] = (average, peak)
+			return stats
+
+	def load_bans(self):
+		"""Fills self.bans with the bans the database has as still active.
+		Returns whether it could."""
+		try:
+			with self.reader() as conn:
+				rows = conn.execute("SELECT c.channel_name, b.banmask, b.banned_by, b.\"timestamp\", b.reason FROM bans b JOIN channels c ON c.id = b.channel WHERE b.still_banned ORDER BY b.id").fetchall()
+		except sqlite3.Error as e:
+			logging.error('Error within load_bans: ' + str(e))
+			return False
+		for (channel, mask, setBy, timestamp, reason) in rows:
+			self.bans.add(channel, mask, setBy, from_text(timestamp), reason)
+		return True
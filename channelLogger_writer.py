@@ -0,0 +1,152 @@
+#!/usr/bin/python
+import logging
+import queue
+import threading
+import time
+import zlib
+
+try:
+	from . import channelLogger_model as channellogger_model
+except ImportError:
+	import channelLogger_model as channellogger_model
+
+class LogviewerWriter(channellogger_model.LogviewerEvents):
+	# Takes the same calls as LogviewerDB but only queues them, a background
+	# thread drains the queue and hands whole batches to LogviewerDB.write_batch
+	# so the bot never waits on the database.
+
+	def __init__(self, db, queueSize=10000, batchSize=500, batchDelay=1.0, name='LogsToDB writer'):
+		self.db = db
+		self.queue = queue.Queue(queueSize)
+		self.batchSize = batchSize
+		self.batchDelay = batchDelay
+		self.dropped = 0
+		self.flushing = threading.Event()
+		self.closing = False
+		self.stopped = False
+		self.thread = threading.Thread(target=self.run, name=name)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def write_event(self, kind, args, timestamp=None):
+		if timestamp is None:
+			timestamp = time.time()
+		try:
+			self.queue.put_nowait((kind, timestamp, args))
+		except queue.Full:
+			# Never block the bot, losing a line is better than stalling every channel
+			self.dropped += 1
+			logging.error('Writer queue is full, dropped %s event (%s dropped so far)' % (kind, self.dropped))
+
+	def qsize(self):
+		return self.queue.qsize()
+
+	def flush(self):
+		# Ask the worker to write what it has now instead of waiting for batchDelay
+		self.flushing.set()
+
+	def stop(self):
+		# Let the worker finish what's queued and exit, without waiting for it
+		if not self.stopped:
+			self.stopped = True
+			self.queue.put(None)
+			self.flushing.set()
+
+	def join(self, timeout=30):
+		self.thread.join(timeout)
+		if self.thread.is_alive():
+			logging.error('Writer did not finish within %s seconds, %s events left unwritten' % (timeout, self.queue.qsize()))
+			return False
+		return True
+
+	def close(self, timeout=30):
+		self.stop()
+		if self.join(timeout):
+			self.db.close()
+
+	def run(self):
+		replaying = False
+		while not self.closing:
+			batch = self.next_batch(wait=not replaying)
+			if batch:
+				self.db.write_batch(batch)
+			# Catch up on anything spooled while the database was away, a batch at
+			# a time in between new events so they don't queue up behind it
+			replaying = self.db.replay_spool()
+
+	def next_batch(self, wait=True):
+		# Wait for the first event, then keep collecting until the batch is full,
+		# batchDelay has passed since that first event or a flush was asked for
+		try:
+			event = self.queue.get(timeout=self.batchDelay if wait else 0)
+		except queue.Empty:
+			self.flushing.clear()
+			return []
+		batch = []
+		deadline = time.time() + self.batchDelay
+		while event is not None:
+			batch.append(event)
+			if len(batch) >= self.batchSize:
+				return batch
+			try:
+				if self.flushing.is_set():
+					event = self.queue.get_nowait()
+				else:
+					event = self.queue.get(timeout=max(deadline - time.time(), 0))
+			except queue.Empty:
+				self.flushing.clear()
+				return batch
+		# None is put on the queue by close()
+		self.closing = True
+		return batch
+
+# Where the channel is in each kind of event's args, the last unless listed.
+# None is for events covering every channel, a list of samples each starting
+# with its channel, split so every writer gets its own channels' samples.
+CHANNEL_ARG = {'count': 1, 'counts': None}
+
+class ShardedWriter(channellogger_model.LogviewerEvents):
+	# Spreads events over several LogviewerWriters, each with its own thread
+	# and LogviewerDB, by channel.  A channel always goes to the same writer so
+	# its events are still written in order, and a flood in one channel only
+	# holds up the channels sharing its writer.
+
+	def __init__(self, writers):
+		self.writers = writers
+
+	def writer(self, channel):
+		# IRC channel names aren't case sensitive
+		return self.writers[zlib.crc32(channel.lower().encode('utf-8')) % len(self.writers)]
+
+	def write_event(self, kind, args, timestamp=None):
+		index = CHANNEL_ARG.get(kind, -1)
+		if index is None:
+			shares = {}
+			for sample in args[0]:
+				shares.setdefault(self.writer(sample[0]), []).append(sample)
+			for (writer, samples) in shares.items():
+				writer.write_event(kind, (samples,), timestamp)
+		else:
+			self.writer(args[index]).write_event(kind, args, timestamp)
+
+	@property
+	def dropped(self):
+		return sum(writer.dropped for writer in self.writers)
+
+	def qsize(self):
+		return sum(writer.qsize() for writer in self.writers)
+
+	def flush(self):
+		for writer in self.writers:
+			writer.flush()
+
+	def close(self, timeout=30):
+		# Stopped together so they drain at the same time, and the databases
+		# (which share a pool) are only closed once every writer is done
+		for writer in self.writers:
+			writer.stop()
+		deadline = time.time() + timeout
+		finished = [writer.join(max(deadline - time.time(), 0)) for writer in self.writers]
+		if all(finished):
+			for writer in self.writers:
+				writer.db.close()
@@ -33,6 +33,22 @@ import supybot.registry as registry
 from supybot.i18n import PluginInternationalization, internationalizeDocstring
 _ = PluginInternationalization('LogsToDB')
 
+class FsyncPolicy(registry.OnlySomeStrings):
+    """Valid values include 'always', 'interval' and 'never'."""
+    validStrings = ('always', 'interval', 'never')
+
+class Compression(registry.OnlySomeStrings):
+    """Valid values include 'none', 'gzip' and 'xz'."""
+    validStrings = ('none', 'gzip', 'xz')
+
+class Backend(registry.OnlySomeStrings):
+    """Valid values include 'postgres' and 'sqlite'."""
+    validStrings = ('postgres', 'sqlite')
+
+class ArchiveMethod(registry.OnlySomeStrings):
+    """Valid values include 'zlib' and 'lzma'."""
+    validStrings = ('zlib', 'lzma')
+
 def configure(advanced):
     # This will be called by supybot to configure this module.  advanced is
     # a bool that specifies whether the user identified himself as an advanced
@@ -72,6 +88,177 @@ conf.registerChannelValue(LogsToDB, 'filenameTimestamp',
     for the timestamp are in the time.strftime docs at python.org.  In order
     for your logs to be rotated, you'll also have to enable
     supybot.plugins.LogsToDB.rotateLogs.""")))
+conf.registerGlobalValue(LogsToDB.rotateLogs, 'compress',
+    Compression('none', _("""Determines how rotated logs are compressed once
+    they've been closed, in a background thread.  gzip and xz add .gz or .xz
+    to the file name.""")))
+
+conf.registerGlobalValue(LogsToDB, 'capabilityCacheTime',
+    registry.NonNegativeInteger(60, _("""Determines how many seconds whether a
+    user's messages may be logged in a channel (the logChannelMessages
+    capability) is remembered.  Changes to the user or channel databases are
+    picked up straight away regardless.  0 checks every message.""")))
+conf.registerGlobalValue(LogsToDB, 'backend',
+    Backend('postgres', _("""Determines where the logs are stored, 'postgres'
+    is the server in backend.configFile and 'sqlite' a file the bot keeps
+    itself, with no server to run.  SQLite has no partitions, archive or
+    full-text index and only ever uses one background writer.  Takes effect
+    when the plugin is reloaded.""")))
+conf.registerGlobalValue(LogsToDB.backend, 'configFile',
+    registry.String('', _("""Determines the JSON file with the Postgres
+    connection settings.  If empty, config.json in the plugin's directory is
+    used, or plugins/LogsToDB/config.json under the bot's directory if there
+    isn't one.""")))
+conf.registerGlobalValue(LogsToDB.backend, 'sqliteFile',
+    registry.String('', _("""Determines the SQLite database file.  If empty,
+    LogsToDB.sqlite3 in the bot's data directory is used.""")))
+conf.registerGlobalValue(LogsToDB, 'backgroundWriter',
+    registry.Boolean(True, _("""Determines whether database writes are queued
+    and committed in batches by a background thread, rather than one
+    transaction per event on the bot's own thread.""")))
+conf.registerGlobalValue(LogsToDB.backgroundWriter, 'queueSize',
+    registry.PositiveInteger(10000, _("""Determines how many events may be
+    waiting for the background writer.  Events arriving while the queue is
+    full are dropped rather than blocking the bot.""")))
+conf.registerGlobalValue(LogsToDB.backgroundWriter, 'batchSize',
+    registry.PositiveInteger(500, _("""Determines the largest number of events
+    the background writer commits in one transaction.""")))
+conf.registerGlobalValue(LogsToDB.backgroundWriter, 'batchDelay',
+    registry.PositiveFloat(1.0, _("""Determines how many seconds the background
+    writer waits for a batch to fill up before committing it anyway.""")))
+conf.registerGlobalValue(LogsToDB.backgroundWriter, 'shards',
+    registry.PositiveInteger(1, _("""Determines how many background writers
+    there are.  Each channel's events always go to the same writer, in order,
+    and each writer has its own database connection, so a flood in one
+    channel doesn't hold up logging in the others.  Each writer has its own
+    queue of queueSize events.  Takes effect when the plugin is reloaded.""")))
+conf.registerGlobalValue(LogsToDB, 'identityCacheSize',
+    registry.PositiveInteger(50000, _("""Determines how many user/host and
+    channel IDs are kept in memory so they don't have to be looked up in the
+    database for every line.""")))
+conf.registerGlobalValue(LogsToDB, 'copyThreshold',
+    registry.NonNegativeInteger(50, _("""Determines how many messages a batch
+    must hold before they are loaded into the database with COPY instead of
+    one INSERT each.  0 disables COPY.""")))
+conf.registerGlobalValue(LogsToDB, 'fileFlushInterval',
+    registry.NonNegativeInteger(5, _("""Determines how many seconds lines for
+    the daily log files in config.json's logs.folderPath are buffered before
+    being flushed to disk.  0 flushes every line, as does
+    supybot.plugins.LogsToDB.flushImmediately.""")))
+conf.registerGlobalValue(LogsToDB, 'spool',
+    registry.Boolean(True, _("""Determines whether events that can't be written
+    because the database is unavailable are kept in an on-disk spool and
+    written once it's back, rather than being dropped.""")))
+conf.registerGlobalValue(LogsToDB.spool, 'directory',
+    registry.String('', _("""Determines the directory the spool is kept in.
+    If empty, LogsToDB-spool in the bot's data directory is used.""")))
+conf.registerGlobalValue(LogsToDB.spool, 'fsync',
+    FsyncPolicy('interval', _("""Determines when the spool is synced to disk:
+    after every write ('always'), at most every
+    supybot.plugins.LogsToDB.spool.fsyncInterval seconds ('interval'), or
+    only when the operating system decides to ('never').""")))
+conf.registerGlobalValue(LogsToDB.spool, 'fsyncInterval',
+    registry.PositiveInteger(1, _("""Determines how many seconds may pass
+    between syncs of the spool when supybot.plugins.LogsToDB.spool.fsync is
+    'interval'.""")))
+conf.registerGlobalValue(LogsToDB.spool, 'replayBatch',
+    registry.PositiveInteger(1000, _("""Determines how many spooled events are
+    read and written to the database at a time while replaying.""")))
+conf.registerGroup(LogsToDB, 'pool')
+conf.registerGlobalValue(LogsToDB.pool, 'writeConnections',
+    registry.PositiveInteger(2, _("""Determines how many connections may be
+    open at once for writing logs to the database.""")))
+conf.registerGlobalValue(LogsToDB.pool, 'readConnections',
+    registry.PositiveInteger(2, _("""Determines how many connections may be
+    open at once for reading from the database.""")))
+conf.registerGlobalValue(LogsToDB.pool, 'checkInterval',
+    registry.PositiveInteger(30, _("""Determines how many seconds a pooled
+    connection may sit unused before it is checked with a query before being
+    used again.""")))
+conf.registerGlobalValue(LogsToDB.pool, 'maxBackoff',
+    registry.PositiveInteger(60, _("""Determines the longest time, in seconds,
+    the bot waits between attempts to reconnect to the database.""")))
+conf.registerGlobalValue(LogsToDB, 'partitionsAhead',
+    registry.NonNegativeInteger(3, _("""Determines how many months of
+    partitions for the messages and user_count tables are created ahead of
+    time.  The check runs once a day.""")))
+conf.registerGroup(LogsToDB, 'search')
+conf.registerGlobalValue(LogsToDB.search, 'maxResults',
+    registry.PositiveInteger(5, _("""Determines the most messages the search
+    command returns at once.""")))
+conf.registerGlobalValue(LogsToDB.search, 'timeout',
+    registry.PositiveInteger(5000, _("""Determines how many milliseconds the
+    database may spend on a single search before giving up.""")))
+conf.registerGlobalValue(LogsToDB, 'metrics',
+    registry.Boolean(False, _("""Determines whether the plugin times its
+    handlers, log writes and database queries for the logstats command and
+    the Prometheus textfile.  Takes effect when the plugin is reloaded.""")))
+conf.registerGlobalValue(LogsToDB.metrics, 'textfile',
+    registry.String('', _("""Determines the file the metrics are written to
+    in the Prometheus text format, for node_exporter's textfile collector.  If
+    empty, LogsToDB.prom in the data directory is used.""")))
+conf.registerGlobalValue(LogsToDB.metrics, 'interval',
+    registry.PositiveInteger(60, _("""Determines how often, in seconds, the
+    metrics textfile is rewritten.""")))
+conf.registerGlobalValue(LogsToDB, 'archive',
+    registry.Boolean(False, _("""Determines whether messages older than
+    supybot.plugins.LogsToDB.archive.months are moved out of the database into
+    compressed archive files once a day.  Archived messages are still read
+    back along with the rest, see channelLogger_archive.py.""")))
+conf.registerGlobalValue(LogsToDB.archive, 'months',
+    registry.PositiveInteger(12, _("""Determines how many whole months of
+    messages, besides the current one, are kept in the database.""")))
+conf.registerGlobalValue(LogsToDB.archive, 'directory',
+    registry.String('', _("""Determines the directory archived messages are
+    kept in.  If empty, LogsToDB-archive in the bot's data directory is
+    used.""")))
+conf.registerGlobalValue(LogsToDB.archive, 'method',
+    ArchiveMethod('zlib', _("""Determines how archive blocks are compressed,
+    lzma is smaller and slower than zlib.""")))
+conf.registerGlobalValue(LogsToDB, 'netsplits',
+    registry.Boolean(True, _("""Determines whether the quits from a netsplit,
+    and the joins when it's over or when a channel is flooded with joins, are
+    written as one line per channel and one database insert rather than one
+    of each per user.  The lines still list every user, and the database still
+    has a row for each quit.""")))
+conf.registerGlobalValue(LogsToDB.netsplits, 'window',
+    registry.PositiveInteger(5, _("""Determines how many seconds without
+    another quit or join a netsplit or join flood has to go before it's
+    written.""")))
+conf.registerGlobalValue(LogsToDB.netsplits, 'joinThreshold',
+    registry.PositiveInteger(20, _("""Determines how many joins to a channel
+    within supybot.plugins.LogsToDB.netsplits.window seconds make a join
+    flood, the joins after that are written together.""")))
+conf.registerGlobalValue(LogsToDB.netsplits, 'rejoinTime',
+    registry.PositiveInteger(3600, _("""Determines for how many seconds after a
+    netsplit the users it took are looked out for, their joins are written
+    together as the netsplit ending.""")))
+conf.registerGroup(LogsToDB, 'userCount')
+conf.registerGlobalValue(LogsToDB.userCount, 'sampleInterval',
+    registry.PositiveInteger(10, _("""Determines how often, in seconds, the
+    number of users in each channel (and its topic) is sampled.  Takes effect
+    when the plugin is reloaded.""")))
+conf.registerGlobalValue(LogsToDB.userCount, 'interval',
+    registry.PositiveInteger(60, _("""Determines how often, in seconds, the
+    samples are written to the database, as the lowest, highest and average
+    count for each channel since the last write.  Topics are only written
+    when they change.  Takes effect when the plugin is reloaded.""")))
+conf.registerGroup(LogsToDB, 'stats')
+conf.registerGlobalValue(LogsToDB.stats, 'hours',
+    registry.PositiveInteger(24, _("""Determines how many hours back the stats
+    command looks when it isn't given --hours.""")))
+conf.registerGlobalValue(LogsToDB.stats, 'talkers',
+    registry.PositiveInteger(5, _("""Determines how many of the most active
+    nicks the stats command lists.""")))
+
+conf.registerGroup(LogsToDB, 'export')
+conf.registerGlobalValue(LogsToDB.export, 'directory',
+    registry.String('', _("""Determines the directory the export command
+    writes to.  If empty, LogsToDB-exports in the bot's data directory is
+    used.""")))
+conf.registerGlobalValue(LogsToDB.export, 'itersize',
+    registry.PositiveInteger(2000, _("""Determines how many rows an export
+    fetches from the database at a time.""")))
 
 conf.registerGlobalValue(LogsToDB, 'directories',
     registry.Boolean(True, _("""Determines whether the bot will partition its
@@ -0,0 +1,243 @@
+#!/usr/bin/python
+# Load existing plain-text logs into the database, run from the bot's
+# directory:
+#
+#   python plugins/LogsToDB/importer.py logs/LogsToDB /path/to/viewer/logs
+#
+# Two formats are understood: the per-channel logs doLog writes
+# (<logDir>/[network/][#channel/]#channel[.<filenameTimestamp>].log) and the
+# daily <YYYY-MM-DD>.log files from LogviewerFile.  The latter don't say
+# which channel a message was said in, so those lines are only imported when
+# --channel is given.
+#
+# Files are spread over a process pool and each is loaded in batches through
+# LogviewerDB.write_batch, which uses COPY for the messages.  The byte offset
+# reached in each file is saved in spool_replay with every batch, so an
+# interrupted import picks up exactly where it stopped; --checkpoint also
+# remembers finished files so they aren't even opened again.
+import argparse
+import concurrent.futures
+import json
+import os
+import re
+import time
+
+try:
+	from . import channelLogger_model as channellogger_model
+except ImportError:
+	import channelLogger_model as channellogger_model
+
+VIEWER_FILE = re.compile(r'^(\d{4}-\d{2}-\d{2})\.log$')
+# Rotated logs have the filenameTimestamp between the channel and .log,
+# anything with a digit in it is taken to be one
+CHANNEL_FILE = re.compile(r'^(?P<channel>.+?)(?:\.(?P<stamp>[^.]*\d[^.]*))?\.log$')
+
+# doLog lines, after the timestamp
+CHANNEL_MESSAGE = re.compile(r'^<(?P<nick>[^>]+)> (?P<text>.*)$')
+CHANNEL_EMOTE = re.compile(r'^\* (?P<nick>\S+) (?P<text>.*)$')
+CHANNEL_JOIN = re.compile(r'^\*\*\* (?P<nick>\S+) <(?P<prefix>[^>]*)> has joined (?P<channel>\S+)$')
+CHANNEL_PART = re.compile(r'^\*\*\* (?P<nick>\S+) <(?P<prefix>[^>]*)> has left (?P<channel>\S+)')
+CHANNEL_QUIT = re.compile(r'^\*\*\* (?P<nick>\S+) <(?P<prefix>[^>]*)> has quit IRC')
+CHANNEL_MODE = re.compile(r'^\*\*\* (?P<nick>\S+) sets mode: (?P<mode>[+-]b) (?P<target>\S+)$')
+# A netsplit's quits or a join flood, written as one line listing the nicks
+CHANNEL_NETSPLIT = re.compile(r'^\*\*\* Netsplit .*, \d+ users quit: (?P<nicks>.+)$')
+CHANNEL_NETJOIN = re.compile(r'^\*\*\* \d+ users joined(?: after the netsplit)?: (?P<nicks>.+)$')
+
+# LogviewerFile lines
+VIEWER_LINE = re.compile(r'^(?P<time>\d{2}:\d{2}:\d{2}) (?P<text>.*)$')
+VIEWER_MESSAGE = re.compile(r'^<(?P<nick>[^>]+)> (?P<text>.*)$')
+VIEWER_JOIN = re.compile(r'^--> <(?P<nick>[^>]+)> \((?P<prefix>[^)]*)\) joins (?P<channel>\S+) ?$')
+VIEWER_LEAVE = re.compile(r'^<-- <(?P<nick>[^>]+)> \((?P<prefix>[^)]*)\) (?P<action>parts|quits) (?P<channel>\S+) ?$')
+VIEWER_MODE = re.compile(r'^(?P<nick>\S+) sets mode: (?P<mode>[+-]b) (?P<target>\S+)$')
+VIEWER_NETSPLIT = re.compile(r'^<-- Netsplit .*, \d+ users quit (?P<channel>\S+): (?P<users>.+?) ?$')
+VIEWER_NETJOIN = re.compile(r'^--> \d+ users join (?P<channel>\S+): (?P<users>.+?) ?$')
+VIEWER_USER = re.compile(r'<(?P<nick>[^>]+)> \((?P<prefix>[^)]*)\)')
+
+def read_lines(path, offset):
+	"""Yields (text, offset after the line) for every line from offset on."""
+	with open(path, 'rb') as logFile:
+		logFile.seek(offset)
+		for line in logFile:
+			offset += len(line)
+			yield (channellogger_model.decode(line).rstrip('\r\n'), offset)
+
+def parse_channel_log(path, offset, options):
+	match = CHANNEL_FILE.match(os.path.basename(path))
+	channel = match.group('channel')
+	# The nick!user@host of a nick is only logged when they join, remember it
+	# for their messages
+	prefixes = {}
+	lastStamp = timestamp = None
+	for (line, offset) in read_lines(path, offset):
+		(stamp, sep, text) = line.partition('  ')
+		# strptime is slow and busy channels log many lines a second
+		if stamp != lastStamp:
+			try:
+				timestamp = time.mktime(time.strptime(stamp, options.timestamp_format))
+				lastStamp = stamp
+			except ValueError:
+				yield (None, offset)
+				continue
+		event = None
+		match = CHANNEL_MESSAGE.match(text) or CHANNEL_EMOTE.match(text)
+		storm = CHANNEL_NETSPLIT.match(text) or CHANNEL_NETJOIN.match(text)
+		if storm:
+			# One quit or join per nick, at the time the line was written
+			action = 'quit' if text.startswith('*** Netsplit ') else 'join'
+			users = [(nick, prefixes.get(nick, ''), timestamp) for nick in storm.group('nicks').split(', ')]
+			event = ('group', timestamp, (action, users, channel))
+		elif match:
+			nick = match.group('nick')
+			action = 'message' if text.startswith('<') else 'emote'
+			event = ('message', timestamp, (nick, prefixes.get(nick, ''), match.group('text'), action, channel))
+		elif text.startswith('*** '):
+			for (pattern, action) in ((CHANNEL_JOIN, 'join'), (CHANNEL_PART, 'part'), (CHANNEL_QUIT, 'quit')):
+				match = pattern.match(text)
+				if match:
+					prefixes[match.group('nick')] = match.group('prefix')
+					event = ('message', timestamp, (match.group('nick'), match.group('prefix'), '', action, channel))
+					break
+			else:
+				match = CHANNEL_MODE.match(text)
+				if match:
+					kind = 'ban' if match.group('mode') == '+b' else 'unban'
+					nick = match.group('nick')
+					event = (kind, timestamp, (nick, prefixes.get(nick, ''), match.group('mode'), match.group('target'), channel))
+		yield (event, offset)
+
+def parse_viewer_log(path, offset, options):
+	day = VIEWER_FILE.match(os.path.basename(path)).group(1)
+	channel = options.channel
+	midnight = time.mktime(time.strptime(day, '%Y-%m-%d'))
+	prefixes = {}
+	for (line, offset) in read_lines(path, offset):
+		match = VIEWER_LINE.match(line)
+		if not match:
+			yield (None, offset)
+			continue
+		(hours, minutes, seconds) = match.group('time').split(':')
+		timestamp = midnight + int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+		text = match.group('text')
+		event = None
+		match = VIEWER_JOIN.match(text) or VIEWER_LEAVE.match(text)
+		storm = VIEWER_NETSPLIT.match(text) or VIEWER_NETJOIN.match(text)
+		if storm:
+			action = 'quit' if text.startswith('<-- ') else 'join'
+			users = []
+			for user in VIEWER_USER.finditer(storm.group('users')):
+				prefixes[user.group('nick')] = user.group('prefix')
+				users.append((user.group('nick'), user.group('prefix'), timestamp))
+			event = ('group', timestamp, (action, users, storm.group('channel')))
+		elif match:
+			action = {'parts': 'part', 'quits': 'quit'}.get(match.groupdict().get('action'), 'join')
+			prefixes[match.group('nick')] = match.group('prefix')
+			event = ('message', timestamp, (match.group('nick'), match.group('prefix'), '', action, match.group('channel')))
+		elif channel:
+			match = VIEWER_MESSAGE.match(text)
+			if match:
+				nick = match.group('nick')
+				text = match.group('text')
+				# Emotes are written as the raw CTCP, the database has just the text
+				if text.startswith('\x01ACTION '):
+					event = ('message', timestamp, (nick, prefixes.get(nick, ''), text[8:].rstrip('\x01'), 'emote', channel))
+				else:
+					event = ('message', timestamp, (nick, prefixes.get(nick, ''), text, 'message', channel))
+			else:
+				match = VIEWER_MODE.match(text)
+				if match:
+					kind = 'ban' if match.group('mode') == '+b' else 'unban'
+					nick = match.group('nick')
+					event = (kind, timestamp, (nick, prefixes.get(nick, ''), match.group('mode'), match.group('target'), channel))
+		yield (event, offset)
+
+def import_file(path, options):
+	"""Runs in a worker process, returns (path, events imported, lines skipped)."""
+	db = channellogger_model.LogviewerDB(copyThreshold=1)
+	marker = 'import:' + path
+	if VIEWER_FILE.match(os.path.basename(path)):
+		lines = parse_viewer_log(path, db.get_marker(marker), options)
+	else:
+		lines = parse_channel_log(path, db.get_marker(marker), options)
+	imported = skipped = 0
+	batch = []
+	offset = None
+	for (event, offset) in lines:
+		if event is None:
+			skipped += 1
+			continue
+		batch.append(event)
+		if len(batch) >= options.batch_size:
+			if not db.write_batch(batch, (marker, offset)):
+				raise RuntimeError('Could not write a batch from %s, stopping at offset %s' % (path, offset))
+			imported += len(batch)
+			batch = []
+	# Save the final offset even if the tail was all skipped lines
+	if offset is not None and not db.write_batch(batch, (marker, offset)):
+		raise RuntimeError('Could not write a batch from %s, stopping at offset %s' % (path, offset))
+	imported += len(batch)
+	db.close()
+	return (path, imported, skipped)
+
+def find_logs(paths):
+	for path in paths:
+		if os.path.isfile(path):
+			yield os.path.abspath(path)
+			continue
+		for (directory, dirs, files) in os.walk(path):
+			for name in files:
+				if name.endswith('.log'):
+					yield os.path.abspath(os.path.join(directory, name))
+
+def load_checkpoint(path):
+	if path and os.path.exists(path):
+		with open(path) as data:
+			return json.load(data)
+	return {}
+
+def save_checkpoint(path, checkpoint):
+	if path:
+		with open(path + '.tmp', 'w') as data:
+			json.dump(checkpoint, data)
+		os.replace(path + '.tmp', path)
+
+def main():
+	parser = argparse.ArgumentParser(description='Import plain-text channel logs into the LogsToDB database')
+	parser.add_argument('paths', nargs='+', help='log files or directories to search for *.log files')
+	parser.add_argument('--channel', help='channel for messages in LogviewerFile daily logs, which do not record it')
+	parser.add_argument('--timestamp-format', default='%Y-%m-%dT%H:%M:%S', help='supybot.log.timestampFormat the channel logs were written with')
+	parser.add_argument('--checkpoint', default='import-checkpoint.json', help='file remembering which logs are finished')
+	parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='worker processes')
+	parser.add_argument('--batch-size', type=int, default=5000, help='events per transaction')
+	options = parser.parse_args()
+
+	checkpoint = load_checkpoint(options.checkpoint)
+	files = []
+	for path in find_logs(options.paths):
+		stat = os.stat(path)
+		if checkpoint.get(path) != [stat.st_size, stat.st_mtime]:
+			files.append((stat.st_size, path))
+	# Biggest first so one huge file doesn't start last and hold everything up
+	files.sort(reverse=True)
+	print('Importing %s files' % len(files))
+
+	start = time.time()
+	total = 0
+	with concurrent.futures.ProcessPoolExecutor(options.jobs) as pool:
+		futures = dict((pool.submit(import_file, path, options), (size, path)) for (size, path) in files)
+		for future in concurrent.futures.as_completed(futures):
+			(size, path) = futures[future]
+			try:
+				(path, imported, skipped) = future.result()
+			except Exception as e:
+				print('%s: failed, %s' % (path, e))
+				continue
+			total += imported
+			stat = os.stat(path)
+			checkpoint[path] = [stat.st_size, stat.st_mtime]
+			save_checkpoint(options.checkpoint, checkpoint)
+			print('%s: %s events, %s lines skipped' % (path, imported, skipped))
+	elapsed = time.time() - start
+	print('Imported %s events from %s files in %.0f seconds' % (total, len(files), elapsed))
+
+if __name__ == '__main__':
+	main()
@@ -31,13 +31,26 @@
 
 import os
 import time
+import collections
+import cProfile
+import threading
+import datetime
 import re
 import sys
 
 import chardet
+import psycopg2
 from io import StringIO
 sys.path.append(os.getcwd() + '/plugins/LogsToDB')
 from . import channelLogger_model as channellogger_model
+from . import channelLogger_writer as channellogger_writer
+from . import channelLogger_spool as channellogger_spool
+from . import channelLogger_pool as channellogger_pool
+from . import channelLogger_schema as channellogger_schema
+from . import channelLogger_metrics as channellogger_metrics
+from . import channelLogger_archive as channellogger_archive
+from . import channelLogger_export as channellogger_export
+from . import channelLogger_sqlite as channellogger_sqlite
 
 from supybot.commands import *
 import supybot.conf as conf
@@ -60,29 +73,602 @@ class FakeLog(object):
     def write(self, s):
         return
 
+class Membership(object):
+    """Which channels each nick is in, kept up to date from the messages that
+    change it so a quit or nick change only touches the nick's own channels."""
+    __slots__ = ('nicks', 'names')
+
+    def __init__(self, state=None):
+        # Lowercased nick -> set of channel names
+        self.nicks = {}
+        # Lowercased channel -> the name used in those sets, so every set
+        # shares one string per channel
+        self.names = {}
+        if state is not None:
+            for (channel, c) in state.channels.items():
+                for nick in c.users:
+                    self.add(nick, channel)
+
+    def name(self, channel):
+        key = ircutils.toLower(channel)
+        name = self.names.get(key)
+        if name is None:
+            name = self.names[key] = channel
+        return name
+
+    def channels(self, nick):
+        return self.nicks.get(ircutils.toLower(nick), ())
+
+    def add(self, nick, channel):
+        key = ircutils.toLower(nick)
+        channels = self.nicks.get(key)
+        if channels is None:
+            channels = self.nicks[key] = set()
+        channels.add(self.name(channel))
+
+    def remove(self, nick, channel):
+        key = ircutils.toLower(nick)
+        channels = self.nicks.get(key)
+        if channels is not None:
+            channels.discard(self.name(channel))
+            if not channels:
+                del self.nicks[key]
+
+    def rename(self, oldNick, newNick):
+        channels = self.nicks.pop(ircutils.toLower(oldNick), None)
+        if channels is not None:
+            self.nicks[ircutils.toLower(newNick)] = channels
+
+    def quit(self, nick):
+        self.nicks.pop(ircutils.toLower(nick), None)
+
+    def forget(self, channel):
+        # We left, nobody's in it as far as we can tell.  Rare enough that
+        # going over every nick doesn't matter.
+        name = self.names.pop(ircutils.toLower(channel), None)
+        if name is None:
+            return
+        for (key, channels) in list(self.nicks.items()):
+            channels.discard(name)
+            if not channels:
+                del self.nicks[key]
+
+    def addMsg(self, irc, msg):
+        command = msg.command
+        if command == 'JOIN':
+            for channel in msg.args[0].split(','):
+                self.add(msg.nick, channel)
+        elif command == 'PART':
+            for channel in msg.args[0].split(','):
+                if ircutils.strEqual(msg.nick, irc.nick):
+                    self.forget(channel)
+                else:
+                    self.remove(msg.nick, channel)
+        elif command == 'KICK':
+            if ircutils.strEqual(msg.args[1], irc.nick):
+                self.forget(msg.args[0])
+            else:
+                self.remove(msg.args[1], msg.args[0])
+        elif command == 'QUIT':
+            self.quit(msg.nick)
+        elif command == 'NICK':
+            self.rename(msg.nick, msg.args[0])
+        elif command == '353':
+            # RPL_NAMREPLY: nicks come with their status prefixes, and the
+            # whole nick!user@host with userhost-in-names
+            prefixes = ''.join(irc.state.supported.get('prefix', {}).values()) \
+                or '@%+&~'
+            channel = msg.args[2]
+            for name in msg.args[3].split():
+                self.add(name.lstrip(prefixes).split('!', 1)[0], channel)
+
+
+# A quit reason that is the two servers either side of a netsplit
+NETSPLIT = re.compile(r'^[\w.*-]+\.[\w*-]+ [\w.*-]+\.[\w*-]+$')
+
+class Storm(object):
+    """The quits from a netsplit, or the joins after one or in a join flood,
+    in one channel, written as one line once they stop coming."""
+    __slots__ = ('kind', 'channel', 'servers', 'last', 'users')
+
+    def __init__(self, kind, channel, servers, now):
+        self.kind = kind
+        self.channel = channel
+        self.servers = servers
+        self.last = now
+        # (nick, host, time) of each user, in the order they came
+        self.users = []
+
+class Storms(object):
+    """Spots netsplits and join floods on a network and gathers their quits
+    and joins into a Storm a channel until window seconds go by without
+    another."""
+
+    def __init__(self, window=5, threshold=20, rejoinTime=3600):
+        self.window = window
+        self.threshold = threshold
+        self.rejoinTime = rejoinTime
+        # (kind, channel) -> the Storm still gathering
+        self.open = {}
+        # Lowercased nick -> (time, servers) for users a netsplit took
+        self.split = {}
+        # Channel -> times of its joins in the last window
+        self.joins = {}
+
+    def add(self, kind, channel, nick, host, servers, now):
+        storm = self.open.get((kind, channel))
+        if storm is None:
+            storm = self.open[(kind, channel)] = Storm(kind, channel, servers,
+                                                       now)
+        storm.users.append((nick, host, now))
+        storm.last = now
+
+    def quit(self, channel, nick, host, reason, now):
+        """Adds the quit to its channel's netsplit if it's from one, returns
+        whether it did."""
+        if not NETSPLIT.match(reason):
+            return False
+        self.split[ircutils.toLower(nick)] = (now, reason)
+        self.add('netsplit', channel, nick, host, reason, now)
+        return True
+
+    def join(self, channel, nick, host, now):
+        """Adds the join to its channel's storm if the user is back from a
+        netsplit or the channel is being flooded, returns whether it did."""
+        split = self.split.get(ircutils.toLower(nick))
+        if split is not None and now - split[0] < self.rejoinTime:
+            self.add('netjoin', channel, nick, host, split[1], now)
+            return True
+        joins = self.joins.get(channel)
+        if joins is None:
+            joins = self.joins[channel] = collections.deque()
+        joins.append(now)
+        while now - joins[0] >= self.window:
+            joins.popleft()
+        if len(joins) < self.threshold and \
+                ('netjoin', channel) not in self.open:
+            return False
+        self.add('netjoin', channel, nick, host, '', now)
+        return True
+
+    def due(self, now, everything=False):
+        """Takes the storms that are over, or all of them."""
+        over = [storm for storm in self.open.values()
+                if everything or now - storm.last >= self.window]
+        for storm in over:
+            del self.open[(storm.kind, storm.channel)]
+        # Only needed while there are storms, so only tidied up after them
+        for (nick, (when, servers)) in list(self.split.items()):
+            if now - when >= self.rejoinTime:
+                del self.split[nick]
+        for (channel, joins) in list(self.joins.items()):
+            if now - joins[-1] >= self.window:
+                del self.joins[channel]
+        return over
+
+    def next(self):
+        """When the next storm will be over if nothing more comes."""
+        return min(storm.last for storm in self.open.values()) + self.window
+
+
+# Everything logEvent and the handlers look up for a line, resolved once per
+# network and channel, see LogsToDB.settings
+CHANNEL_SETTINGS = ('enable', 'noLogPrefix', 'timestamp', 'stripFormatting',
+                    'showJoinParts')
+Settings = collections.namedtuple('Settings', CHANNEL_SETTINGS +
+                                  ('flushImmediately', 'timestampFormat'))
+
+NOT_LOGGED = '-= THIS MESSAGE NOT LOGGED =-'
+
+def reason(event):
+    return ' (%s)' % event.content if event.content else ''
+
+def nicks(event):
+    return ', '.join(nick for (nick, host, when) in event.target)
+
+# How each kind of LogEvent reads in the channel logs, after the timestamp
+LOG_LINES = {
+    'message': lambda event: '<%s> %s\n' % (
+        event.target or event.nick,
+        NOT_LOGGED if event.hidden else event.content),
+    'emote': lambda event: '* %s %s\n' % (
+        event.target or event.nick,
+        NOT_LOGGED if event.hidden else event.content),
+    'notice': lambda event: '-%s- %s\n' % (event.nick, event.content),
+    'join': lambda event: '*** %s <%s> has joined %s\n' % (
+        event.nick, event.host, event.channel),
+    'part': lambda event: '*** %s <%s> has left %s%s\n' % (
+        event.nick, event.host, event.channel, reason(event)),
+    'quit': lambda event: '*** %s <%s> has quit IRC%s\n' % (
+        event.nick, event.host, reason(event)),
+    'kick': lambda event: '*** %s was kicked by %s%s\n' % (
+        event.target, event.nick, reason(event)),
+    'nick': lambda event: '*** %s is now known as %s\n' % (
+        event.nick, event.target),
+    'mode': lambda event: '*** %s sets mode: %s\n' % (
+        event.nick, event.content),
+    'topic': lambda event: '*** %s changes topic to "%s"\n' % (
+        event.nick, event.content),
+    'netsplit': lambda event: '*** Netsplit %s, %s users quit: %s\n' % (
+        event.content.replace(' ', ' <-> '), len(event.target), nicks(event)),
+    'netjoin': lambda event: '*** %s users joined%s: %s\n' % (
+        len(event.target),
+        ' after the netsplit' if event.content else '', nicks(event)),
+}
+
+# The kinds of LogEvent that go to the database, see LogviewerEvents.add_event
+DB_KINDS = ('message', 'emote', 'join', 'netjoin', 'part', 'quit', 'netsplit',
+            'ban', 'unban')
+
+class CapabilityCache(object):
+    """Remembers whether a prefix may have its messages logged in a channel
+    for ttl seconds.  ircdb writes its users and channels files on every
+    change, so those are checked (at most once a second) to start over as
+    soon as anyone's capabilities change."""
+    def __init__(self, ttl):
+        self.ttl = ttl
+        # prefix -> {channel: (allowed, expiry)}
+        self.cache = {}
+        self.stamp = None
+        self.checked = 0
+
+    def clear(self):
+        self.cache.clear()
+
+    def forget(self, prefix):
+        self.cache.pop(prefix, None)
+
+    def databases(self):
+        stamp = []
+        for db in (ircdb.users, ircdb.channels):
+            try:
+                stamp.append(os.stat(db.filename).st_mtime_ns)
+            except (TypeError, OSError):
+                stamp.append(None)
+        return stamp
+
+    def logChannelMessages(self, prefix, channel):
+        now = time.time()
+        if now - self.checked >= 1:
+            self.checked = now
+            stamp = self.databases()
+            if stamp != self.stamp:
+                self.stamp = stamp
+                self.cache.clear()
+        channels = self.cache.get(prefix)
+        cached = channels.get(channel) if channels is not None else None
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        cap = ircdb.makeChannelCapability(channel, 'logChannelMessages')
+        try:
+            allowed = ircdb.checkCapability(prefix, cap, ignoreOwner=True)
+        except KeyError:
+            allowed = True
+        if self.ttl:
+            if channels is None:
+                if len(self.cache) >= 10000:
+                    self.cache.clear()
+                channels = self.cache[prefix] = {}
+            channels[channel] = (allowed, now + self.ttl)
+        return allowed
+
+
 class LogsToDB(callbacks.Plugin):
     noIgnore = True
     def __init__(self, irc):
         self.__parent = super(LogsToDB, self)
         self.__parent.__init__(irc)
-        self.lastMsgs = {}
-        self.lastStates = {}
+        # Seeded now for the networks already connected: by the time a
+        # handler runs irc.state has taken its message, a quit's nick is gone
+        self.members = dict((other, Membership(other.state))
+                            for other in world.ircs)
         self.logs = {}
+        # When rotate() is next scheduled to run, None if it isn't
+        self.rotation = None
+        # irc -> its Storms, when writeStorms() is next scheduled to run and
+        # the netsplits settings, looked up again after settingsChanged
+        self.storms = {}
+        self.stormCheck = None
+        self.stormSettings = None
+        # (network, channel) -> Settings, emptied by settingsChanged whenever
+        # one of the registry values they came from (or that decide log
+        # paths) is set
+        self.channelSettings = {}
+        self.watched = {}
+        # removeCallback compares with is, so keep hold of one bound method
+        self.settingsCallback = self.settingsChanged
+        settings = conf.supybot.plugins.LogsToDB
+        for setting in (settings.rotateLogs, settings.filenameTimestamp,
+                        settings.directories, settings.directories.network,
+                        settings.directories.channel,
+                        settings.directories.timestamp,
+                        settings.directories.timestamp.format,
+                        settings.flushImmediately,
+                        conf.supybot.log.timestampFormat):
+            self.watch(setting)
+        self.capabilities = CapabilityCache(
+            self.registryValue('capabilityCacheTime'))
+        self.watch(conf.supybot.capabilities)
+        self.hookUsers()
         self.flusher = self.flush
         world.flushers.append(self.flusher)
-        self.logViewerDB = channellogger_model.LogviewerDB()
-        self.logViewerFile = channellogger_model.LogviewerFile()
+        backend = self.registryValue('backend')
+        # SQLite takes one writer at a time whatever, more would only queue
+        if self.registryValue('backgroundWriter') and backend == 'postgres':
+            shards = self.registryValue('backgroundWriter.shards')
+        else:
+            shards = 1
+        self.adoptSpools(shards)
+        if self.registryValue('metrics'):
+            self.metrics = channellogger_metrics.LogviewerMetrics()
+            connectionFactory = self.metrics.connection_factory()
+        else:
+            self.metrics = None
+            connectionFactory = None
+        self.profiler = None
+        if backend == 'sqlite':
+            # Nothing else needs the Postgres pool
+            self.dbPool = None
+            self.shardDBs = [channellogger_sqlite.SQLiteDB(
+                self.registryValue('backend.sqliteFile') or
+                    conf.supybot.directories.data.dirize('LogsToDB.sqlite3'),
+                cacheSize=self.registryValue('identityCacheSize'),
+                spool=self.makeSpool(0),
+                replayBatch=self.registryValue('spool.replayBatch'))]
+        else:
+            self.dbPool = channellogger_pool.LogviewerPool(
+                channellogger_model.load_config(self.configFile()),
+                # A connection for each writer so they never wait on each other
+                writeConnections=max(self.registryValue('pool.writeConnections'),
+                                     shards),
+                readConnections=self.registryValue('pool.readConnections'),
+                checkInterval=self.registryValue('pool.checkInterval'),
+                maxBackoff=self.registryValue('pool.maxBackoff'),
+                connectionFactory=connectionFactory)
+            # One LogviewerDB per writer, the first also serves the commands
+            self.shardDBs = [channellogger_model.LogviewerDB(self.dbPool,
+                cacheSize=self.registryValue('identityCacheSize'),
+                copyThreshold=self.registryValue('copyThreshold'),
+                spool=self.makeSpool(shard),
+                replayBatch=self.registryValue('spool.replayBatch'),
+                archiveDir=self.archiveDir())
+                for shard in range(shards)]
+        self.logViewerDB = self.shardDBs[0]
+        if self.registryValue('backgroundWriter'):
+            writers = [channellogger_writer.LogviewerWriter(db,
+                queueSize=self.registryValue('backgroundWriter.queueSize'),
+                batchSize=self.registryValue('backgroundWriter.batchSize'),
+                batchDelay=self.registryValue('backgroundWriter.batchDelay'),
+                name='LogsToDB writer %s' % shard if shard else 'LogsToDB writer')
+                for (shard, db) in enumerate(self.shardDBs)]
+            if shards == 1:
+                self.dbWriter = writers[0]
+            else:
+                self.dbWriter = channellogger_writer.ShardedWriter(writers)
+        else:
+            self.dbWriter = self.logViewerDB
+        if self.registryValue('flushImmediately'):
+            fileFlushInterval = 0
+        else:
+            fileFlushInterval = self.registryValue('fileFlushInterval')
+        self.logViewerFile = channellogger_model.LogviewerFile(
+            flushInterval=fileFlushInterval)
+        if self.metrics is not None:
+            self.instrument()
+            schedule.addPeriodicEvent(self.writeMetrics,
+                                      self.registryValue('metrics.interval'),
+                                      'LogsToDB.metrics', now=False)
+        # kind -> the sinks taking that kind of event, after instrument() so
+        # they're the timed methods.  A kind nothing takes is never even built.
+        self.sinks = {}
+        self.addSink(self.logEvent, LOG_LINES)
+        self.addSink(self.fileEvent, channellogger_model.FILE_LINES)
+        self.addSink(self.dbEvent, DB_KINDS)
+        self.addSink(self.banEvent, ('ban', 'unban'))
+        self.bansLoaded = self.logViewerDB.load_bans()
         self.currentUsers = 0
+        # channel -> CountRing of its user counts, and the last topic written
+        self.userCounts = {}
+        self.topics = {}
+        sampleInterval = self.registryValue('userCount.sampleInterval')
+        countInterval = self.registryValue('userCount.interval')
+        # Room for two intervals' samples in case writing one is late
+        self.ringSize = 2 * -(-countInterval // sampleInterval) + 1
         def myEventCaller():
             self.addCount(irc)
-        schedule.addPeriodicEvent(myEventCaller, 600, 'mySpamEvent')
+            # Try again if the database was away when the plugin loaded
+            if not self.bansLoaded:
+                self.bansLoaded = self.logViewerDB.load_bans()
+        schedule.addPeriodicEvent(lambda: self.sampleCounts(irc),
+                                  sampleInterval, 'LogsToDB.sample')
+        schedule.addPeriodicEvent(myEventCaller, countInterval, 'mySpamEvent')
+        # Partitions and the archive are Postgres only
+        if self.dbPool is not None:
+            schedule.addPeriodicEvent(self.addPartitions, 86400,
+                                      'LogsToDB.partitions')
+        self.archiving = threading.Lock()
+        # Remembered for die(), the setting may have changed by then
+        self.archiveScheduled = self.registryValue('archive') and \
+            self.dbPool is not None
+        if self.archiveScheduled:
+            schedule.addPeriodicEvent(self.archiveMessages, 86400,
+                                      'LogsToDB.archive', now=False)
+
+
+    def spoolDir(self):
+        return self.registryValue('spool.directory') or \
+            conf.supybot.directories.data.dirize('LogsToDB-spool')
+
+    def adoptSpools(self, shards):
+        """Move what writers there are no longer any of (fewer shards, or
+        SQLite's one) left spooled into the first writer's spool.  Segment
+        names are unique, so their replay markers still apply."""
+        spoolDir = self.spoolDir()
+        if not self.registryValue('spool') or not os.path.isdir(spoolDir):
+            return
+        for name in os.listdir(spoolDir):
+            path = os.path.join(spoolDir, name)
+            if not name.isdigit() or int(name) < shards or \
+                    not os.path.isdir(path):
+                continue
+            for segment in os.listdir(path):
+                if segment.endswith('.spool'):
+                    os.replace(os.path.join(path, segment),
+                               os.path.join(spoolDir, segment))
+                    self.log.info('Replaying spool segment %s from writer %s '
+                                  'with the first writer', segment, name)
+            try:
+                os.rmdir(path)
+            except OSError as e:
+                self.log.warning('Could not remove %s: %s', path, e)
+
+    def makeSpool(self, shard):
+        "The spool for a writer, the first uses the directory itself"
+        if not self.registryValue('spool'):
+            return None
+        spoolDir = self.spoolDir()
+        if shard:
+            spoolDir = os.path.join(spoolDir, str(shard))
+        return channellogger_spool.LogviewerSpool(spoolDir,
+            fsync=self.registryValue('spool.fsync'),
+            fsyncInterval=self.registryValue('spool.fsyncInterval'))
 
+    def sampleCounts(self, irc):
+        "Sample the number of users in each channel and write topic changes"
+        now = time.time()
+        for (channel, state) in list(irc.state.channels.items()):
+            ring = self.userCounts.get(channel)
+            if ring is None:
+                ring = self.userCounts[channel] = \
+                    channellogger_model.CountRing(self.ringSize)
+            ring.add(now, len(state.users))
+            if channel not in self.topics and not state.topic:
+                # Not seen the topic yet, the server sends it after the join
+                continue
+            if state.topic != self.topics.get(channel):
+                self.topics[channel] = state.topic
+                self.dbWriter.add_topic(state.topic, channel)
 
     def addCount(self, irc):
-        "Periodically check the amount of users in the channel every 10 minutes"
-        for chan in list(irc.state.channels.keys()):
-            self.logViewerDB.add_count(len(irc.state.channels[chan].users), chan, irc.state.channels[chan].topic)
+        "Write every channel's user count samples since the last time at once"
+        samples = []
+        for (channel, ring) in list(self.userCounts.items()):
+            summary = ring.drain()
+            if summary is not None:
+                samples.append((channel,) + summary)
+            elif channel not in irc.state.channels:
+                del self.userCounts[channel]
+                self.topics.pop(channel, None)
+        if samples:
+            self.dbWriter.add_counts(samples)
+
+
+    def instrument(self):
+        "Time the handlers, log writes and database work, and export gauges"
+        metrics = self.metrics
+        metrics.instrument(self, 'handler',
+                           [name for name in dir(self) if name.startswith('do')
+                            and callable(getattr(self, name))])
+        metrics.instrument(self, 'log', ['logEvent'])
+        metrics.instrument(self.logViewerFile, 'file',
+                           [name for name in dir(self.logViewerFile)
+                            if name.startswith('write_')])
+        for db in self.shardDBs:
+            metrics.instrument(db, 'db', ['write_batch', 'replay_spool'])
+        if self.dbWriter is not self.logViewerDB:
+            writer = self.dbWriter
+            metrics.gauge('writer_queue_depth', writer.qsize,
+                          'Events waiting for the background writer')
+            metrics.gauge('writer_dropped_total', lambda: writer.dropped,
+                          'Events dropped because the writer queue was full',
+                          'counter')
+        dbs = self.shardDBs
+        if self.registryValue('spool'):
+            metrics.gauge('spool_segments',
+                          lambda: sum(len(db.spool.segments) for db in dbs),
+                          'Spool segments waiting to be replayed')
+        metrics.gauge('user_cache_size',
+                      lambda: sum(len(db.userCache) for db in dbs))
+        metrics.gauge('nick_cache_size',
+                      lambda: sum(len(db.nickCache) for db in dbs))
+        metrics.gauge('host_cache_size',
+                      lambda: sum(len(db.hostCache) for db in dbs))
+        metrics.gauge('channel_cache_size',
+                      lambda: sum(len(db.channelCache) for db in dbs))
+        if self.dbPool is None:
+            return
+        for kind in ('write', 'read'):
+            for (name, type) in (('in_use', 'gauge'), ('peak', 'gauge'),
+                                 ('waits', 'counter'), ('timeouts', 'counter'),
+                                 ('discarded', 'counter')):
+                metrics.gauge('pool_%s_%s%s' % (kind, name,
+                                                '_total' if type == 'counter' else ''),
+                              lambda kind=kind, name=name:
+                                  self.dbPool.stats()[kind][name],
+                              type=type)
+        metrics.gauge('pool_connect_failures_total',
+                      lambda: self.dbPool.stats()['connect_failures'],
+                      type='counter')
 
+    def writeMetrics(self):
+        path = self.registryValue('metrics.textfile') or \
+            conf.supybot.directories.data.dirize('LogsToDB.prom')
+        try:
+            self.metrics.write_textfile(path)
+        except EnvironmentError as e:
+            self.log.error('Could not write the metrics to %s: %s', path, e)
+
+    def configFile(self):
+        "The Postgres settings, by default next to the plugin or where they used to be"
+        path = self.registryValue('backend.configFile')
+        if not path:
+            path = os.path.join(os.path.dirname(__file__), 'config.json')
+            if not os.path.exists(path):
+                path = channellogger_model.CONFIG_PATH
+        return path
+
+    def archiveDir(self):
+        return self.registryValue('archive.directory') or \
+            conf.supybot.directories.data.dirize('LogsToDB-archive')
+
+    def archiveMessages(self):
+        "Move old messages into the archive, in a thread as it can take a while"
+        if not self.archiving.acquire(False):
+            self.log.warning('The last archive run has not finished yet.')
+            return
+        def run():
+            try:
+                (archived, dropped) = channellogger_archive.archive_messages(
+                    self.dbPool, self.archiveDir(),
+                    self.registryValue('archive.months'),
+                    self.registryValue('archive.method'), log=self.log.debug)
+                self.log.info('Archived %s messages, dropped partitions: %s',
+                              archived, ', '.join(dropped) or 'none')
+            except (channellogger_pool.PoolUnavailable, psycopg2.Error,
+                    EnvironmentError) as e:
+                self.log.error('Could not archive messages: %s', e)
+            finally:
+                self.archiving.release()
+        thread = threading.Thread(target=run, name='LogsToDB archiver')
+        thread.daemon = True
+        thread.start()
+
+    def addPartitions(self):
+        "Create next months' partitions for messages and user_count, in a thread"
+        def run():
+            try:
+                with self.dbPool.connection() as conn:
+                    created = channellogger_schema.ensure_partitions(
+                        conn.cursor(), self.registryValue('partitionsAhead'))
+                    conn.commit()
+            except (channellogger_pool.PoolUnavailable, psycopg2.Error) as e:
+                self.log.error('Could not create partitions: %s', e)
+                return
+            if created:
+                self.log.info('Created partitions: %s', ', '.join(created))
+        thread = threading.Thread(target=run, name='LogsToDB partitions')
+        thread.daemon = True
+        thread.start()
 
     def to_unicode_or_bust(self, obj, encoding='utf-8'):
         if isinstance(obj, str):
@@ -92,14 +678,7 @@ class LogsToDB(callbacks.Plugin):
         return obj
 
     def decode(self, bytes):
-        try:
-            text = bytes.decode('utf-8')
-        except UnicodeDecodeError:
-            try:
-                text = bytes.decode('iso-8859-1')
-            except UnicodeDecodeError:
-                text = bytes.decode('cp1252')
-        return text
+        return channellogger_model.decode(bytes)
 
     def encode(self, bytes):
         try:
@@ -112,9 +691,28 @@ class LogsToDB(callbacks.Plugin):
         return text
 
     def die(self):
+        self.writeStorms(everything=True)
         for log in self._logs():
             log.close()
         world.flushers = [x for x in world.flushers if x is not self.flusher]
+        schedule.removePeriodicEvent('mySpamEvent')
+        schedule.removePeriodicEvent('LogsToDB.sample')
+        if self.dbPool is not None:
+            schedule.removePeriodicEvent('LogsToDB.partitions')
+        if self.archiveScheduled:
+            schedule.removePeriodicEvent('LogsToDB.archive')
+        if self.metrics is not None:
+            schedule.removePeriodicEvent('LogsToDB.metrics')
+        if self.profiler is not None:
+            self.profiler.disable()
+            schedule.removeEvent('LogsToDB.profile')
+        if self.rotation is not None:
+            schedule.removeEvent('LogsToDB.rotate')
+        for setting in self.watched.values():
+            setting.removeCallback(self.settingsCallback)
+        self.unhookUsers()
+        self.logViewerFile.close()
+        self.dbWriter.close()
 
     def __call__(self, irc, msg):
         try:
@@ -122,20 +720,26 @@ class LogsToDB(callbacks.Plugin):
             # doesn't call doNick or doQuit.
             # if msg.args and irc.isChannel(msg.args[0]):
             self.__parent.__call__(irc, msg)
-            if irc in self.lastMsgs:
-                if irc not in self.lastStates:
-                    self.lastStates[irc] = irc.state.copy()
-                self.lastStates[irc].addMsg(irc, self.lastMsgs[irc])
         finally:
-            # We must make sure this always gets updated.
-            self.lastMsgs[irc] = msg
+            # irc.state has already seen msg, the handlers need to know who
+            # was where before it.  We must make sure this always gets updated.
+            self.membership(irc).addMsg(irc, msg)
 
     def reset(self):
+        self.writeStorms(everything=True)
+        self.storms.clear()
         for log in self._logs():
             log.close()
         self.logs.clear()
-        self.lastMsgs.clear()
-        self.lastStates.clear()
+        self.members.clear()
+
+    def membership(self, irc):
+        try:
+            return self.members[irc]
+        except KeyError:
+            # A network connected since, start from what irc.state knows
+            members = self.members[irc] = Membership(irc.state)
+            return members
 
     def _logs(self):
         for logs in self.logs.values():
@@ -143,13 +747,14 @@ class LogsToDB(callbacks.Plugin):
                 yield log
 
     def flush(self):
-        self.checkLogNames()
         for log in self._logs():
             try:
                 log.flush()
             except ValueError as e:
                 if e.args[0] != 'I/O operation on a closed file':
                     self.log.exception('Odd exception:')
+        self.logViewerFile.flush()
+        self.dbWriter.flush()
 
     def logNameTimestamp(self, channel):
         format = self.registryValue('filenameTimestamp', channel)
@@ -162,6 +767,12 @@ class LogsToDB(callbacks.Plugin):
             return '%s.log' % channel
 
     def getLogDir(self, irc, channel):
+        logDir = self.logDirName(irc, channel)
+        if not os.path.exists(logDir):
+            os.makedirs(logDir)
+        return logDir
+
+    def logDirName(self, irc, channel):
         logDir = conf.supybot.directories.log.dirize(self.name())
         if self.registryValue('directories'):
             if self.registryValue('directories.network'):
@@ -172,96 +783,309 @@ class LogsToDB(callbacks.Plugin):
                 format = self.registryValue('directories.timestamp.format')
                 timeDir =time.strftime(format)
                 logDir = os.path.join(logDir, timeDir)
-        if not os.path.exists(logDir):
-            os.makedirs(logDir)
         return logDir
 
+    def logNameFormats(self, channel):
+        "The strftime formats that go into channel's log path"
+        formats = []
+        if self.registryValue('rotateLogs', channel):
+            formats.append(self.registryValue('filenameTimestamp', channel))
+        if self.registryValue('directories') and \
+                self.registryValue('directories.timestamp'):
+            formats.append(self.registryValue('directories.timestamp.format'))
+        return formats
+
     def checkLogNames(self):
+        """Close the logs whose path has changed and return the old paths that
+        no channel's log will be written to any more"""
+        rotated = []
+        current = set()
         for (irc, logs) in list(self.logs.items()):
             for (channel, log) in list(logs.items()):
-                if self.registryValue('rotateLogs', channel):
-                    name = self.getLogName(channel)
-                    if name != log.name:
-                        log.close()
-                        del logs[channel]
+                path = os.path.join(self.logDirName(irc, channel),
+                                    self.getLogName(channel))
+                current.add(path)
+                if path != log.name:
+                    log.close()
+                    del logs[channel]
+                    rotated.append(log.name)
+        return [path for path in rotated if path not in current]
+
+    def openLogNames(self):
+        return set(log.name for logs in list(self.logs.values())
+                   for log in list(logs.values()))
+
+    def scheduleRotation(self, when):
+        if when is None or (self.rotation is not None and
+                            self.rotation <= when):
+            return
+        if self.rotation is not None:
+            schedule.removeEvent('LogsToDB.rotate')
+        self.rotation = when
+        schedule.addEvent(self.rotationDue, when, 'LogsToDB.rotate')
+
+    def rotationDue(self):
+        self.rotation = None
+        self.rotate()
+
+    def rotate(self):
+        "Rotate the logs whose names have changed and schedule the next check"
+        if self.rotation is not None:
+            schedule.removeEvent('LogsToDB.rotate')
+            self.rotation = None
+        rotated = self.checkLogNames()
+        compress = self.registryValue('rotateLogs.compress')
+        if rotated and compress != 'none':
+            thread = threading.Thread(target=self.compressLogs,
+                                      args=(rotated, compress),
+                                      name='LogsToDB compressor')
+            thread.daemon = True
+            thread.start()
+        now = time.time()
+        rollovers = {}
+        for logs in self.logs.values():
+            for channel in logs:
+                for format in self.logNameFormats(channel):
+                    if format not in rollovers:
+                        rollovers[format] = \
+                            channellogger_model.next_rollover(format, now)
+        self.scheduleRotation(min([when for when in rollovers.values()
+                                   if when is not None], default=None))
+
+    def compressLogs(self, paths, method):
+        for path in paths:
+            if path in self.openLogNames():
+                # Reopened since, e.g. by a setting changed back
+                continue
+            try:
+                channellogger_model.compress_file(path, method)
+            except EnvironmentError as e:
+                self.log.error('Could not compress %s: %s', path, e)
 
     def getLog(self, irc, channel):
-        self.checkLogNames()
+        # Rotation happens in rotate(), scheduled for when the name changes, so
+        # this is just a lookup for every line but the first of a log
         try:
-            logs = self.logs[irc]
+            return self.logs[irc][channel]
         except KeyError:
-            logs = ircutils.IrcDict()
-            self.logs[irc] = logs
-        if channel in logs:
-            return logs[channel]
-        else:
-            try:
-                name = self.getLogName(channel)
-                logDir = self.getLogDir(irc, channel)
-                log = open(os.path.join(logDir, name), 'a')
-                logs[channel] = log
-                return log
-            except IOError:
-                self.log.exception('Error opening log:')
-                return FakeLog()
-
-    def timestamp(self, log):
-        format = conf.supybot.log.timestampFormat()
-        if format:
-            log.write(time.strftime(format))
-            log.write('  ')
+            pass
+        logs = self.logs.setdefault(irc, {})
+        try:
+            name = self.getLogName(channel)
+            logDir = self.getLogDir(irc, channel)
+            log = channellogger_model.IndexedLog(os.path.join(logDir, name))
+        except IOError:
+            self.log.exception('Error opening log:')
+            return FakeLog()
+        logs[channel] = log
+        now = time.time()
+        rollovers = [channellogger_model.next_rollover(format, now)
+                     for format in self.logNameFormats(channel)]
+        self.scheduleRotation(min([when for when in rollovers
+                                   if when is not None], default=None))
+        return log
+
+    def watch(self, setting):
+        if id(setting) not in self.watched:
+            self.watched[id(setting)] = setting
+            setting.addCallback(self.settingsCallback)
+
+    def settingsChanged(self):
+        self.channelSettings.clear()
+        self.stormSettings = None
+        self.capabilities.clear()
+        # Log paths may have changed too.  Setting a value calls this for each
+        # of its children, so rotate once on the next scheduler run rather
+        # than once per call.
+        self.scheduleRotation(time.time())
+
+    def hookUsers(self):
+        # Identifying changes what a prefix may do without writing the users
+        # file, so the capabilities are looked up again after any user change.
+        # UsersDictionary has __slots__, so it's hooked on the class.
+        setUser = ircdb.UsersDictionary.setUser
+        def hook(users, *args, **kwargs):
+            self.capabilities.clear()
+            return setUser(users, *args, **kwargs)
+        ircdb.UsersDictionary.setUser = hook
+        self.usersHook = (setUser, hook)
+
+    def unhookUsers(self):
+        (setUser, hook) = self.usersHook
+        if ircdb.UsersDictionary.setUser is hook:
+            ircdb.UsersDictionary.setUser = setUser
+
+    def settings(self, irc, channel):
+        # Keyed by the normalised name so #Foo and #foo share one entry
+        channel = self.normalizeChannel(irc, channel)
+        try:
+            return self.channelSettings[(irc.network, channel)]
+        except KeyError:
+            pass
+        values = []
+        for name in CHANNEL_SETTINGS:
+            setting = conf.supybot.plugins.LogsToDB.get(name)
+            values.append(setting.getSpecific(irc.network, channel,
+                                              check=False)())
+            # Watch every value the lookup could have come from, they all
+            # exist now that getSpecific has been through them
+            for specific in (setting,
+                             setting.getSpecific(network=irc.network,
+                                                 check=False),
+                             setting.getSpecific(channel=channel, check=False),
+                             setting.getSpecific(irc.network, channel,
+                                                 check=False,
+                                                 fallback_to_channel=False)):
+                self.watch(specific)
+        values.append(self.registryValue('flushImmediately'))
+        values.append(conf.supybot.log.timestampFormat())
+        settings = self.channelSettings[(irc.network, channel)] = \
+            Settings(*values)
+        return settings
 
     def normalizeChannel(self, irc, channel):
         return ircutils.toLower(channel)
 
-    def doLog(self, irc, channel, s, *args):
-        if not self.registryValue('enable', channel):
+    def addSink(self, sink, kinds):
+        for kind in kinds:
+            self.sinks.setdefault(kind, []).append(sink)
+
+    def emit(self, irc, kind, channel, nick, host=None, content='',
+             target=None, now=None, hidden=False):
+        """Hands an event to every sink taking its kind.  Handlers logging
+        one message in several channels pass the same now to each."""
+        sinks = self.sinks.get(kind)
+        if not sinks:
             return
-        s = format(s, *args)
-        channel = self.normalizeChannel(irc, channel)
-        log = self.getLog(irc, channel)
-        if self.registryValue('timestamp', channel):
-            self.timestamp(log)
-        if self.registryValue('stripFormatting', channel):
-            s = ircutils.stripFormatting(s)
-        log.write(s)
-        if self.registryValue('flushImmediately'):
+        event = channellogger_model.LogEvent(
+            kind, time.time() if now is None else now, channel,
+            self.normalizeChannel(irc, channel), nick, host, content, target,
+            hidden)
+        for sink in sinks:
+            sink(irc, event)
+
+    def logEvent(self, irc, event):
+        settings = self.settings(irc, event.channel)
+        if not settings.enable:
+            return
+        if settings.stripFormatting:
+            line = event.rendered('log stripped', lambda event:
+                ircutils.stripFormatting(event.rendered(
+                    'log', LOG_LINES[event.kind])))
+        else:
+            line = event.rendered('log', LOG_LINES[event.kind])
+        log = self.getLog(irc, event.normalized)
+        if settings.timestamp and settings.timestampFormat:
+            log.write(event.strftime(settings.timestampFormat))
+            log.write('  ')
+        log.write(line)
+        if settings.flushImmediately:
             log.flush()
 
+    def stormsFor(self, irc):
+        """irc's Storms, None if netsplits aren't being written together."""
+        if self.stormSettings is None:
+            netsplits = conf.supybot.plugins.LogsToDB.netsplits
+            values = []
+            for setting in (netsplits, netsplits.window,
+                            netsplits.joinThreshold, netsplits.rejoinTime):
+                self.watch(setting)
+                values.append(setting())
+            self.stormSettings = values
+            for storms in self.storms.values():
+                (storms.window, storms.threshold, storms.rejoinTime) = \
+                    values[1:]
+        if not self.stormSettings[0]:
+            return None
+        storms = self.storms.get(irc)
+        if storms is None:
+            storms = self.storms[irc] = Storms(*self.stormSettings[1:])
+        return storms
+
+    def scheduleStorms(self, when):
+        if self.stormCheck is not None and self.stormCheck <= when:
+            return
+        if self.stormCheck is not None:
+            schedule.removeEvent('LogsToDB.storms')
+        self.stormCheck = when
+        schedule.addEvent(self.stormsDue, when, 'LogsToDB.storms')
+
+    def stormsDue(self):
+        self.stormCheck = None
+        self.writeStorms()
+
+    def writeStorms(self, everything=False):
+        "Write the storms that are over, or all of them, and check again later"
+        if self.stormCheck is not None:
+            schedule.removeEvent('LogsToDB.storms')
+            self.stormCheck = None
+        now = time.time()
+        for (irc, storms) in list(self.storms.items()):
+            for storm in storms.due(now, everything):
+                self.emitStorm(irc, storm)
+            if storms.open:
+                self.scheduleStorms(storms.next())
+
+    def emitStorm(self, irc, storm):
+        if len(storm.users) == 1:
+            # Nothing to gather after all, it's a plain quit or join
+            (nick, host, when) = storm.users[0]
+            if storm.kind == 'netsplit':
+                self.emit(irc, 'quit', storm.channel, nick, host,
+                          storm.servers, now=when)
+            else:
+                self.emit(irc, 'join', storm.channel, nick, host, now=when)
+        else:
+            # Logged when it's written, each user's own time is in target
+            self.emit(irc, storm.kind, storm.channel, None,
+                      content=storm.servers, target=storm.users)
+
+    def fileEvent(self, irc, event):
+        self.logViewerFile.write_event(event)
+
+    def dbEvent(self, irc, event):
+        self.dbWriter.add_event(event)
+
+    def banEvent(self, irc, event):
+        if event.kind == 'ban':
+            self.logViewerDB.bans.add(event.channel, event.target, event.nick)
+        else:
+            self.logViewerDB.bans.remove(event.channel, event.target)
+
     def doPrivmsg(self, irc, msg):
         (recipients, text) = msg.args
+        now = time.time()
         for channel in recipients.split(','):
             if irc.isChannel(channel):
-                noLogPrefix = self.registryValue('noLogPrefix', channel)
-                cap = ircdb.makeChannelCapability(channel, 'logChannelMessages')
-                try:
-                    logChannelMessages = ircdb.checkCapability(msg.prefix, cap,
-                        ignoreOwner=True)
-                except KeyError:
-                    logChannelMessages = True
-                nick = msg.nick or irc.nick
+                noLogPrefix = self.settings(irc, channel).noLogPrefix
+                logChannelMessages = self.capabilities.logChannelMessages(
+                    msg.prefix, channel)
+                # The channel logs show who a relayed message is from, the
+                # database and day logs the relay that sent it
+                relayed = None
                 if msg.tagged('LogsToDB__relayed'):
-                    (nick, text) = text.split(' ', 1)
-                    nick = nick[1:-1]
+                    (relayed, text) = text.split(' ', 1)
+                    relayed = relayed[1:-1]
                     msg.args = (recipients, text)
-                if (noLogPrefix and text.startswith(noLogPrefix)) or \
-                        not logChannelMessages:
-                    text = '-= THIS MESSAGE NOT LOGGED =-'
+                elif not msg.nick:
+                    relayed = irc.nick
+                hidden = (noLogPrefix and text.startswith(noLogPrefix)) or \
+                    not logChannelMessages
                 if ircmsgs.isAction(msg):
-                    self.doLog(irc, channel,
-                               '* %s %s\n', nick, ircmsgs.unAction(msg))
+                    self.emit(irc, 'emote', channel, msg.nick, msg.prefix,
+                              ircmsgs.unAction(msg), target=relayed, now=now,
+                              hidden=hidden)
                 else:
-                    self.doLog(irc, channel, '<%s> %s\n', nick, text)
-                
-                message = msg.args[1]
-                self.logViewerDB.add_message(msg.nick, msg.prefix, message, channel)
-                self.logViewerFile.write_message(msg.nick, message)
+                    self.emit(irc, 'message', channel, msg.nick, msg.prefix,
+                              text, target=relayed, now=now, hidden=hidden)
 
     def doNotice(self, irc, msg):
         (recipients, text) = msg.args
+        now = time.time()
         for channel in recipients.split(','):
             if irc.isChannel(channel):
-                self.doLog(irc, channel, '-%s- %s\n', msg.nick, text)
+                self.emit(irc, 'notice', channel, msg.nick, msg.prefix, text,
+                          now=now)
 
 
     def getcount(self, irc, msg, args):
@@ -275,20 +1099,284 @@ class LogsToDB(callbacks.Plugin):
 
     getcount = wrap(getcount)
 
+    def _parseDate(self, irc, s):
+        for format in ('%Y-%m-%d %H:%M', '%Y-%m-%d'):
+            try:
+                return datetime.datetime.strptime(s, format)
+            except ValueError:
+                pass
+        irc.errorInvalid(_('date'), s)
+
+    def checkReadable(self, irc, msg, channel):
+        """Errors unless msg's sender may read what was logged in channel:
+        it's where they asked, they're in it or they're one of its ops.  None
+        is every channel, which takes the owner capability."""
+        if channel is None:
+            if not ircdb.checkCapability(msg.prefix, 'owner',
+                                         ignoreDefaultAllow=True):
+                irc.errorNoCapability('owner', Raise=True)
+            return
+        if msg.channel and ircutils.strEqual(msg.channel, channel):
+            return
+        state = irc.state.channels.get(channel)
+        if state is not None and msg.nick in state.users:
+            return
+        capability = ircdb.makeChannelCapability(channel, 'op')
+        if not ircdb.checkCapability(msg.prefix, capability,
+                                     ignoreDefaultAllow=True):
+            irc.errorNoCapability(capability, Raise=True)
+
+    @internationalizeDocstring
+    def search(self, irc, msg, args, optlist, terms):
+        """[--channel <channel>] [--nick <nick>] [--since <date>] [--until <date>] [--before <position>] <terms>
+
+        Searches the logged messages for <terms>, newest first.  Dates are
+        given as YYYY-MM-DD or "YYYY-MM-DD HH:MM".  If there are more
+        results, the reply ends with the --before <position> that fetches the
+        next page.  <channel> defaults to the channel the command is sent in,
+        searching another one takes being in it or its op capability, and
+        searching every channel (in private, without --channel) the owner
+        capability.
+        """
+        options = dict(optlist)
+        channel = options.get('channel') or msg.channel
+        self.checkReadable(irc, msg, channel)
+        since = until = before = None
+        if 'since' in options:
+            since = self._parseDate(irc, options['since'])
+        if 'until' in options:
+            until = self._parseDate(irc, options['until'])
+        if 'before' in options:
+            try:
+                (id, timestamp) = options['before'].split('-')
+                before = (datetime.datetime.strptime(timestamp,
+                                                     '%Y%m%d%H%M%S%f'),
+                          int(id))
+            except ValueError:
+                irc.errorInvalid(_('position'), options['before'])
+        limit = self.registryValue('search.maxResults')
+        try:
+            # Ask for one more than we show to know whether there's a next page
+            rows = self.logViewerDB.search(terms,
+                channel=channel, nick=options.get('nick'),
+                since=since, until=until, before=before, limit=limit + 1,
+                timeout=self.registryValue('search.timeout'))
+        except self.logViewerDB.errors as e:
+            irc.error(_('Search failed: %s') % e, Raise=True)
+        if not rows:
+            irc.reply(_('No messages found.'))
+            return
+        replies = ['[%s] %s <%s> %s' % (timestamp.strftime('%Y-%m-%d %H:%M'),
+                                        channel, nick, content)
+                   for (id, timestamp, channel, nick, content) in rows[:limit]]
+        if len(rows) > limit:
+            (id, timestamp) = rows[limit - 1][:2]
+            replies.append(_('more: --before %s-%s') %
+                           (id, timestamp.strftime('%Y%m%d%H%M%S%f')))
+        irc.reply(' | '.join(replies))
+    search = thread(wrap(search, [getopts({'channel': 'something',
+                                           'nick': 'something',
+                                           'since': 'something',
+                                           'until': 'something',
+                                           'before': 'something'}),
+                                  'text']))
+
+    @internationalizeDocstring
+    def stats(self, irc, msg, args, optlist, channel):
+        """[--hours <hours>] [<channel>]
+
+        Shows how active <channel> has been over the last <hours> hours
+        (supybot.plugins.LogsToDB.stats.hours by default).  <channel> is only
+        necessary if the message isn't sent in the channel itself, another
+        channel takes being in it or its op capability.
+        """
+        self.checkReadable(irc, msg, channel)
+        hours = dict(optlist).get('hours') or self.registryValue('stats.hours')
+        since = datetime.datetime.now() - datetime.timedelta(hours=hours)
+        since = since.replace(minute=0, second=0, microsecond=0)
+        try:
+            stats = self.logViewerDB.activity_stats(channel, since,
+                talkers=self.registryValue('stats.talkers'))
+        except self.logViewerDB.errors as e:
+            irc.error(_('Could not get the stats: %s') % e, Raise=True)
+        if stats is None:
+            irc.error(_('%s has not been logged.') % channel, Raise=True)
+        actions = stats['actions']
+        replies = [', '.join(['%s %s' % (actions.get(action, 0), name)
+                              for (action, name) in
+                              (('message', _('messages')),
+                               ('emote', _('emotes')),
+                               ('join', _('joins')),
+                               ('part', _('parts')),
+                               ('quit', _('quits')))])]
+        if stats['busiest']:
+            (hour, count) = stats['busiest']
+            replies.append(_('busiest hour %s with %s messages') %
+                           (hour.strftime('%Y-%m-%d %H:00'), count))
+        (average, peak) = stats['users']
+        if peak is not None:
+            replies.append(_('%s users on average, %s at most') %
+                           (average, peak))
+        if stats['talkers']:
+            replies.append(_('top talkers: %s') %
+                           ', '.join(['%s (%s)' % talker
+                                      for talker in stats['talkers']]))
+        irc.reply(_('%s in the last %s hours: %s') %
+                  (channel, hours, '; '.join(replies)))
+    stats = thread(wrap(stats, [getopts({'hours': 'positiveInt'}),
+                                'channel']))
+
+    @internationalizeDocstring
+    def export(self, irc, msg, args, optlist, channel):
+        """[--nick <nick>] [--action <action>] [--since <date>] [--until <date>] [--format jsonl|csv] [--gzip] [<channel>]
+
+        Exports <channel>'s logged messages, archived ones included, to a file
+        in supybot.plugins.LogsToDB.export.directory.  Dates are given as
+        YYYY-MM-DD or "YYYY-MM-DD HH:MM".  <channel> is only necessary if the
+        message isn't sent in the channel itself.
+        """
+        options = dict(optlist)
+        since = until = None
+        if 'since' in options:
+            since = self._parseDate(irc, options['since'])
+        if 'until' in options:
+            until = self._parseDate(irc, options['until'])
+        format = options.get('format', 'jsonl')
+        directory = self.registryValue('export.directory') or \
+            conf.supybot.directories.data.dirize('LogsToDB-exports')
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, channellogger_export.export_filename(
+            channel, format, 'gzip' in options))
+        try:
+            count = channellogger_export.export_messages(self.logViewerDB,
+                path, channel, format, 'gzip' in options,
+                nick=options.get('nick'), action=options.get('action'),
+                since=since, until=until,
+                itersize=self.registryValue('export.itersize'))
+        except self.logViewerDB.errors + (EnvironmentError,) as e:
+            irc.error(_('Export failed: %s') % e, Raise=True)
+        irc.reply(_('Exported %s messages to %s') % (count, path))
+    export = thread(wrap(export, ['owner',
+                                  getopts({'nick': 'something',
+                                           'action': 'something',
+                                           'since': 'something',
+                                           'until': 'something',
+                                           'format': ('literal',
+                                                      ('jsonl', 'csv')),
+                                           'gzip': ''}),
+                                  'channel']))
+
+    @internationalizeDocstring
+    def bans(self, irc, msg, args, hostmask, channel):
+        """<nick|hostmask> [<channel>]
+
+        Lists the active bans matching <hostmask> (nick!user@host) in
+        <channel>, by default the channel the command is sent in.  Another
+        channel takes being in it or its op capability, and every channel (in
+        private, without <channel>) the owner capability.  A nick is looked up
+        among the users the bot can see.
+        """
+        channel = channel or msg.channel
+        self.checkReadable(irc, msg, channel)
+        if not ircutils.isUserHostmask(hostmask):
+            try:
+                hostmask = irc.state.nickToHostmask(hostmask)
+            except KeyError:
+                irc.errorNoUser(name=hostmask, Raise=True)
+        bans = self.logViewerDB.bans.match(hostmask, channel)
+        if not bans:
+            irc.reply(_('No active bans match %s.') % hostmask)
+            return
+        irc.reply(_('%s is banned by %s') % (hostmask, ', '.join([
+            _('%s in %s (set by %s on %s)') %
+            (ban.mask, ban.channel, ban.setBy or _('unknown'),
+             ban.timestamp.strftime('%Y-%m-%d'))
+            for ban in sorted(bans, key=lambda ban: ban.timestamp)])))
+    bans = wrap(bans, ['something', optional('validChannel')])
+
+    @internationalizeDocstring
+    def logstats(self, irc, msg, args, name):
+        """[<name>]
+
+        Shows how many times each handler, log write and database query has
+        run and how long they took, along with the writer queue, spool and
+        connection pool.  If <name> is given only what starts with it is
+        shown, e.g. "handler", "db_query" or "pool".
+        """
+        if self.metrics is None:
+            irc.error(_('Metrics are off, turn on '
+                        'supybot.plugins.LogsToDB.metrics and reload the '
+                        'plugin.'), Raise=True)
+        (histograms, gauges) = self.metrics.snapshot()
+        replies = []
+        for ((histogram, label), (count, total, p50, p99, counts)) in \
+                sorted(histograms.items()):
+            key = '%s %s' % (histogram, label)
+            if name and not key.startswith(name):
+                continue
+            replies.append(_('%s: %s, avg %.3fms, p50 <%gms, p99 <%gms') %
+                           (key, count, total * 1000 / count, p50 * 1000,
+                            p99 * 1000))
+        for (gauge, value) in sorted(gauges.items()):
+            if name and not gauge.startswith(name):
+                continue
+            replies.append('%s: %s' % (gauge, value))
+        if not replies:
+            irc.reply(_('Nothing recorded yet.'))
+            return
+        irc.reply('; '.join(replies))
+    logstats = wrap(logstats, [additional('something')])
+
+    @internationalizeDocstring
+    def profile(self, irc, msg, args, seconds):
+        """<seconds>
+
+        Profiles the bot's main thread, where the handlers run, for <seconds>
+        seconds and saves the stats for pstats in the data directory.  The
+        background writer's thread is not included.
+        """
+        if self.profiler is not None:
+            irc.error(_('Already profiling.'), Raise=True)
+        path = conf.supybot.directories.data.dirize(
+            'LogsToDB-%s.pstats' % time.strftime('%Y%m%d-%H%M%S'))
+        def stop():
+            profiler = self.profiler
+            self.profiler = None
+            profiler.disable()
+            profiler.dump_stats(path)
+            self.log.info('Saved %s seconds of profiling to %s', seconds, path)
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        schedule.addEvent(stop, time.time() + seconds, 'LogsToDB.profile')
+        irc.reply(_('Profiling for %s seconds, the stats will be saved to %s')
+                  % (seconds, path))
+    profile = wrap(profile, ['owner', 'positiveInt'])
+
     def doNick(self, irc, msg):
         oldNick = msg.nick
         newNick = msg.args[0]
-        for (channel, c) in irc.state.channels.items():
-            if newNick in c.users:
-                self.doLog(irc, channel,
-                           '*** %s is now known as %s\n', oldNick, newNick)
+        if not isinstance(irc, irclib.Irc):
+            irc = irc.getRealIrc()
+        self.capabilities.forget(msg.prefix)
+        now = time.time()
+        for channel in self.membership(irc).channels(oldNick):
+            self.emit(irc, 'nick', channel, oldNick, msg.prefix,
+                      target=newNick, now=now)
+
     def doJoin(self, irc, msg):
+        if not isinstance(irc, irclib.Irc):
+            irc = irc.getRealIrc()
+        storms = self.stormsFor(irc)
+        now = time.time()
         for channel in msg.args[0].split(','):
-            if(self.registryValue('showJoinParts', channel)):
-                self.doLog(irc, channel,
-                           '*** %s <%s> has joined %s\n',
-                           msg.nick, msg.prefix, channel)
-                self.logViewerFile.write_join(msg.nick, msg.prefix, channel)
+            if self.settings(irc, channel).showJoinParts:
+                if storms is not None and \
+                        storms.join(channel, msg.nick, msg.prefix, now):
+                    self.scheduleStorms(now + storms.window)
+                else:
+                    self.emit(irc, 'join', channel, msg.nick, msg.prefix,
+                              now=now)
 
     def doKick(self, irc, msg):
         if len(msg.args) == 3:
@@ -296,68 +1384,63 @@ class LogsToDB(callbacks.Plugin):
         else:
             (channel, target) = msg.args
             kickmsg = ''
-
-        print(msg)
-        if kickmsg:
-            self.doLog(irc, channel,
-                       '*** %s was kicked by %s (%s)\n',
-                       target, msg.nick, kickmsg)
-            self.logViewerFile.write_kick(target, msg.nick, channel)
-        else:
-            self.doLog(irc, channel,
-                       '*** %s was kicked by %s\n', target, msg.nick, channel)
-            self.logViewerFile.write_kick(target, msg.nick)
+        self.emit(irc, 'kick', channel, msg.nick, msg.prefix, kickmsg,
+                  target=target)
 
     def doPart(self, irc, msg):
         if len(msg.args) > 1:
-            reason = " (%s)" % msg.args[1]
+            reason = msg.args[1]
         else:
-            reason = ""
+            reason = ''
+        now = time.time()
         for channel in msg.args[0].split(','):
-            if(self.registryValue('showJoinParts', channel)):
-                self.doLog(irc, channel,
-                           '*** %s <%s> has left %s%s\n',
-                           msg.nick, msg.prefix, channel, reason)
-                self.logViewerDB.add_part(msg.nick, msg.prefix, channel)
-                self.logViewerFile.write_part(msg.nick, msg.prefix, channel)
+            if self.settings(irc, channel).showJoinParts:
+                self.emit(irc, 'part', channel, msg.nick, msg.prefix, reason,
+                          now=now)
 
     def doMode(self, irc, msg):
         channel = msg.args[0]
         if irc.isChannel(channel) and msg.args[1:]:
-            self.doLog(irc, channel,
-                       '*** %s sets mode: %s %s\n',
-                       msg.nick or msg.prefix, msg.args[1],
-                        ' '.join(msg.args[2:]))
-            if (msg.args[1] == '+b'):                
-                self.logViewerFile.write_ban(msg.nick, msg.prefix, msg.args[1], ' '.join(msg.args[2:]), channel)
-                self.logViewerDB.write_ban(msg.nick, msg.prefix, msg.args[1], ' '.join(msg.args[2:]), channel)
-            elif (msg.args[1] == '-b'):
-                self.logViewerFile.write_unban(msg.nick, msg.prefix, msg.args[1], ' '.join(msg.args[2:]), channel)
-                self.logViewerDB.write_unban(msg.nick, msg.prefix, msg.args[1], ' '.join(msg.args[2:]), channel)
+            now = time.time()
+            self.emit(irc, 'mode', channel, msg.nick or msg.prefix, msg.prefix,
+                      '%s %s' % (msg.args[1], ' '.join(msg.args[2:])),
+                      now=now)
+            # One line can set several modes, +bb-o a b nick is two bans
+            for (mode, target) in ircutils.separateModes(msg.args[1:]):
+                if mode == '+b':
+                    self.emit(irc, 'ban', channel, msg.nick, msg.prefix, mode,
+                              target=target, now=now)
+                elif mode == '-b':
+                    self.emit(irc, 'unban', channel, msg.nick, msg.prefix,
+                              mode, target=target, now=now)
 
 
     def doTopic(self, irc, msg):
         if len(msg.args) == 1:
             return # It's an empty TOPIC just to get the current topic.
         channel = msg.args[0]
-        self.doLog(irc, channel,
-                   '*** %s changes topic to "%s"\n', msg.nick, msg.args[1])
+        self.emit(irc, 'topic', channel, msg.nick, msg.prefix, msg.args[1])
 
     def doQuit(self, irc, msg):
         if len(msg.args) == 1:
-            reason = " (%s)" % msg.args[0]
+            reason = msg.args[0]
         else:
-            reason = ""
+            reason = ''
         if not isinstance(irc, irclib.Irc):
             irc = irc.getRealIrc()
-        for (channel, chan) in self.lastStates[irc].channels.items():
-            if(self.registryValue('showJoinParts', channel)):
-                if msg.nick in chan.users:
-                    self.doLog(irc, channel,
-                               '*** %s <%s> has quit IRC%s\n',
-                               msg.nick, msg.prefix, reason)
-                    self.logViewerDB.add_quit(msg.nick, msg.prefix, channel)
-                    self.logViewerFile.write_quit(msg.nick, msg.prefix, channel)
+        self.capabilities.forget(msg.prefix)
+        # A netsplit's quits are gathered per channel and written together
+        # once they stop, see writeStorms
+        storms = self.stormsFor(irc)
+        now = time.time()
+        for channel in self.membership(irc).channels(msg.nick):
+            if self.settings(irc, channel).showJoinParts:
+                if storms is not None and storms.quit(channel, msg.nick,
+                                                      msg.prefix, reason, now):
+                    self.scheduleStorms(now + storms.window)
+                else:
+                    self.emit(irc, 'quit', channel, msg.nick, msg.prefix,
+                              reason, now=now)
 
     def outFilter(self, irc, msg):
         # Gotta catch my own messages *somehow* :)
@@ -0,0 +1,85 @@
+###
+# Copyright (c) 2002-2004, Jeremiah Fincher
+# Copyright (c) 2009-2010, James McCoy
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+import tempfile
+
+from supybot.test import *
+
+from . import plugin
+
+class LogsToDBTestCase(ChannelPluginTestCase):
+    plugins = ('LogsToDB',)
+
+    def setUp(self):
+        # No Postgres or config.json here: SQLite, written as events come, and
+        # the daily logs in a scratch directory
+        settings = conf.supybot.plugins.LogsToDB
+        self.defaults = (settings.backend(), settings.backgroundWriter())
+        settings.backend.setValue('sqlite')
+        settings.backgroundWriter.setValue(False)
+        self.logDir = tempfile.mkdtemp()
+        self.loadConfig = plugin.channellogger_model.load_config
+        plugin.channellogger_model.load_config = \
+            lambda path=None: {'logs': {'folderPath': self.logDir}}
+        ChannelPluginTestCase.setUp(self)
+
+    def tearDown(self):
+        ChannelPluginTestCase.tearDown(self)
+        plugin.channellogger_model.load_config = self.loadConfig
+        settings = conf.supybot.plugins.LogsToDB
+        settings.backend.setValue(self.defaults[0])
+        settings.backgroundWriter.setValue(self.defaults[1])
+
+    def clearQueue(self):
+        # The bot's own joins have it asking the server about the channel
+        while self.irc.takeMsg():
+            pass
+
+    def testStatsSecretChannel(self):
+        secret = '#secret'
+        member = 'member!m@__no_testcap__'
+        self.irc.feedMsg(ircmsgs.join(secret, prefix=self.irc.prefix))
+        self.irc.feedMsg(ircmsgs.mode(secret, ('+s',), prefix='op!o@o'))
+        self.irc.feedMsg(ircmsgs.join(secret, prefix=member))
+        self.irc.feedMsg(ircmsgs.privmsg(secret, 'hello', prefix=member))
+        self.clearQueue()
+        self.assertRegexp('logstodb stats %s' % secret, 'capability',
+                          frm='nobody!n@__no_testcap__')
+        self.assertRegexp('logstodb stats %s' % secret, '1 messages',
+                          frm=member)
+
+    def testStatsJoins(self):
+        for prefix in (self.irc.prefix, 'bob!b@h', 'carl!c@h'):
+            self.irc.feedMsg(ircmsgs.join('#joins', prefix=prefix))
+        self.clearQueue()
+        self.assertRegexp('logstodb stats #joins', '3 joins')
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
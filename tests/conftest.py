@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+# The modules are imported on their own, as importer.py and benchmark.py do,
+# rather than as the plugin package (which needs supybot)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import channelLogger_spool
+import channelLogger_sqlite
+
+@pytest.fixture
+def spool(tmp_path):
+	spool = channelLogger_spool.LogviewerSpool(str(tmp_path / 'spool'), fsync='never')
+	yield spool
+	spool.close()
+
+@pytest.fixture
+def db(tmp_path, monkeypatch, spool):
+	# LogviewerStorage logs to combined.log in the working directory
+	monkeypatch.chdir(tmp_path)
+	db = channelLogger_sqlite.SQLiteDB(str(tmp_path / 'logs.sqlite3'), spool=spool)
+	yield db
+	db.close()
@@ -0,0 +1,36 @@
+import argparse
+
+import importer
+
+OPTIONS = argparse.Namespace(timestamp_format='%Y-%m-%dT%H:%M:%S', channel='#test')
+
+def parse(tmp_path, name, lines, parser):
+	path = tmp_path / name
+	path.write_text(''.join(line + '\n' for line in lines))
+	return [event for (event, offset) in parser(str(path), 0, OPTIONS)]
+
+def test_channel_log_storms(tmp_path, db):
+	events = parse(tmp_path, '#test.log', [
+		'2024-05-01T12:00:00  *** alice <alice!a@host> has joined #test',
+		'2024-05-01T12:05:00  *** Netsplit hub.example.net <-> leaf.example.net, 2 users quit: alice, bob',
+		'2024-05-01T12:20:00  *** 2 users joined after the netsplit: alice, bob',
+	], importer.parse_channel_log)
+	assert None not in events
+	assert db.write_batch(events)
+	assert [(nick, action) for (id, timestamp, user, nick, action, content) in db.iter_messages('#test')] == [('alice', 'join'), ('alice', 'quit'), ('bob', 'quit'), ('alice', 'join'), ('bob', 'join')]
+
+def test_viewer_log_storms(tmp_path, db):
+	events = parse(tmp_path, '2024-05-01.log', [
+		'12:05:00 <-- Netsplit hub.example.net leaf.example.net, 2 users quit #test: <alice> (alice!a@host) <bob> (bob!b@host) ',
+		'12:20:00 --> 2 users join #test: <alice> (alice!a@host) <bob> (bob!b@host) ',
+	], importer.parse_viewer_log)
+	assert events[0] == ('group', events[0][1], ('quit', [('alice', 'alice!a@host', events[0][1]), ('bob', 'bob!b@host', events[0][1])], '#test'))
+	assert db.write_batch(events)
+	assert [(nick, action) for (id, timestamp, user, nick, action, content) in db.iter_messages('#test')] == [('alice', 'quit'), ('bob', 'quit'), ('alice', 'join'), ('bob', 'join')]
+
+def test_viewer_log_emote(tmp_path):
+	events = parse(tmp_path, '2024-05-01.log', [
+		'12:00:00 <alice> \x01ACTION waves\x01',
+		'12:00:01 <alice> hello',
+	], importer.parse_viewer_log)
+	assert [args[2:4] for (kind, timestamp, args) in events] == [('waves', 'emote'), ('hello', 'message')]
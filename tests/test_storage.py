@@ -0,0 +1,70 @@
+import datetime
+import time
+
+import pytest
+
+import channelLogger_model
+
+NOW = time.mktime((2024, 5, 1, 12, 0, 0, 0, 0, -1))
+
+def message(nick, text, channel='#test', when=NOW, action='message'):
+	return ('message', when, (nick, '%s@example.com' % nick, text, action, channel))
+
+def rows(db, channel='#test', **filters):
+	return [(nick, action, content) for (id, timestamp, user, nick, action, content) in db.iter_messages(channel, **filters)]
+
+def test_abstract():
+	with pytest.raises(TypeError):
+		channelLogger_model.LogviewerStorage()
+
+def test_write_batch(db):
+	assert db.write_batch([message('alice', 'hello'), message('bob', 'hi', action='emote'), message('alice', '', action='join')])
+	assert rows(db) == [('alice', 'message', 'hello'), ('bob', 'emote', 'hi'), ('alice', 'join', None)]
+	stats = db.activity_stats('#test', datetime.datetime(2024, 1, 1))
+	assert stats['actions'] == {'message': 1, 'emote': 1, 'join': 1}
+
+def test_write_batch_drops_bad_event(db):
+	# A NULL nick fails the batch, only that event is lost on the retry
+	assert db.write_batch([message('alice', 'one'), message(None, 'two'), message('bob', 'three')], ('segment', 42))
+	assert rows(db) == [('alice', 'message', 'one'), ('bob', 'message', 'three')]
+	assert db.get_marker('segment') == 42
+	# Nothing cached for the rolled back event
+	assert db.nickCache.get(None) is None
+
+def test_replay_spool(db, spool):
+	batches = [[message('alice', 'one', when=NOW + i * 2), message('bob', 'two', when=NOW + i * 2 + 1)] for i in range(3)]
+	for events in batches:
+		db.spool_events(events)
+	db.replayBatch = 4
+	replays = 0
+	while db.replay_spool():
+		replays += 1
+	assert replays == 3
+	assert not spool.pending()
+	assert rows(db) == [('alice', 'message', 'one'), ('bob', 'message', 'two')] * 3
+	assert db.get_marker(spool.segments[0] if spool.segments else 'gone') == 0
+
+def test_iter_messages_filters(db):
+	db.write_batch([message('alice', 'early', when=NOW), message('bob', 'late', when=NOW + 3600), message('alice', 'elsewhere', channel='#other'), message('alice', 'waves', when=NOW + 7200, action='emote')])
+	later = datetime.datetime.fromtimestamp(NOW + 1800)
+	assert rows(db, since=later) == [('bob', 'message', 'late'), ('alice', 'emote', 'waves')]
+	assert rows(db, until=later) == [('alice', 'message', 'early')]
+	assert rows(db, nick='alice') == [('alice', 'message', 'early'), ('alice', 'emote', 'waves')]
+	assert rows(db, action='emote') == [('alice', 'emote', 'waves')]
+	assert rows(db, '#missing') == []
+
+def test_search(db):
+	db.write_batch([message('alice', 'The quick brown fox', when=NOW), message('bob', 'a quick reply', when=NOW + 1), message('carol', 'quick fox', channel='#other', when=NOW + 2)])
+	found = db.search('quick fox')
+	assert [(channel, nick, content) for (id, timestamp, channel, nick, content) in found] == [('#other', 'carol', 'quick fox'), ('#test', 'alice', 'The quick brown fox')]
+	assert [nick for (id, timestamp, channel, nick, content) in db.search('QUICK', channel='#test')] == ['bob', 'alice']
+	assert [nick for (id, timestamp, channel, nick, content) in db.search('quick', nick='bob')] == ['bob']
+	# Paging carries on from the last row of the previous page
+	(first,) = db.search('quick', limit=1)
+	assert [nick for (id, timestamp, channel, nick, content) in db.search('quick', before=(first[1], first[0]))] == ['bob', 'alice']
+
+def test_joins_only_counted(db):
+	db.add_event(channelLogger_model.LogEvent('join', NOW, '#test', '#test', 'alice', 'alice@example.com'))
+	db.add_event(channelLogger_model.LogEvent('netjoin', NOW + 1, '#test', '#test', None, content='', target=[('bob', 'bob@example.com', NOW + 1), ('carol', 'carol@example.com', NOW + 2)]))
+	assert rows(db) == []
+	assert db.activity_stats('#test', datetime.datetime(2024, 1, 1))['actions'] == {'join': 3}